@@ -2,7 +2,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from fastapi import FastAPI, Request, Depends, Form, Path, Query, status, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
@@ -29,11 +29,28 @@ import re
 import unicodedata
 from utils.security import verify_password, get_password_hash, create_access_token, verify_token
 from utils.csrf import get_csrf_token, verify_csrf_token
+from utils.transliteration import CYRILLIC_TO_LATIN
 from utils.image_processor import ImageProcessor
 from services.api import api_router
 from services.notifications import NotificationService, NotificationTemplates
-from services.comments import CommentService, CommentValidator
-from services.cache import QueryCache, CacheInvalidator
+from services.realtime import realtime_notifications
+from services.notification_archive import notification_archiver
+from services.comments import CommentService, CommentValidator, comment_counter
+from services.cache import QueryCache, CacheInvalidator, install_invalidation_hooks
+from services.search import search_service
+from services.counts import count_service
+from services.facets import facet_index
+from services.tags import tag_service
+from services.deals import deal_investor_index
+from services.coinvest import coinvest_graph
+from services.similarity import similarity_engine
+from services.matching import matching_engine
+from services.analytics import analytics_service
+from services.funding import funding_analytics
+from services.admin_stats import admin_counters
+from services.views import view_counter
+from services.trending import trending_engine
+from services.sitemap import sitemap_service
 from services.pagination import PaginationHelper, DatabasePagination
 from services.email import email_service
 
@@ -51,9 +68,46 @@ def get_redirect_url(request: Request, path: str) -> str:
 
 app = FastAPI()
 
+# Инвалидация кеша по тегам при коммите изменений компаний, инвесторов, новостей и т.д.
+install_invalidation_hooks(SessionLocal)
+
+# Поисковый индекс обновляется вместе с компаниями, инвесторами, новостями и вакансиями
+search_service.install_hooks()
+
+# Фасеты фильтров пересчитываются на разницу значений при записи компаний, инвесторов и вакансий
+facet_index.install_hooks()
+
+# Теги Investor.focus/stages и Company.industry синхронизируются с таблицами связей при записи
+tag_service.install_hooks()
+
+# Связи сделок с инвесторами синхронизируются с полем Deal.investors при записи
+deal_investor_index.install_hooks()
+
+# Граф соинвестиций пересчитывает затронутые раунды после flush сделок и записей портфеля
+coinvest_graph.install_hooks()
+
+# Списки похожих компаний пересчитываются в фоне после коммита изменений компаний
+similarity_engine.install_hooks()
+
+# Агрегаты аналитики пересчитывают затронутые ячейки после flush сделок и компаний
+analytics_service.install_hooks()
+
+# Трендовые рейтинги получают просмотры и закоммиченные комментарии
+trending_engine.install_hooks(view_counter)
+
+# Части sitemap отмечаются устаревшими после flush записей в компании, инвесторов, новости и т.д.
+sitemap_service.install_hooks()
+
+# События уведомлений (SSE, счетчик непрочитанных) доставляются после коммита
+realtime_notifications.install_hooks()
+
 # Подключение статики и шаблонов
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+# Бейджи меню админки (новая обратная связь и т.п.) из кешированных счетчиков
+templates.env.globals['admin_badges'] = admin_counters.badges
+# Непрочитанные уведомления в меню - из кеша воркера
+templates.env.globals['unread_notifications'] = realtime_notifications.badge
 
 # Middleware для генерации session_id для CSRF защиты
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -79,22 +133,8 @@ def generate_slug(title):
     # Нормализация Unicode (убираем диакритические знаки)
     title = unicodedata.normalize('NFKD', title)
     
-    # Транслитерация кириллицы в латиницу
-    cyrillic_to_latin = {
-        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
-        'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
-        'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
-        'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
-        'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
-        'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'E',
-        'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й': 'Y', 'К': 'K', 'Л': 'L', 'М': 'M',
-        'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R', 'С': 'S', 'Т': 'T', 'У': 'U',
-        'Ф': 'F', 'Х': 'H', 'Ц': 'Ts', 'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch',
-        'Ъ': '', 'Ы': 'Y', 'Ь': '', 'Э': 'E', 'Ю': 'Yu', 'Я': 'Ya'
-    }
-    
     # Заменяем кириллицу на латиницу
-    for cyr, lat in cyrillic_to_latin.items():
+    for cyr, lat in CYRILLIC_TO_LATIN.items():
         title = title.replace(cyr, lat)
     
     # Приводим к нижнему регистру
@@ -260,53 +300,12 @@ async def universal_search(request: Request, q: str = Query('', alias='q')):
     q = q.strip()
     db = SessionLocal()
     try:
-        from sqlalchemy import or_
-        # Компании
-        companies = db.query(Company).filter(
-            Company.status == 'active',
-            or_(
-                Company.name.ilike(f'%{q}%'),
-                Company.description.ilike(f'%{q}%'),
-                Company.industry.ilike(f'%{q}%'),
-                Company.country.ilike(f'%{q}%'),
-                Company.city.ilike(f'%{q}%'),
-                Company.stage.ilike(f'%{q}%')
-            )
-        ).order_by(Company.id.desc()).limit(20).all()
-
-        # Инвесторы
-        investors = db.query(Investor).filter(
-            Investor.status == 'active',
-            or_(
-                Investor.name.ilike(f'%{q}%'),
-                Investor.description.ilike(f'%{q}%'),
-                Investor.focus.ilike(f'%{q}%'),
-                Investor.country.ilike(f'%{q}%'),
-                Investor.stages.ilike(f'%{q}%')
-            )
-        ).order_by(Investor.id.desc()).limit(20).all()
-
-        # Новости
-        news = db.query(News).options(joinedload(News.author)).filter(
-            News.status == 'active',
-            or_(
-                News.title.ilike(f'%{q}%'),
-                News.summary.ilike(f'%{q}%'),
-                News.content.ilike(f'%{q}%')
-            )
-        ).order_by(News.date.desc()).limit(20).all()
-
-        # Вакансии
-        jobs = db.query(Job).options(joinedload(Job.company)).filter(
-            Job.status == 'active',
-            or_(
-                Job.title.ilike(f'%{q}%'),
-                Job.description.ilike(f'%{q}%'),
-                Job.city.ilike(f'%{q}%'),
-                Job.job_type.ilike(f'%{q}%'),
-                Job.contact.ilike(f'%{q}%')
-            )
-        ).order_by(Job.id.desc()).limit(20).all()
+        # Полнотекстовый индекс: ранжирование по релевантности и сниппеты с подсветкой
+        results, snippets = search_service.search_entities(db, q, limit=20)
+        companies = results['company']
+        investors = results['investor']
+        news = results['news']
+        jobs = results['job']
 
         total_results = len(companies) + len(investors) + len(news) + len(jobs)
         print(f"[SEARCH] Запрос: '{q}' | Компании: {len(companies)}, Инвесторы: {len(investors)}, Новости: {len(news)}, Вакансии: {len(jobs)}")
@@ -316,6 +315,7 @@ async def universal_search(request: Request, q: str = Query('', alias='q')):
         investors = []
         news = []
         jobs = []
+        snippets = {}
         total_results = 0
     finally:
         db.close()
@@ -327,21 +327,37 @@ async def universal_search(request: Request, q: str = Query('', alias='q')):
         "investors": investors,
         "news": news,
         "jobs": jobs,
+        "snippets": snippets,
         "total_results": total_results
     })
 
+def load_trending(model, entity_type: str, limit: int) -> list:
+    """Активные записи из топа трендов в порядке оценки"""
+    ranked = trending_engine.ranked_ids(entity_type, limit * 4)
+    if not ranked:
+        return []
+    db = SessionLocal()
+    try:
+        loaded = {item.id: item for item in db.query(model).filter(model.id.in_(ranked), model.status == 'active')}
+    finally:
+        db.close()
+    return [loaded[entity_id] for entity_id in ranked if entity_id in loaded][:limit]
+
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request):
     print("INDEX SESSION:", dict(request.session))
-    db = SessionLocal()
     try:
-        # Простые запросы без сервисов
-        companies = db.query(Company).filter(Company.status == 'active').order_by(Company.id.desc()).limit(20).all()
-        investors = db.query(Investor).filter(Investor.status == 'active').order_by(Investor.id.desc()).limit(20).all()
-        news = db.query(News).options(joinedload(News.author)).filter(News.status == 'active').order_by(News.date.desc()).limit(10).all()
-        podcasts = db.query(Podcast).filter(Podcast.status == 'active').order_by(Podcast.date.desc()).limit(10).all()
-        jobs = db.query(Job).filter(Job.status == 'active').order_by(Job.id.desc()).limit(10).all()
-        events = db.query(Event).filter(Event.status == 'active').order_by(Event.date.desc()).limit(10).all()
+        # Блоки главной страницы из кеша: промах выполняет один запрос, остальные ждут его результата
+        homepage = QueryCache.get_homepage()
+        companies = homepage['companies']
+        investors = homepage['investors']
+        news = homepage['news']
+        podcasts = homepage['podcasts']
+        jobs = homepage['jobs']
+        events = homepage['events']
+        # Блоки "В тренде" - топ из памяти воркера, сами записи одним запросом на тип
+        trending_news = load_trending(News, 'news', 3)
+        trending_companies = load_trending(Company, 'company', 3)
     except Exception as e:
         print(f"Ошибка при загрузке данных: {e}")
         # Возвращаем пустые списки в случае ошибки
@@ -351,9 +367,9 @@ def index(request: Request):
         podcasts = []
         jobs = []
         events = []
-    finally:
-        db.close()
-    return templates.TemplateResponse("index.html", {"request": request, "session": request.session, "companies": companies, "investors": investors, "news": news, "podcasts": podcasts, "jobs": jobs, "events": events})
+        trending_news = []
+        trending_companies = []
+    return templates.TemplateResponse("index.html", {"request": request, "session": request.session, "companies": companies, "investors": investors, "news": news, "podcasts": podcasts, "jobs": jobs, "events": events, "trending_news": trending_news, "trending_companies": trending_companies})
 
 # robots.txt
 @app.get("/robots.txt")
@@ -368,54 +384,41 @@ def robots_txt():
             media_type="text/plain"
         )
 
+def sitemap_file_response(request: Request, filename: str):
+    """Готовый файл sitemap с ETag; 304, если у клиента та же версия"""
+    try:
+        sitemap_service.refresh()
+    except Exception as e:
+        print(f"Ошибка генерации sitemap: {e}")
+    found = sitemap_service.file(filename)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Sitemap не найден")
+    path, etag = found
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="application/xml", headers=headers)
+
 # sitemap.xml
 @app.get("/sitemap.xml")
-def sitemap_xml():
+def sitemap_xml(request: Request):
     env = os.getenv("ENVIRONMENT", "development")
 
     if env == "production":
-        db = SessionLocal()
-        try:
-            companies = db.query(Company).filter(Company.status == 'active').all()
-            investors = db.query(Investor).filter(Investor.status == 'active').all()
-            jobs = db.query(Job).filter(Job.status == 'active').all()
-            news = db.query(News).filter(News.status == 'active').all()
-        
-            sitemap = '<?xml version="1.0" encoding="UTF-8"?>\n'
-            sitemap += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-        
-            # Главная страница
-            sitemap += '  <url>\n'
-            sitemap += '    <loc>https://stanbase.tech/</loc>\n'
-            sitemap += '    <changefreq>daily</changefreq>\n'
-            sitemap += '    <priority>1.0</priority>\n'
-            sitemap += '  </url>\n'
-        
-            # Компании
-            for company in companies:
-                sitemap += '  <url>\n'
-                sitemap += f'    <loc>https://stanbase.tech/company/{company.id}</loc>\n'
-                sitemap += '    <changefreq>weekly</changefreq>\n'
-                sitemap += '    <priority>0.8</priority>\n'
-                sitemap += '  </url>\n'
-        
-            # Инвесторы
-            for investor in investors:
-                sitemap += '  <url>\n'
-                sitemap += f'    <loc>https://stanbase.tech/investor/{investor.id}</loc>\n'
-                sitemap += '    <changefreq>weekly</changefreq>\n'
-                sitemap += '    <priority>0.8</priority>\n'
-                sitemap += '  </url>\n'
-        
-            sitemap += '</urlset>'
-        
-            return Response(content=sitemap, media_type="application/xml")
-        finally:
-            db.close()
+        # Индекс частей sitemap (по 50 000 URL на файл)
+        return sitemap_file_response(request, "sitemap_index.xml")
     else:
         # Для разработки возвращаем статический файл
         return RedirectResponse(url="/static/sitemap.xml")
 
+@app.get("/sitemap_index.xml")
+def sitemap_index_xml(request: Request):
+    return sitemap_file_response(request, "sitemap_index.xml")
+
+@app.get("/sitemaps/{filename}")
+def sitemap_chunk_xml(request: Request, filename: str):
+    return sitemap_file_response(request, filename)
+
 
 @app.get("/companies", response_class=HTMLResponse)
 def companies(
@@ -424,6 +427,8 @@ def companies(
     country: str = Query('', alias='country'), 
     stage: str = Query('', alias='stage'), 
     industry: str = Query('', alias='industry'),
+    match: str = Query('', alias='match'),
+    sort: str = Query('', alias='sort'),
     page: int = Query(1, alias='page'),
     per_page: int = Query(20, alias='per_page')
 ):
@@ -433,37 +438,24 @@ def companies(
     per_page = min(per_page, 100)  # Максимум 100
     offset = (page - 1) * per_page
     
-    db = SessionLocal()
-    try:
-        query = db.query(Company).filter(Company.status == 'active')
-        if q:
-            # Поиск по названию, описанию и индустрии
-            from sqlalchemy import or_
-            search_filter = or_(
-                Company.name.ilike(f'%{q}%'),
-                Company.description.ilike(f'%{q}%'),
-                Company.industry.ilike(f'%{q}%')
-            )
-            query = query.filter(search_filter)
-        if country:
-            query = query.filter_by(country=country)
-        if stage:
-            query = query.filter_by(stage=stage)
-        if industry:
-            query = query.filter_by(industry=industry)
-        
-        # Получаем общее количество
-        total = query.count()
-        
-        # Применяем пагинацию
-        companies = query.order_by(Company.name).offset(offset).limit(per_page).all()
-        
-        # Получаем фильтры
-        countries = [c[0] for c in db.query(Company.country).distinct().order_by(Company.country) if c[0]]
-        stages = [s[0] for s in db.query(Company.stage).distinct().order_by(Company.stage) if s[0]]
-        industries = [i[0] for i in db.query(Company.industry).distinct().order_by(Company.industry) if i[0]]
-    finally:
-        db.close()
+    if sort == 'trending' and not q:
+        # Порядок по трендовой оценке из памяти воркера, без кеша страниц
+        result = QueryCache.get_trending_companies(
+            country=country, stage=stage, industry=industry, limit=per_page, offset=offset, match=match
+        )
+    else:
+        result = QueryCache.get_companies_with_filters(
+            q=q, country=country, stage=stage, industry=industry, limit=per_page, offset=offset, match=match
+        )
+    companies = result['companies']
+    total = result['total']
+    
+    # Получаем фильтры
+    filters = QueryCache.get_company_filters()
+    countries = filters['countries']
+    stages = filters['stages']
+    industries = filters['industries']
+    facet_counts = filters['counts']
     
     # Простая пагинация
     total_pages = (total + per_page - 1) // per_page
@@ -495,6 +487,10 @@ def companies(
                 params.append(f"stage={stage}")
             if industry:
                 params.append(f"industry={industry}")
+            if match:
+                params.append(f"match={match}")
+            if sort:
+                params.append(f"sort={sort}")
             params.append(f"per_page={per_page}")
             params.append(f"page={page_num}")
             return f"{url}?{'&'.join(params)}"
@@ -533,6 +529,8 @@ def companies(
         "countries": countries, 
         "stages": stages, 
         "industries": industries,
+        "facet_counts": facet_counts,
+        "comment_counts": comment_counter.counts('company', [c.id for c in companies]),
         "pagination": pagination,
         "show_per_page_selector": True
     })
@@ -541,7 +539,7 @@ def companies(
 def company_profile(request: Request, id: int = Path(...)):
     db = SessionLocal()
     company = db.query(Company).options(
-        joinedload(Company.deals),
+        joinedload(Company.deals).selectinload(Deal.participants),
         joinedload(Company.pitches),
         joinedload(Company.team),
         joinedload(Company.jobs)
@@ -549,6 +547,7 @@ def company_profile(request: Request, id: int = Path(...)):
     if not company:
         db.close()
         raise HTTPException(status_code=404)
+    view_counter.record('company', company.id)
     team = list(company.team)
     # Сортируем сделки по ID в убывающем порядке (новые сначала)
     deals = sorted(company.deals, key=lambda x: x.id, reverse=True)
@@ -557,81 +556,52 @@ def company_profile(request: Request, id: int = Path(...)):
     investors = db.query(Investor).all()
     investor_dict = {inv.name: inv for inv in investors}
 
-    # --- Логика подбора похожих компаний ---
-    similar_query = db.query(Company).filter(Company.id != company.id)
-    filters = []
-    if company.country:
-        filters.append(Company.country == company.country)
-    if company.stage:
-        filters.append(Company.stage == company.stage)
-    if company.industry:
-        filters.append(Company.industry == company.industry)
-    if filters:
-        similar_query = similar_query.filter(or_(*filters))
-    similar = similar_query.limit(6).all()
+    # Похожие компании - предрассчитанный список, ранжированный по близости признаков
+    similar = similarity_engine.similar(db, company.id)
+
+    # Инвесторы, активные в стране и стадии компании (кроме уже участвовавших в ее сделках)
+    participants = {investor.id for deal in deals for investor in deal.participants}
+    active_investors = coinvest_graph.active_investors(db, company.country, company.stage, exclude=participants)
 
     db.close()
     return templates.TemplateResponse(
         "public/companies/detail.html",
-        {"request": request, "company": company, "team": team, "deals": deals, "jobs": jobs, "pitches": pitches, "investor_dict": investor_dict, "session": request.session, "similar": similar}
+        {"request": request, "company": company, "team": team, "deals": deals, "jobs": jobs, "pitches": pitches, "investor_dict": investor_dict, "session": request.session, "similar": similar, "active_investors": active_investors, "views": view_counter.views('company', company.id)}
     )
 
 @app.get("/investors", response_class=HTMLResponse)
-def investors(request: Request, q: str = Query('', alias='q'), country: str = Query('', alias='country'), focus: str = Query('', alias='focus'), stages: str = Query('', alias='stages')):
-    db = SessionLocal()
+def investors(request: Request, q: str = Query('', alias='q'), country: str = Query('', alias='country'), focus: str = Query('', alias='focus'), stages: str = Query('', alias='stages'), match: str = Query('', alias='match')):
     try:
-        query = db.query(Investor).filter(Investor.status == 'active')
-        if q:
-            query = query.filter(Investor.name.ilike(f'%{q}%'))
-        if country:
-            query = query.filter_by(country=country)
-        if focus:
-            query = query.filter(Investor.focus.ilike(f'%{focus}%'))
-        if stages:
-            query = query.filter(Investor.stages.ilike(f'%{stages}%'))
-        investors = query.order_by(Investor.name).all()
-        countries = [c[0] for c in db.query(Investor.country).distinct().order_by(Investor.country) if c[0]]
-        # Собираем уникальные значения focus и stages (разбиваем по запятым)
-        all_focus = set()
-        all_stages = set()
-        for f in db.query(Investor.focus).distinct():
-            if f[0]:
-                for part in f[0].split(','):
-                    val = part.strip()
-                    if val:
-                        all_focus.add(val)
-        for s in db.query(Investor.stages).distinct():
-            if s[0]:
-                for part in s[0].split(','):
-                    val = part.strip()
-                    if val:
-                        all_stages.add(val)
-        focus_list = sorted(all_focus)
-        stages_list = sorted(all_stages)
+        investors = QueryCache.get_investors_with_filters(
+            q=q, country=country, focus=focus, stages=stages, limit=None, match=match
+        )['investors']
+        filters = QueryCache.get_investor_filters()
+        countries = filters['countries']
+        focus_list = filters['focus_list']
+        stages_list = filters['stages_list']
+        facet_counts = filters['counts']
     except Exception as e:
         print(f"Ошибка при загрузке инвесторов: {e}")
         investors = []
         countries = []
         focus_list = []
         stages_list = []
-    finally:
-        db.close()
-    response = templates.TemplateResponse("public/investors/list.html", {"request": request, "session": request.session, "investors": investors, "countries": countries, "focus_list": focus_list, "stages_list": stages_list})
+        facet_counts = {}
+    response = templates.TemplateResponse("public/investors/list.html", {"request": request, "session": request.session, "investors": investors, "countries": countries, "focus_list": focus_list, "stages_list": stages_list, "facet_counts": facet_counts})
     return response
 
 @app.get("/investor/{id}", response_class=HTMLResponse)
 def investor_profile(request: Request, id: int = Path(...)):
-    from models import Deal
     db = SessionLocal()
     investor = db.query(Investor).get(id)
     
     # Получаем компании из сделок, где участвовал этот инвестор
     portfolio_companies = []
     if investor:
-        # Ищем сделки, где имя инвестора упоминается в поле investors
-        deals = db.query(Deal).options(joinedload(Deal.company)).all()
+        # Сделки инвестора по таблице связей deal_investor
+        deals = deal_investor_index.deals_query(db, investor.id).all()
         for deal in deals:
-            if deal.investors and investor.name in deal.investors and deal.company:
+            if deal.company:
                 # Добавляем компанию с информацией о сделке
                 company_data = {
                     'company': deal.company,
@@ -647,16 +617,26 @@ def investor_profile(request: Request, id: int = Path(...)):
         # Сортируем по дате сделки (новые сначала)
         portfolio_companies = sorted(portfolio_companies, key=lambda x: x['deal_date'] if x['deal_date'] else datetime.min, reverse=True)
     
+    # Соинвесторы из графа в памяти
+    co_investors = coinvest_graph.co_investors(db, investor.id) if investor else []
     team = list(investor.team) if investor else []
     db.close()
-    return templates.TemplateResponse("public/investors/detail.html", {"request": request, "session": request.session, "investor": investor, "portfolio_companies": portfolio_companies, "team": team})
+    views = 0
+    if investor:
+        view_counter.record('investor', investor.id)
+        views = view_counter.views('investor', investor.id)
+    return templates.TemplateResponse("public/investors/detail.html", {"request": request, "session": request.session, "investor": investor, "portfolio_companies": portfolio_companies, "team": team, "co_investors": co_investors, "views": views})
 
 @app.get("/news", response_class=HTMLResponse)
-def news_list(request: Request):
+def news_list(request: Request, sort: str = Query('', alias='sort')):
     db = SessionLocal()
     news = db.query(News).options(joinedload(News.author)).order_by(News.date.desc()).all()
     db.close()
-    return templates.TemplateResponse("public/news/list.html", {"request": request, "session": request.session, "news": news})
+    if sort == 'trending':
+        # По затухающей оценке просмотров и комментариев; без событий - по дате, как раньше
+        news = trending_engine.order('news', news)
+    comment_counts = comment_counter.counts('news', [n.id for n in news])
+    return templates.TemplateResponse("public/news/list.html", {"request": request, "session": request.session, "news": news, "sort": sort, "comment_counts": comment_counts})
 
 @app.get("/news/{slug}", response_class=HTMLResponse)
 def news_detail(request: Request, slug: str = Path(...)):
@@ -674,9 +654,9 @@ def news_detail(request: Request, slug: str = Path(...)):
         db.close()
         raise HTTPException(status_code=404, detail="Новость не найдена")
     
-    # Увеличиваем счетчик просмотров
-    news.views = (news.views or 0) + 1
-    db.commit()
+    # Просмотр засчитывается в памяти воркера и пишется в базу пачкой, без транзакции на чтение
+    view_counter.record('news', news.id)
+    views = (news.views or 0) + view_counter.pending('news', news.id)
     
     # Другие новости (исключая текущую)
     other_news = db.query(News).filter(News.id != news.id).order_by(News.date.desc()).limit(5).all()
@@ -692,41 +672,20 @@ def news_detail(request: Request, slug: str = Path(...)):
         "request": request, 
         "session": request.session, 
         "news": news,
+        "views": views,
         "other_news": other_news,
         "upcoming_events": upcoming_events
     })
 
 @app.get("/events", response_class=HTMLResponse)
 def events_list(request: Request, q: str = Query('', alias='q'), date: str = Query('', alias='date'), format_: str = Query('', alias='format'), country: str = Query('', alias='country')):
-    db = SessionLocal()
-    query = db.query(Event)
+    # Мероприятия с фильтрами по поиску, дате, формату и стране
+    events = QueryCache.get_events_with_filters(q=q, date=date, format_=format_, country=country)
     
-    # Фильтр по поиску
-    if q:
-        query = query.filter(Event.title.ilike(f'%{q}%'))
-    
-    # Фильтр по дате
-    if date:
-        try:
-            filter_date = datetime.strptime(date, '%Y-%m-%d').date()
-            query = query.filter(Event.date >= filter_date, Event.date < filter_date + timedelta(days=1))
-        except ValueError:
-            pass
-    
-    # Фильтр по формату
-    if format_:
-        query = query.filter(Event.format == format_)
-    
-    # Фильтр по стране
-    if country:
-        query = query.filter(Event.country == country)
-    
-    events = query.order_by(Event.date.asc()).all()
-    
-    # Получаем уникальные значения для фильтров
-    formats = [f[0] for f in db.query(Event.format).distinct().order_by(Event.format) if f[0]]
-    # Получаем страны из справочника
-    countries = [c.name for c in db.query(Country).filter(Country.status == 'active').order_by(Country.name).all()]
+    # Получаем уникальные значения для фильтров (страны - из справочника)
+    filters = QueryCache.get_event_filters()
+    formats = filters['formats']
+    countries = filters['countries']
     
     # Маппинг форматов на русские названия
     format_mapping = {
@@ -761,7 +720,6 @@ def events_list(request: Request, q: str = Query('', alias='q'), date: str = Que
             'is_today': date_obj == today
         })
     
-    db.close()
     return templates.TemplateResponse("public/events/list.html", {
         "request": request, 
         "session": request.session, 
@@ -792,32 +750,29 @@ def event_detail(request: Request, id: int = Path(...)):
     ).order_by(News.date.desc()).limit(3).all()
     
     db.close()
+    views = 0
+    if event:
+        view_counter.record('event', event.id)
+        views = view_counter.views('event', event.id)
     return templates.TemplateResponse("public/events/detail.html", {
         "request": request, 
         "session": request.session, 
         "event": event,
+        "views": views,
         "other_events": other_events,
         "upcoming_news": upcoming_news
     })
 
 @app.get("/jobs", response_class=HTMLResponse)
 def jobs_list(request: Request, q: str = Query('', alias='q'), city: str = Query('', alias='city'), job_type: str = Query('', alias='job_type'), company: str = Query('', alias='company')):
-    db = SessionLocal()
-    query = db.query(Job)
-    if q:
-        query = query.filter(Job.title.ilike(f'%{q}%'))
-    if city:
-        query = query.filter_by(city=city)
-    if job_type:
-        query = query.filter_by(job_type=job_type)
-    if company:
-        query = query.filter_by(company_id=company)
-    jobs = query.order_by(Job.id.desc()).all()
-    cities = [c[0] for c in db.query(Job.city).distinct().order_by(Job.city) if c[0]]
-    job_types = [t[0] for t in db.query(Job.job_type).distinct().order_by(Job.job_type) if t[0]]
-    companies = db.query(Company).order_by(Company.name).all()
-    db.close()
-    return templates.TemplateResponse("public/jobs/list.html", {"request": request, "session": request.session, "jobs": jobs, "cities": cities, "job_types": job_types, "companies": companies})
+    jobs = QueryCache.get_jobs_with_filters(q=q, city=city, job_type=job_type, company=company)
+    filters = QueryCache.get_job_filters()
+    cities = filters['cities']
+    job_types = filters['job_types']
+    companies = filters['companies']
+    facet_counts = filters['counts']
+    comment_counts = comment_counter.counts('job', [j.id for j in jobs])
+    return templates.TemplateResponse("public/jobs/list.html", {"request": request, "session": request.session, "jobs": jobs, "cities": cities, "job_types": job_types, "companies": companies, "facet_counts": facet_counts, "comment_counts": comment_counts})
 
 @app.get("/job/{id}", response_class=HTMLResponse)
 def job_detail(request: Request, id: int = Path(...)):
@@ -825,7 +780,11 @@ def job_detail(request: Request, id: int = Path(...)):
     job = db.query(Job).get(id)
     company = job.company if job else None
     db.close()
-    return templates.TemplateResponse("public/jobs/detail.html", {"request": request, "session": request.session, "job": job, "company": company})
+    views = 0
+    if job:
+        view_counter.record('job', job.id)
+        views = view_counter.views('job', job.id)
+    return templates.TemplateResponse("public/jobs/detail.html", {"request": request, "session": request.session, "job": job, "company": company, "views": views})
 
 @app.get("/podcasts", response_class=HTMLResponse)
 def podcasts_list(request: Request):
@@ -900,10 +859,16 @@ async def dashboard_user(request: Request):
         # Загружаем страны всегда (нужны для редактирования профиля пользователя)
         countries = db.query(Country).filter(Country.status == 'active').all()
         
+        matching_investors = []
         if company:  # Загружаем остальные данные только если у пользователя есть компания
             from models import CompanyStage, Category
             stages = db.query(CompanyStage).filter(CompanyStage.status == 'active').all()
             categories = db.query(Category).filter(Category.status == 'active').all()
+            # Подходящие инвесторы из модели подбора в памяти
+            try:
+                matching_investors = matching_engine.investors_for_company(company.id, limit=10)
+            except Exception as e:
+                print(f"Ошибка подбора инвесторов: {e}")
         
         return templates.TemplateResponse("dashboard/user.html", {
             "request": request,
@@ -915,7 +880,8 @@ async def dashboard_user(request: Request):
             "active_tab": active_tab,
             "countries": countries,
             "stages": stages,
-            "categories": categories
+            "categories": categories,
+            "matching_investors": matching_investors
         })
     finally:
         db.close()
@@ -1984,31 +1950,29 @@ async def delete_portfolio(request: Request, company_id: int):
 
 @app.get("/analytics", response_class=HTMLResponse)
 async def analytics(request: Request, year: int = Query(None)):
-    from models import Deal, Company
     import datetime
-    # Получаем все года, в которых были сделки
+    # Года и суммы по странам - из агрегатов deal_rollup, без выборки всех сделок
     db = SessionLocal()
-    years = sorted({d.date.year for d in db.query(Deal) if d.date}, reverse=True)
-    db.close()
-    if not years:
-        years = [datetime.date.today().year]
-    if year is None:
-        year = years[0]
-    # Считаем по странам
-    stats = {}
-    db = SessionLocal()
-    from sqlalchemy.orm import joinedload
-    deals = db.query(Deal).options(joinedload(Deal.company)).filter(Deal.date != None).all()
-    db.close()
-    for d in deals:
-        if d.date.year == year:
-            country = d.company.country if d.company else 'Неизвестно'
-            if country not in stats:
-                stats[country] = {'sum': 0, 'count': 0}
-            stats[country]['sum'] += d.amount or 0
-            stats[country]['count'] += 1
-    stats = sorted(stats.items(), key=lambda x: -x[1]['sum'])
-    return templates.TemplateResponse("public/analytics.html", {"request": request, "session": request.session, "stats": stats, "years": years, "year": year})
+    try:
+        years = analytics_service.years(db)
+        if not years:
+            years = [datetime.date.today().year]
+        if year is None:
+            year = years[0]
+        stats = [
+            (row['key'] or 'Неизвестно', {'sum': row['sum'], 'count': row['count']})
+            for row in analytics_service.summary('country', {'year': year}, db)
+        ]
+    finally:
+        db.close()
+    # Медианы, рост оценки и концентрация - из колоночного снимка раундов
+    distribution = funding_analytics.distribution('amount', ('country',), {'year': year})
+    concentration = funding_analytics.concentration(('country',), {'year': year})
+    step_ups = funding_analytics.step_ups(('deal_type',), {'year': year})
+    return templates.TemplateResponse("public/analytics.html", {
+        "request": request, "session": request.session, "stats": stats, "years": years, "year": year,
+        "distribution": distribution, "concentration": concentration, "step_ups": step_ups
+    })
 
 def admin_required(request: Request):
     if not request.session.get('user_id') or request.session.get('role') not in ['admin', 'moderator']:
@@ -2018,7 +1982,6 @@ def admin_required(request: Request):
 @app.get("/admin", response_class=HTMLResponse, name="admin_dashboard")
 async def admin_dashboard(request: Request):
     """Главная страница админки с статистикой."""
-    from models import User, Investor, News, Event, Job, Deal, Company
     from sqlalchemy.exc import SQLAlchemyError
     
     if not admin_required(request):
@@ -2026,13 +1989,8 @@ async def admin_dashboard(request: Request):
     
     db = SessionLocal()
     try:
-        users = db.query(User).all()
-        companies = db.query(Company).all()
-        investors = db.query(Investor).all()
-        news = db.query(News).all()
-        events = db.query(Event).all()
-        jobs = db.query(Job).all()
-        deals = db.query(Deal).all()
+        # Итоги, статусы и приросты за неделю - агрегатными запросами с кешем по тегам таблиц
+        counters = admin_counters.all(db)
         db.close()
         
         return templates.TemplateResponse(
@@ -2040,13 +1998,7 @@ async def admin_dashboard(request: Request):
             {
                 "request": request, 
                 "session": request.session, 
-                "users": users, 
-                "companies": companies, 
-                "investors": investors, 
-                "news": news, 
-                "events": events, 
-                "jobs": jobs, 
-                "deals": deals
+                "counters": counters
             }
         )
     except SQLAlchemyError as e:
@@ -2076,7 +2028,7 @@ async def admin_users(request: Request, q: str = Query('', alias='q'), per_page:
         query = query.filter(User.email.ilike(f'%{q}%'))
     if status_:
         query = query.filter(User.status == status_)
-    total = query.count()
+    total = count_service.count(query, User, filters={'q': q, 'status': status_}, estimate_unfiltered=True)
     users = query.order_by(User.id).offset((page-1)*per_page).limit(per_page).all()
     countries = {c.id: c.name for c in db.query(Country).all()}
     db.close()
@@ -2360,7 +2312,7 @@ async def admin_countries(request: Request, q: str = Query('', alias='q'), statu
         query = query.filter(Country.name.ilike(f'%{q}%'))
     if status:
         query = query.filter(Country.status == status)
-    total = query.count()
+    total = count_service.count(query, Country, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     countries = query.order_by(Country.id).offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/countries/list.html", {"request": request, "countries": countries, "q": q, "status": status, "per_page": per_page, "page": page, "total": total})
@@ -2472,7 +2424,7 @@ async def admin_cities(request: Request, q: str = Query('', alias='q'), status:
         query = query.filter(City.name.ilike(f'%{q}%'))
     if status:
         query = query.filter(City.status == status)
-    total = query.count()
+    total = count_service.count(query, City, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     cities = query.order_by(City.id).offset((page-1)*per_page).limit(per_page).all()
     countries = db.query(Country).order_by(Country.name).all()
     import starlette.background
@@ -2551,7 +2503,7 @@ async def admin_categories(request: Request, q: str = Query('', alias='q'), stat
         query = query.filter(Category.name.ilike(f'%{q}%'))
     if status:
         query = query.filter(Category.status == status)
-    total = query.count()
+    total = count_service.count(query, Category, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     categories = query.order_by(Category.id).offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/categories/list.html", {"request": request, "categories": categories, "q": q, "status": status, "per_page": per_page, "page": page, "total": total})
@@ -2626,7 +2578,7 @@ async def admin_authors(request: Request, q: str = Query('', alias='q'), status:
         query = query.filter(Author.name.ilike(f'%{q}%'))
     if status:
         query = query.filter(Author.status == status)
-    total = query.count()
+    total = count_service.count(query, Author, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     authors = query.order_by(Author.id).offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/authors/list.html", {"request": request, "authors": authors, "q": q, "status": status, "per_page": per_page, "page": page, "total": total})
@@ -2724,7 +2676,7 @@ def admin_jobs(request: Request, q: str = Query('', alias='q'), per_page: int =
     else:  # newest (по умолчанию)
         query = query.order_by(Job.id.desc())
     
-    total = query.count()
+    total = count_service.count(query, Job, filters={'q': q}, estimate_unfiltered=True)
     jobs = query.offset((page-1)*per_page).limit(per_page).all()
     companies_list = db.query(Company).all()
     companies = {s.id: s for s in companies_list}
@@ -2846,7 +2798,7 @@ def admin_events(request: Request, q: str = Query('', alias='q'), status: str =
     else:  # newest (по умолчанию)
         query = query.order_by(Event.id.desc())
     
-    total = query.count()
+    total = count_service.count(query, Event, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     events = query.offset((page-1)*per_page).limit(per_page).all()
     response = templates.TemplateResponse("admin/events/list.html", {"request": request, "session": request.session, "events": events, "q": q, "status": status, "per_page": per_page, "page": page, "total": total, "sort": sort})
     db.close()
@@ -3051,7 +3003,7 @@ def admin_news(request: Request, q: str = Query('', alias='q'), per_page: int =
     else:  # newest (по умолчанию)
         query = query.order_by(News.id.desc())
     
-    total = query.count()
+    total = count_service.count(query, News, filters={'q': q}, estimate_unfiltered=True)
     news = query.offset((page-1)*per_page).limit(per_page).all()
     response = templates.TemplateResponse("admin/news/list.html", {"request": request, "session": request.session, "news": news, "q": q, "per_page": per_page, "page": page, "total": total, "sort": sort})
     db.close()
@@ -3328,7 +3280,7 @@ async def admin_investors(request: Request, q: str = Query('', alias='q'), per_p
     else:  # newest (по умолчанию)
         query = query.order_by(Investor.id.desc())
     
-    total = query.count()
+    total = count_service.count(query, Investor, filters={'q': q}, estimate_unfiltered=True)
     investors = query.offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/investors/list.html", {"request": request, "session": request.session, "investors": investors, "q": q, "per_page": per_page, "page": page, "total": total, "sort": sort})
@@ -3411,13 +3363,8 @@ async def admin_edit_investor(request: Request, investor_id: int):
     # Получаем сделки этого инвестора
     portfolio_deals = []
     if investor:
-        # Ищем сделки, где имя инвестора упоминается в поле investors
-        deals = db.query(Deal).options(joinedload(Deal.company)).all()
-        for deal in deals:
-            if deal.investors and investor.name in deal.investors:
-                portfolio_deals.append(deal)
-        # Сортируем по ID в убывающем порядке (новые сначала)
-        portfolio_deals = sorted(portfolio_deals, key=lambda x: x.id, reverse=True)
+        # Сделки инвестора по таблице связей deal_investor, новые сначала
+        portfolio_deals = deal_investor_index.deals_query(db, investor.id).order_by(Deal.id.desc()).all()
     
     # Получаем список стран для формы
     countries = db.query(Country).filter(Country.status == 'active').order_by(Country.name).all()
@@ -3600,10 +3547,12 @@ async def admin_startup_search(request: Request, q: str = Query('', alias='q')):
         return RedirectResponse(url="/login", status_code=302)
 
     db = SessionLocal()
-    query = db.query(Company)
     if q:
-        query = query.filter(Company.name.ilike(f"%{q}%"))
-    companies = query.order_by(Company.name).limit(20).all()
+        # Триграммный индекс названий: находит и в другой письменности, и с опечатками
+        hits = search_service.fuzzy_search('company', q, limit=20, active_only=False, prefix=True)
+        companies = search_service.load_objects(db, 'company', [hit.entity_id for hit in hits])
+    else:
+        companies = db.query(Company).order_by(Company.name).limit(20).all()
     results = []
     for s in companies:
         country_code = (s.country or '').strip().upper()[:2]
@@ -3793,6 +3742,54 @@ def root():
 # Гарантируем создание таблиц при любом запуске
 Base.metadata.create_all(bind=engine)
 
+# Таблица поискового индекса (FTS5 / tsvector) и первичное заполнение на существующей базе
+search_service.ensure_schema()
+search_service.rebuild_if_empty()
+
+# Фасеты фильтров списков с количествами
+facet_index.ensure_schema()
+facet_index.rebuild_if_empty()
+
+# Таблицы тегов и первичное заполнение из строковых полей
+tag_service.ensure_schema()
+tag_service.backfill_if_empty()
+
+# Связи сделок с инвесторами и первичное заполнение из поля Deal.investors
+deal_investor_index.ensure_schema()
+deal_investor_index.backfill_if_empty()
+
+# Граф соинвестиций (раунды и ребра) по сделкам и портфелям
+coinvest_graph.ensure_schema()
+coinvest_graph.rebuild_if_empty()
+
+# Похожие компании (top-k соседей по признакам)
+similarity_engine.ensure_schema()
+similarity_engine.rebuild_if_empty()
+
+# Агрегаты сделок для аналитики
+analytics_service.ensure_schema()
+analytics_service.rebuild_if_empty()
+
+# Счетчики просмотров страниц (отложенная запись)
+view_counter.ensure_schema()
+
+# Части sitemap и первичная отметка всех частей на существующей базе
+sitemap_service.ensure_schema()
+sitemap_service.mark_all_if_empty()
+
+# Счетчики комментариев сущностей и первичное заполнение на существующей базе
+comment_counter.ensure_schema()
+comment_counter.reconcile_if_empty()
+
+# Таблица событий уведомлений для доставки между воркерами
+realtime_notifications.ensure_schema()
+
+# Таблица архива уведомлений и колонка дайджеста group_count на существующей базе (индекс - в /run-migration)
+notification_archiver.ensure_schema()
+
+# Счетчики строк для приблизительных итогов пагинации (SQLite)
+count_service.install_hooks()
+
 # --- Автоматическое создание тестовых данных для всех сущностей ---
 def create_full_test_data():
     from db import SessionLocal
@@ -3953,6 +3950,14 @@ def run_migration():
             'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP',
             'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS created_by VARCHAR(64)',
             'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS updated_by VARCHAR(64)',
+            
+            # Индексы для keyset пагинации API
+            "CREATE INDEX IF NOT EXISTS ix_company_status_name_id ON company (status, name, id)",
+            "CREATE INDEX IF NOT EXISTS ix_investor_status_name_id ON investor (status, name, id)",
+            "CREATE INDEX IF NOT EXISTS ix_job_status_id ON job (status, id)",
+            "CREATE INDEX IF NOT EXISTS ix_notification_user_created_id ON notification (user_id, created_at, id)",
+            "CREATE INDEX IF NOT EXISTS ix_notification_read_created ON notification (is_read, created_at)",
+            "ALTER TABLE notification ADD COLUMN IF NOT EXISTS group_count INTEGER NOT NULL DEFAULT 1",
         ]
         
         executed_migrations = []
@@ -4031,7 +4036,7 @@ async def admin_company_stages(request: Request, q: str = Query('', alias='q'),
         query = query.filter(CompanyStage.name.ilike(f'%{q}%'))
     if status:
         query = query.filter(CompanyStage.status == status)
-    total = query.count()
+    total = count_service.count(query, CompanyStage, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     stages = query.order_by(CompanyStage.id).offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/company_stages/list.html", {"request": request, "stages": stages, "q": q, "status": status, "per_page": per_page, "page": page, "total": total})
@@ -4115,7 +4120,7 @@ async def admin_companies(request: Request, q: str = Query('', alias='q'), statu
     else:  # newest (по умолчанию)
         query = query.order_by(Company.id.desc())
     
-    total = query.count()
+    total = count_service.count(query, Company, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     companies = query.offset((page-1)*per_page).limit(per_page).all()
     db.close()
     return templates.TemplateResponse("admin/companies/list.html", {"request": request, "companies": companies, "q": q, "status": status, "per_page": per_page, "page": page, "total": total, "sort": sort})
@@ -4642,6 +4647,18 @@ async def notifications_page(request: Request):
         "session": request.session
     })
 
+@app.get("/notifications/stream")
+async def notifications_stream(request: Request):
+    """Поток уведомлений и счетчика непрочитанных (Server-Sent Events)"""
+    if not request.session.get("user_id"):
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+    
+    return StreamingResponse(
+        realtime_notifications.stream(request.session.get("user_id"), request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/notifications/{notification_id}/read")
 async def mark_notification_read_web(request: Request, notification_id: int):
     """Отметить уведомление как прочитанное (веб)"""
@@ -4715,26 +4732,19 @@ async def get_comments_web(request: Request, entity_type: str, entity_id: int):
     if not CommentValidator.is_valid_entity_type(entity_type):
         return JSONResponse({"success": False, "error": "Неверный тип сущности"})
     
-    comments = CommentService.get_comments(entity_type, entity_id, limit=50)
+    threads, _ = CommentService.get_threads(entity_type, entity_id, limit=50)
     
-    result = []
-    for comment in comments:
-        replies = CommentService.get_replies(comment.id)
-        result.append({
+    def thread_json(node):
+        comment = node.comment
+        return {
             "id": comment.id,
             "content": comment.content,
             "user_name": f"{comment.user.first_name} {comment.user.last_name}",
             "created_at": comment.created_at.strftime("%d.%m.%Y %H:%M"),
-            "replies": [
-                {
-                    "id": reply.id,
-                    "content": reply.content,
-                    "user_name": f"{reply.user.first_name} {reply.user.last_name}",
-                    "created_at": reply.created_at.strftime("%d.%m.%Y %H:%M")
-                }
-                for reply in replies
-            ]
-        })
+            "replies": [thread_json(reply) for reply in node.replies]
+        }
+    
+    result = [thread_json(node) for node in threads]
     
     return JSONResponse({
         "success": True,
@@ -4770,7 +4780,7 @@ async def admin_deals(request: Request, q: str = Query('', alias='q'), status: s
         query = query.filter(Deal.status == status)
     
     # Общее количество
-    total = query.count()
+    total = count_service.count(query, Deal, Company, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     
     # Пагинация
     deals = query.order_by(Deal.id.desc()).offset((page - 1) * per_page).limit(per_page).all()
@@ -4820,7 +4830,7 @@ async def admin_feedback(request: Request, q: str = Query('', alias='q'), status
     query = query.order_by(Feedback.id.desc())
     
     # Общее количество
-    total = query.count()
+    total = count_service.count(query, Feedback, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     
     # Пагинация
     feedback_list = query.offset((page - 1) * per_page).limit(per_page).all()
@@ -5069,7 +5079,7 @@ async def admin_email_templates(request: Request, q: str = Query('', alias='q'),
         query = query.order_by(EmailTemplate.updated_at.desc())
     
     # Общее количество
-    total = query.count()
+    total = count_service.count(query, EmailTemplate, filters={'q': q, 'status': status}, estimate_unfiltered=True)
     
     # Пагинация
     offset = (page - 1) * per_page
@@ -1,5 +1,5 @@
 from db import Base
-from sqlalchemy import Column, Integer, String, Text, Date, DateTime, Float, ForeignKey, Table, Boolean
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, Float, ForeignKey, Table, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship, backref
 from datetime import datetime
 
@@ -18,8 +18,38 @@ investor_person = Table('investor_person', Base.metadata,
     Column('person_id', Integer, ForeignKey('person.id'))
 )
 
+# Теги (нормализованные значения Investor.focus, Investor.stages, Company.industry)
+investor_tag = Table('investor_tag', Base.metadata,
+    Column('investor_id', Integer, ForeignKey('investor.id', ondelete='CASCADE'), primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_investor_tag_tag_investor', 'tag_id', 'investor_id')
+)
+
+company_tag = Table('company_tag', Base.metadata,
+    Column('company_id', Integer, ForeignKey('company.id', ondelete='CASCADE'), primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_company_tag_tag_company', 'tag_id', 'company_id')
+)
+
+# Участие инвесторов в сделках (разобранное поле Deal.investors, синхронизируется services/deals.py)
+deal_investor = Table('deal_investor', Base.metadata,
+    Column('deal_id', Integer, ForeignKey('deal.id', ondelete='CASCADE'), primary_key=True),
+    Column('investor_id', Integer, ForeignKey('investor.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_deal_investor_investor_deal', 'investor_id', 'deal_id')
+)
+
+class Tag(Base):
+    __tablename__ = 'tag'
+    __table_args__ = (UniqueConstraint('kind', 'slug', name='uq_tag_kind_slug'),)
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)   # focus, stage, industry
+    name = Column(String(64), nullable=False)   # как написано при первом использовании
+    slug = Column(String(64), nullable=False)   # нижний регистр, одиночные пробелы
+
 class Company(Base):
     __tablename__ = 'company'
+    # Keyset пагинация API: WHERE (sort_key, id) > курсор ORDER BY sort_key, id
+    __table_args__ = (Index('ix_company_status_name_id', 'status', 'name', 'id'),)
     id = Column(Integer, primary_key=True)
     name = Column(String(128), nullable=False)
     description = Column(Text)
@@ -35,6 +65,7 @@ class Company(Base):
     deals = relationship('Deal', backref='company', cascade='all, delete-orphan')
     jobs = relationship('Job', backref='company', cascade='all, delete-orphan')
     users = relationship('User', backref='company')  # Убираем cascade='all, delete-orphan'
+    tags = relationship('Tag', secondary=company_tag, viewonly=True)  # теги industry, синхронизируются services/tags.py
     status = Column(String(16), default='active')
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -53,6 +84,8 @@ class PortfolioEntry(Base):
 
 class Investor(Base):
     __tablename__ = 'investor'
+    # Keyset пагинация API: WHERE (sort_key, id) > курсор ORDER BY sort_key, id
+    __table_args__ = (Index('ix_investor_status_name_id', 'status', 'name', 'id'),)
     id = Column(Integer, primary_key=True)
     name = Column(String(128), nullable=False)
     description = Column(Text)
@@ -62,6 +95,8 @@ class Investor(Base):
     portfolio = relationship('Company', secondary=investor_company, backref='investors')
     portfolio_entries = relationship('PortfolioEntry', back_populates='investor', cascade='all, delete-orphan')
     team = relationship('Person', secondary=investor_person, backref='investor_teams')
+    tags = relationship('Tag', secondary=investor_tag, viewonly=True)  # теги focus и stages, синхронизируются services/tags.py
+    deals = relationship('Deal', secondary=deal_investor, viewonly=True)  # сделки с участием инвестора
     website = Column(String(256))
     status = Column(String(16), default='active')
     type = Column(String(16), default='angel')
@@ -77,6 +112,7 @@ class Deal(Base):
     company_id = Column(Integer, ForeignKey('company.id'))
     investors = Column(String(256))
     status = Column(String(16), default='active')
+    participants = relationship('Investor', secondary=deal_investor, viewonly=True)  # инвесторы из поля investors, найденные в базе
 
 class Person(Base):
     __tablename__ = 'person'
@@ -119,6 +155,8 @@ class Podcast(Base):
 
 class Job(Base):
     __tablename__ = 'job'
+    # Keyset пагинация API: WHERE (sort_key, id) > курсор ORDER BY sort_key, id
+    __table_args__ = (Index('ix_job_status_id', 'status', 'id'),)
     id = Column(Integer, primary_key=True)
     title = Column(String(128), nullable=False)
     description = Column(Text)
@@ -233,6 +271,10 @@ class Comment(Base):
 
 class Notification(Base):
     __tablename__ = 'notification'
+    __table_args__ = (
+        Index('ix_notification_user_created_id', 'user_id', 'created_at', 'id'),
+        Index('ix_notification_read_created', 'is_read', 'created_at'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     title = Column(String(256), nullable=False)
@@ -242,6 +284,7 @@ class Notification(Base):
     entity_id = Column(Integer, nullable=True)
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    group_count = Column(Integer, nullable=False, default=1, server_default='1')  # сколько уведомлений свернуто в дайджест
 
     # Отношения
     user = relationship('User', backref='notifications')
@@ -300,4 +343,151 @@ class EmailTemplate(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     created_by = Column(String(64), nullable=True)
-    updated_by = Column(String(64), nullable=True) 
\ No newline at end of file
+    updated_by = Column(String(64), nullable=True)
+
+class SearchName(Base):
+    """Нормализованный ключ названия (латиница, без диакритики) для нечеткого поиска"""
+    __tablename__ = 'search_name'
+    entity_type = Column(String(16), primary_key=True)  # company, investor, news, job
+    entity_id = Column(Integer, primary_key=True)
+    search_key = Column(String(512), nullable=False)
+    trigram_count = Column(Integer, nullable=False)
+    is_active = Column(Boolean, default=True)
+
+class SearchTrigram(Base):
+    """Триграммный индекс ключей поиска: триграмма -> сущности.
+
+    Число триграмм названия и активность продублированы в каждой строке, чтобы запрос
+    сходства читал только первичный ключ (на SQLite таблица без rowid - кластерный индекс).
+    """
+    __tablename__ = 'search_trigram'
+    __table_args__ = {'sqlite_with_rowid': False}
+    entity_type = Column(String(16), primary_key=True)
+    trigram = Column(String(3), primary_key=True)
+    entity_id = Column(Integer, primary_key=True)
+    trigram_count = Column(Integer, nullable=False)
+    is_active = Column(Boolean, default=True)
+
+class TableRowCount(Base):
+    """Поддерживаемое количество строк таблицы (приблизительные итоги пагинации на SQLite)"""
+    __tablename__ = 'table_row_count'
+    table_name = Column(String(64), primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+
+class FacetCount(Base):
+    """Материализованные значения фильтров списков с количеством активных записей"""
+    __tablename__ = 'facet_count'
+    entity_type = Column(String(16), primary_key=True)  # company, investor, job
+    facet = Column(String(32), primary_key=True)        # country, stage, industry, focus, ...
+    value = Column(String(128), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class CoinvestRound(Base):
+    """Раунд для графа соинвестиций: сделки и записи портфеля одной компании за одну дату"""
+    __tablename__ = 'coinvest_round'
+    round_key = Column(String(48), primary_key=True)  # c<company_id>:<дата> или d<deal_id> для сделки без даты
+    company_id = Column(Integer, nullable=True, index=True)
+    amount = Column(Float, nullable=False, default=0)
+
+class CoinvestRoundMember(Base):
+    """Участник раунда (состав на момент последнего пересчета графа)"""
+    __tablename__ = 'coinvest_round_member'
+    __table_args__ = (Index('ix_coinvest_round_member_investor', 'investor_id', 'round_key'),)
+    round_key = Column(String(48), primary_key=True)
+    investor_id = Column(Integer, primary_key=True)
+
+class CoinvestEdge(Base):
+    """Ребро графа соинвестиций: число общих раундов и их суммарный объем (хранится в обе стороны)"""
+    __tablename__ = 'coinvest_edge'
+    investor_id = Column(Integer, primary_key=True)
+    peer_id = Column(Integer, primary_key=True)
+    rounds = Column(Integer, nullable=False, default=0)
+    amount = Column(Float, nullable=False, default=0)
+
+class CompanySimilar(Base):
+    """Предрассчитанный список похожих компаний (top-k по косинусной близости признаков)"""
+    __tablename__ = 'company_similar'
+    __table_args__ = (Index('ix_company_similar_similar', 'similar_id'),)
+    company_id = Column(Integer, primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    similar_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+class DealRollup(Base):
+    """Агрегаты сделок по году, месяцу, стране, стадии, индустрии и типу сделки (пустая строка - не указано)"""
+    __tablename__ = 'deal_rollup'
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    country = Column(String(64), primary_key=True)
+    stage = Column(String(64), primary_key=True)
+    industry = Column(String(64), primary_key=True)  # первая индустрия компании, чтобы сделка попадала в одну строку
+    deal_type = Column(String(32), primary_key=True)
+    deal_count = Column(Integer, nullable=False, default=0)
+    amount_count = Column(Integer, nullable=False, default=0)
+    amount_sum = Column(Float, nullable=False, default=0)
+    amount_min = Column(Float, nullable=True)
+    amount_max = Column(Float, nullable=True)
+    valuation_count = Column(Integer, nullable=False, default=0)
+    valuation_sum = Column(Float, nullable=False, default=0)
+    valuation_min = Column(Float, nullable=True)
+    valuation_max = Column(Float, nullable=True)
+
+class EntityView(Base):
+    """Счетчик просмотров страницы сущности (у новостей - колонка News.views)"""
+    __tablename__ = 'entity_view'
+    entity_type = Column(String(16), primary_key=True)  # company, investor, event, job
+    entity_id = Column(Integer, primary_key=True)
+    views = Column(Integer, nullable=False, default=0)
+
+class ViewFlushBatch(Base):
+    """Примененные пачки просмотров: повторный сброс той же пачки не считается дважды"""
+    __tablename__ = 'view_flush_batch'
+    batch_id = Column(String(32), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class SitemapChunk(Base):
+    """Файл sitemap одного типа сущностей и диапазона id; version растет при записи, generated_version - при генерации"""
+    __tablename__ = 'sitemap_chunk'
+    entity_type = Column(String(16), primary_key=True)  # company, investor, news, job, event
+    chunk = Column(Integer, primary_key=True)            # id // SITEMAP_CHUNK_SIZE
+    version = Column(Integer, nullable=False, default=1)
+    generated_version = Column(Integer, nullable=False, default=0)
+    url_count = Column(Integer, nullable=False, default=0)
+    etag = Column(String(64), nullable=True)
+    lastmod = Column(DateTime, nullable=True)
+
+class CommentCount(Base):
+    """Количество активных комментариев сущности; обновляется вместе с комментарием, сверяется с comment"""
+    __tablename__ = 'comment_count'
+    entity_type = Column(String(32), primary_key=True)  # company, investor, news, job, event
+    entity_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class NotificationEvent(Base):
+    """Событие уведомлений для других воркеров (брокер на базе данных); хранится несколько минут"""
+    __tablename__ = 'notification_event'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=True)     # None - пачка рассылки (user_ids в payload)
+    origin = Column(String(32), nullable=False)  # воркер-отправитель: свои события он доставляет сам
+    payload = Column(Text, nullable=False)       # JSON: event, data, unread_delta, unread_reset
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class NotificationArchive(Base):
+    """Прочитанные старые уведомления без текста сообщения - вынесены из горячей таблицы notification"""
+    __tablename__ = 'notification_archive'
+    __table_args__ = (Index('ix_notification_archive_user_created', 'user_id', 'created_at'),)
+    id = Column(Integer, primary_key=True)  # id исходного уведомления
+    user_id = Column(Integer, nullable=False)
+    title = Column(String(256), nullable=False)
+    type = Column(String(32), nullable=False)
+    entity_type = Column(String(32), nullable=True)
+    entity_id = Column(Integer, nullable=True)
+    group_count = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class BackfillLock(Base):
+    """Блокировка первичного заполнения производной таблицы между воркерами (SQLite)"""
+    __tablename__ = 'backfill_lock'
+    name = Column(String(64), primary_key=True)
+    acquired_at = Column(DateTime, nullable=False)
@@ -0,0 +1,100 @@
+"""
+Счетчики дашборда админки.
+
+Для каждой сущности один агрегатный запрос: количество по статусам и новые записи за текущую и
+прошлую неделю (по created_at, если он есть у модели). Результат кешируется по поколению тега
+таблицы, поэтому запись в таблицу сразу дает новые числа; TTL сверяет окно "за неделю" со временем.
+Бейджи меню админки (новая обратная связь, новые пользователи) берутся из тех же счетчиков.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import and_, case, func
+
+from db import SessionLocal
+from models import User, Company, Investor, Deal, Job, News, Event, Feedback
+from .cache import cache_manager, table_cache_tag
+
+# Сущности дашборда: ключ -> модель
+ADMIN_ENTITIES = {
+    'users': User,
+    'companies': Company,
+    'investors': Investor,
+    'deals': Deal,
+    'jobs': Job,
+    'news': News,
+    'events': Event,
+    'feedback': Feedback,
+}
+
+# Сверка окна "за неделю" и страховка от пропущенной инвалидации
+ADMIN_COUNTERS_TTL = 300
+
+TREND_WINDOW = timedelta(days=7)
+
+class AdminCounters:
+    """Кешированные итоги, разбивка по статусам и недельные приросты"""
+
+    def entity(self, name: str, db=None) -> dict:
+        """{'total', 'by_status', 'new_week', 'new_prev_week', 'delta'}; без created_at приросты - None"""
+        model = ADMIN_ENTITIES[name]
+        tag = table_cache_tag(model.__tablename__)
+        cache_key = f"admin_counters_{name}_g{cache_manager.get_tags_version((tag,))}"
+        return cache_manager.get_or_set(cache_key, lambda: self._compute(model, db), ttl=ADMIN_COUNTERS_TTL)
+
+    def _compute(self, model, db=None) -> dict:
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            created_at = getattr(model, 'created_at', None)
+            columns = [model.status, func.count()]
+            if created_at is not None:
+                now = datetime.utcnow()
+                week_start, previous_start = now - TREND_WINDOW, now - 2 * TREND_WINDOW
+                columns += [
+                    func.sum(case((created_at >= week_start, 1), else_=0)),
+                    func.sum(case((and_(created_at >= previous_start, created_at < week_start), 1), else_=0)),
+                ]
+            by_status, new_week, new_prev_week = {}, 0, 0
+            for row in db.query(*columns).group_by(model.status):
+                by_status[row[0] or ''] = row[1]
+                if created_at is not None:
+                    new_week += row[2] or 0
+                    new_prev_week += row[3] or 0
+            if created_at is None:
+                new_week = new_prev_week = None
+            return {
+                'total': sum(by_status.values()),
+                'by_status': by_status,
+                'new_week': new_week,
+                'new_prev_week': new_prev_week,
+                'delta': None if new_week is None else new_week - new_prev_week,
+            }
+        finally:
+            if own_session:
+                db.close()
+
+    def all(self, db=None) -> Dict[str, dict]:
+        """Счетчики всех сущностей дашборда"""
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            return {name: self.entity(name, db) for name in ADMIN_ENTITIES}
+        finally:
+            if own_session:
+                db.close()
+
+    def badges(self) -> Dict[str, int]:
+        """Числа для меню админки: новая обратная связь и пользователи за неделю"""
+        try:
+            return {
+                'feedback': self.entity('feedback')['by_status'].get('new', 0),
+                'users': self.entity('users')['new_week'] or 0,
+            }
+        except Exception as e:
+            print(f"Ошибка подсчета бейджей админки: {e}")
+            return {}
+
+# Глобальный экземпляр счетчиков админки
+admin_counters = AdminCounters()
@@ -0,0 +1,296 @@
+"""
+Аналитика сделок на агрегатах.
+
+Таблица deal_rollup хранит количество, сумму, минимум и максимум объема и оценки сделок в разрезе
+(год, месяц, страна, стадия, индустрия, тип сделки). Страна, стадия и индустрия берутся из компании;
+индустрия - первая из списка, чтобы каждая сделка попадала ровно в одну строку и суммы сходились.
+
+После flush сделки или компании пересчитываются только затронутые ячейки (старые и новые) - это
+одна выборка сделок за месяц, поэтому минимум и максимум остаются точными и при удалении.
+Страница /analytics и /api/v1/analytics читают только агрегаты.
+"""
+
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, event, func, inspect, or_, select
+from sqlalchemy.orm import object_session
+
+from db import engine, SessionLocal
+from models import Company, Deal, DealRollup
+from .backfill import run_backfill
+from .history import previous_value, track_previous
+from .tags import parse_tags
+
+# Разрезы агрегатов: имя -> колонка deal_rollup
+ROLLUP_DIMENSIONS = {
+    'year': DealRollup.year,
+    'month': DealRollup.month,
+    'country': DealRollup.country,
+    'stage': DealRollup.stage,
+    'industry': DealRollup.industry,
+    'deal_type': DealRollup.deal_type,
+}
+
+# Поля компании, от которых зависит ячейка ее сделок
+COMPANY_FIELDS = ('country', 'stage', 'industry')
+
+_ACTIVE_DEAL = or_(Deal.status == 'active', Deal.status.is_(None))
+
+Cell = Tuple[int, int, str, str, str, str]
+
+def primary_industry(industry: Optional[str]) -> str:
+    """Первая индустрия из списка через запятую"""
+    tags = parse_tags(industry)
+    return tags[0][1] if tags else ''
+
+def rollup_cell(deal_date: Optional[date], deal_type: Optional[str], country: Optional[str],
+                stage: Optional[str], industry: Optional[str]) -> Optional[Cell]:
+    """Ячейка агрегата сделки; сделки без даты в аналитику не попадают"""
+    if not deal_date:
+        return None
+    return (deal_date.year, deal_date.month, (country or '')[:64], (stage or '')[:64],
+            primary_industry(industry)[:64], (deal_type or '')[:32])
+
+class _Accumulator:
+    __slots__ = ('deal_count', 'amount', 'valuation')
+
+    def __init__(self):
+        self.deal_count = 0
+        self.amount = [0, 0.0, None, None]
+        self.valuation = [0, 0.0, None, None]
+
+    @staticmethod
+    def _add(state: list, value: Optional[float]) -> None:
+        if value is None:
+            return
+        state[0] += 1
+        state[1] += value
+        state[2] = value if state[2] is None else min(state[2], value)
+        state[3] = value if state[3] is None else max(state[3], value)
+
+    def add(self, amount: Optional[float], valuation: Optional[float]) -> None:
+        self.deal_count += 1
+        self._add(self.amount, amount)
+        self._add(self.valuation, valuation)
+
+    def row(self, cell: Cell) -> dict:
+        year, month, country, stage, industry, deal_type = cell
+        return {
+            "year": year, "month": month, "country": country, "stage": stage,
+            "industry": industry, "deal_type": deal_type, "deal_count": self.deal_count,
+            "amount_count": self.amount[0], "amount_sum": self.amount[1],
+            "amount_min": self.amount[2], "amount_max": self.amount[3],
+            "valuation_count": self.valuation[0], "valuation_sum": self.valuation[1],
+            "valuation_min": self.valuation[2], "valuation_max": self.valuation[3],
+        }
+
+def _deal_rows():
+    return (
+        select(Deal.date, Deal.type, Company.country, Company.stage, Company.industry, Deal.amount, Deal.valuation)
+        .select_from(Deal)
+        .outerjoin(Company, Company.id == Deal.company_id)
+        .where(_ACTIVE_DEAL, Deal.date.isnot(None))
+    )
+
+class AnalyticsService:
+    """Инкрементальные агрегаты сделок и запросы к ним"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу агрегатов, если ее нет"""
+        DealRollup.__table__.create(self.engine, checkfirst=True)
+
+    # --- Запись ---
+
+    def _write(self, connection, cells: Iterable[Cell], totals: Dict[Cell, _Accumulator]) -> None:
+        cells = list(cells)
+        for cell in cells:
+            year, month, country, stage, industry, deal_type = cell
+            connection.execute(DealRollup.__table__.delete().where(
+                DealRollup.year == year, DealRollup.month == month, DealRollup.country == country,
+                DealRollup.stage == stage, DealRollup.industry == industry, DealRollup.deal_type == deal_type
+            ))
+        rows = [totals[cell].row(cell) for cell in cells if cell in totals]
+        if rows:
+            connection.execute(DealRollup.__table__.insert(), rows)
+
+    def refresh_cells(self, connection, cells: Set[Cell]) -> None:
+        """Пересчитывает ячейки по сделкам их месяцев"""
+        cells = {cell for cell in cells if cell is not None}
+        if not cells:
+            return
+        months = defaultdict(set)
+        for cell in cells:
+            months[(cell[0], cell[1])].add(cell[5])
+        conditions = []
+        for (year, month), deal_types in months.items():
+            start = date(year, month, 1)
+            end = date(year + month // 12, month % 12 + 1, 1)
+            conditions.append(and_(Deal.date >= start, Deal.date < end, func.coalesce(Deal.type, '').in_(sorted(deal_types))))
+        totals = defaultdict(_Accumulator)
+        for deal_date, deal_type, country, stage, industry, amount, valuation in connection.execute(
+            _deal_rows().where(or_(*conditions))
+        ):
+            cell = rollup_cell(deal_date, deal_type, country, stage, industry)
+            if cell in cells:
+                totals[cell].add(amount, valuation)
+        self._write(connection, cells, totals)
+
+    def rebuild(self) -> Dict[str, int]:
+        """Полностью пересчитывает агрегаты"""
+        totals = defaultdict(_Accumulator)
+        with self.engine.begin() as connection:
+            deals = 0
+            for deal_date, deal_type, country, stage, industry, amount, valuation in connection.execute(_deal_rows()):
+                totals[rollup_cell(deal_date, deal_type, country, stage, industry)].add(amount, valuation)
+                deals += 1
+            connection.execute(DealRollup.__table__.delete())
+            rows = [accumulator.row(cell) for cell, accumulator in totals.items()]
+            for start in range(0, len(rows), 1000):
+                connection.execute(DealRollup.__table__.insert(), rows[start:start + 1000])
+        return {'deals': deals, 'cells': len(totals)}
+
+    def rebuild_if_empty(self) -> None:
+        """Заполняет агрегаты при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'deal_rollup',
+            lambda connection: connection.execute(select(DealRollup.year).limit(1)).first() is None,
+            self.rebuild
+        )
+        if counts and counts['deals']:
+            print(f"Агрегаты аналитики построены: {counts}")
+
+    # --- Чтение ---
+
+    def years(self, db=None) -> List[int]:
+        """Годы, за которые есть сделки, от новых к старым"""
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            return [row[0] for row in db.query(DealRollup.year).distinct().order_by(DealRollup.year.desc())]
+        finally:
+            if own_session:
+                db.close()
+
+    def summary(self, group_by: Optional[str] = None, filters: Optional[Dict[str, object]] = None,
+                db=None) -> List[dict]:
+        """Итоги по агрегатам: одна строка без group_by или строка на значение разреза (по убыванию суммы)"""
+        if group_by is not None and group_by not in ROLLUP_DIMENSIONS:
+            raise ValueError(f"Неизвестный разрез аналитики: {group_by}")
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            columns = [
+                func.sum(DealRollup.deal_count), func.sum(DealRollup.amount_count), func.sum(DealRollup.amount_sum),
+                func.min(DealRollup.amount_min), func.max(DealRollup.amount_max),
+                func.sum(DealRollup.valuation_count), func.sum(DealRollup.valuation_sum),
+                func.min(DealRollup.valuation_min), func.max(DealRollup.valuation_max),
+            ]
+            group_column = ROLLUP_DIMENSIONS[group_by] if group_by else None
+            query = db.query(*([group_column] if group_by else []), *columns)
+            for name, value in (filters or {}).items():
+                if value not in (None, ''):
+                    query = query.filter(ROLLUP_DIMENSIONS[name] == value)
+            if group_by:
+                query = query.group_by(group_column)
+            rows = []
+            for row in query.all():
+                key, values = (row[0], row[1:]) if group_by else (None, row)
+                deal_count, amount_count, amount_sum, amount_min, amount_max, \
+                    valuation_count, valuation_sum, valuation_min, valuation_max = values
+                if not deal_count:
+                    continue
+                rows.append({
+                    'key': key,
+                    'count': int(deal_count),
+                    'sum': amount_sum or 0,
+                    'min': amount_min,
+                    'max': amount_max,
+                    'avg': (amount_sum / amount_count) if amount_count else None,
+                    'valuation_avg': (valuation_sum / valuation_count) if valuation_count else None,
+                    'valuation_min': valuation_min,
+                    'valuation_max': valuation_max,
+                })
+            if group_by in ('year', 'month'):
+                rows.sort(key=lambda item: item['key'])
+            else:
+                rows.sort(key=lambda item: (-item['sum'], str(item['key'])))
+            return rows
+        finally:
+            if own_session:
+                db.close()
+
+    def install_hooks(self, session_factory=SessionLocal) -> None:
+        """Подписывает агрегаты на изменения сделок и компаний"""
+        if event.contains(session_factory, 'after_flush', _after_flush):
+            return
+        event.listen(Deal, 'after_insert', _deal_changed)
+        event.listen(Deal, 'after_update', _deal_changed)
+        event.listen(Deal, 'after_delete', _deal_changed)
+        event.listen(Company, 'after_update', _company_updated)
+        # Старые значения нужны, чтобы пересчитать ячейку, из которой сделка ушла
+        for field in ('date', 'type', 'company_id'):
+            track_previous(getattr(Deal, field))
+        for field in COMPANY_FIELDS:
+            track_previous(getattr(Company, field))
+        event.listen(session_factory, 'after_flush', _after_flush)
+
+def _pending(target) -> Optional[dict]:
+    session = object_session(target)
+    if session is None:
+        return None
+    return session.info.setdefault('analytics_changes', {'cells': set(), 'companies': set()})
+
+def _company_dimensions(connection, company_ids: Iterable[int]) -> Dict[int, tuple]:
+    company_ids = [company_id for company_id in set(company_ids) if company_id]
+    if not company_ids:
+        return {}
+    return {
+        row[0]: tuple(row[1:]) for row in connection.execute(
+            select(Company.id, Company.country, Company.stage, Company.industry).where(Company.id.in_(company_ids))
+        )
+    }
+
+def _deal_changed(mapper, connection, target):
+    pending = _pending(target)
+    if pending is None:
+        return
+    state = inspect(target)
+    old = (previous_value(state, 'date'), previous_value(state, 'type'), previous_value(state, 'company_id'))
+    new = (target.date, target.type, target.company_id)
+    # Страна, стадия и индустрия читаются сразу: при удалении компании ее строка исчезнет к концу flush
+    dimensions = _company_dimensions(connection, (old[2], new[2]))
+    for deal_date, deal_type, company_id in (old, new):
+        pending['cells'].add(rollup_cell(deal_date, deal_type, *dimensions.get(company_id, (None, None, None))))
+
+def _company_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[field].history.has_changes() for field in COMPANY_FIELDS):
+        return
+    pending = _pending(target)
+    if pending is not None:
+        old = tuple(previous_value(state, field) for field in COMPANY_FIELDS)
+        new = tuple(getattr(target, field) for field in COMPANY_FIELDS)
+        pending['companies'].add((target.id, old, new))
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop('analytics_changes', None)
+    if not pending:
+        return
+    connection = session.connection()
+    cells = pending['cells']
+    # Изменение страны, стадии или индустрии компании переносит все ее сделки в другие ячейки
+    for company_id, old, new in pending['companies']:
+        for deal_date, deal_type in connection.execute(
+            select(Deal.date, Deal.type).where(Deal.company_id == company_id, Deal.date.isnot(None))
+        ):
+            cells.add(rollup_cell(deal_date, deal_type, *old))
+            cells.add(rollup_cell(deal_date, deal_type, *new))
+    analytics_service.refresh_cells(connection, cells)
+
+# Глобальный экземпляр сервиса аналитики
+analytics_service = AnalyticsService()
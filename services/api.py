@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, Path
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, joinedload
 from typing import List, Optional
 from datetime import datetime
 
@@ -8,8 +9,15 @@ from db import SessionLocal
 from models import User, Company, Investor, News, Job, Comment, Notification, Feedback
 from utils.security import verify_token
 from .notifications import NotificationService, NotificationTemplates
+from .realtime import realtime_notifications
 from .comments import CommentService, CommentValidator
 from .cache import cache_manager, CacheInvalidator
+from .pagination import DatabasePagination, InvalidCursor
+from .tags import tag_service
+from .matching import matching_engine
+from .analytics import analytics_service
+from .funding import funding_analytics, FUNDING_DIMENSIONS
+from .trending import trending_page
 from .telegram import telegram_service
 from .email import email_service
 
@@ -31,23 +39,47 @@ def get_db_session():
     finally:
         db.close()
 
+def paginate_list(query, key: str, sort_column, id_column, limit: int, offset: int, after: Optional[str],
+                  descending: bool = False):
+    """Страница списка API: по курсору after (без подсчета total) или по offset (с total)"""
+    try:
+        items, next_cursor = DatabasePagination.paginate_after(
+            query, key, sort_column, id_column,
+            after=after, per_page=limit, descending=descending, offset=offset
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    meta = {"limit": limit, "next_cursor": next_cursor}
+    if after:
+        meta["after"] = after
+    else:
+        meta["total"] = query.count()
+        meta["offset"] = offset
+    return items, meta
+
 # === API для уведомлений ===
 
 @api_router.get("/notifications")
 async def get_notifications(
     token: str = Query(..., alias="token"),
     limit: int = Query(20, ge=1, le=100),
-    unread_only: bool = Query(False)
+    unread_only: bool = Query(False),
+    after: Optional[str] = Query(None, description="Курсор next_cursor предыдущей страницы")
 ):
-    """Получить уведомления пользователя"""
+    """Получить уведомления пользователя (новые первыми, по курсору after)"""
     user_data = get_current_user(token)
     user_id = user_data.get("user_id")
     
-    notifications = NotificationService.get_user_notifications(
-        user_id=user_id,
-        limit=limit,
-        unread_only=unread_only
-    )
+    try:
+        notifications, next_cursor = NotificationService.get_user_notifications_page(
+            user_id=user_id,
+            limit=limit,
+            unread_only=unread_only,
+            after=after
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
         "success": True,
@@ -60,10 +92,12 @@ async def get_notifications(
                 "is_read": n.is_read,
                 "entity_type": n.entity_type,
                 "entity_id": n.entity_id,
-                "created_at": n.created_at.isoformat()
+                "created_at": n.created_at.isoformat(),
+                "count": n.group_count
             }
             for n in notifications
-        ]
+        ],
+        "next_cursor": next_cursor
     }
 
 @api_router.post("/notifications/{notification_id}/read")
@@ -109,59 +143,101 @@ async def get_unread_count(token: str = Query(..., alias="token")):
         "count": count
     }
 
+@api_router.post("/notifications/broadcast")
+async def broadcast_notification(
+    title: str = Query(..., min_length=1, max_length=256),
+    message: str = Query(..., min_length=1),
+    notification_type: str = Query('info', alias="type", pattern="^(info|success|warning|error)$"),
+    role: Optional[str] = Query(None, description="Всем активным пользователям роли"),
+    user_ids: Optional[str] = Query(None, description="Список id через запятую"),
+    entity_type: Optional[str] = Query(None),
+    entity_id: Optional[int] = Query(None),
+    token: str = Query(..., alias="token")
+):
+    """Рассылка уведомления роли или списку пользователей (только для админов)"""
+    user_data = get_current_user(token)
+    user_role = user_data.get("role")
+    
+    if user_role not in ["admin", "moderator"]:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+    if bool(role) == bool(user_ids):
+        raise HTTPException(status_code=400, detail="Укажите role или user_ids")
+    
+    ids = None
+    if user_ids:
+        try:
+            ids = [int(value) for value in user_ids.split(',') if value.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный список user_ids")
+    
+    count = await run_in_threadpool(
+        NotificationService.fan_out, title, message, notification_type, entity_type, entity_id,
+        user_ids=ids, role=role
+    )
+    
+    return {
+        "success": True,
+        "count": count
+    }
+
+@api_router.get("/notifications/stream")
+async def notifications_stream(token: str = Query(..., alias="token")):
+    """Поток уведомлений и счетчика непрочитанных (Server-Sent Events)"""
+    user_data = get_current_user(token)
+    user_id = user_data.get("user_id")
+    
+    return StreamingResponse(
+        realtime_notifications.stream(user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # === API для комментариев ===
 
+def comment_thread_json(node) -> dict:
+    """Комментарий с вложенными ответами для ответа API"""
+    comment = node.comment
+    return {
+        "id": comment.id,
+        "content": comment.content,
+        "user": {
+            "id": comment.user.id,
+            "name": f"{comment.user.first_name} {comment.user.last_name}",
+            "email": comment.user.email
+        },
+        "created_at": comment.created_at.isoformat(),
+        "updated_at": comment.updated_at.isoformat(),
+        "replies": [comment_thread_json(reply) for reply in node.replies]
+    }
+
 @api_router.get("/comments/{entity_type}/{entity_id}")
 async def get_comments(
     entity_type: str = Path(...),
     entity_id: int = Path(...),
     limit: int = Query(50, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Курсор next_cursor предыдущей страницы")
 ):
-    """Получить комментарии для сущности"""
+    """Получить комментарии для сущности с деревом ответов (новые первыми; по offset или по курсору after)"""
     if not CommentValidator.is_valid_entity_type(entity_type):
         raise HTTPException(status_code=400, detail="Неверный тип сущности")
     
-    comments = CommentService.get_comments(
-        entity_type=entity_type,
-        entity_id=entity_id,
-        limit=limit,
-        offset=offset
-    )
-    
-    # Получаем ответы для каждого комментария
-    result = []
-    for comment in comments:
-        replies = CommentService.get_replies(comment.id)
-        result.append({
-            "id": comment.id,
-            "content": comment.content,
-            "user": {
-                "id": comment.user.id,
-                "name": f"{comment.user.first_name} {comment.user.last_name}",
-                "email": comment.user.email
-            },
-            "created_at": comment.created_at.isoformat(),
-            "updated_at": comment.updated_at.isoformat(),
-            "replies": [
-                {
-                    "id": reply.id,
-                    "content": reply.content,
-                    "user": {
-                        "id": reply.user.id,
-                        "name": f"{reply.user.first_name} {reply.user.last_name}",
-                        "email": reply.user.email
-                    },
-                    "created_at": reply.created_at.isoformat()
-                }
-                for reply in replies
-            ]
-        })
+    try:
+        threads, next_cursor = CommentService.get_threads(
+            entity_type=entity_type,
+            entity_id=entity_id,
+            limit=limit,
+            offset=offset,
+            after=after
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
         "success": True,
-        "comments": result,
-        "total": CommentService.get_comment_count(entity_type, entity_id)
+        "comments": [comment_thread_json(node) for node in threads],
+        "total": CommentService.get_comment_count(entity_type, entity_id),
+        "next_cursor": next_cursor
     }
 
 @api_router.post("/comments")
@@ -251,9 +327,12 @@ async def get_companies_api(
     offset: int = Query(0, ge=0),
     country: Optional[str] = Query(None),
     stage: Optional[str] = Query(None),
-    industry: Optional[str] = Query(None)
+    industry: Optional[str] = Query(None, description="Один или несколько тегов через запятую"),
+    match: str = Query('any', pattern='^(any|all)$', description="any - любой из тегов, all - все"),
+    sort: str = Query('name', pattern='^(name|trending)$', description="name - по названию, trending - в тренде"),
+    after: Optional[str] = Query(None, description="Курсор next_cursor предыдущей страницы")
 ):
-    """Получить список компаний"""
+    """Получить список компаний (по offset или по курсору after; sort=trending - только по offset)"""
     db = SessionLocal()
     try:
         query = db.query(Company).filter(Company.status == 'active')
@@ -263,10 +342,16 @@ async def get_companies_api(
         if stage:
             query = query.filter(Company.stage == stage)
         if industry:
-            query = query.filter(Company.industry == industry)
+            query = tag_service.filter_query(query, 'company', 'industry', industry, match_all=(match == 'all'))
         
-        total = query.count()
-        companies = query.offset(offset).limit(limit).all()
+        if sort == 'trending':
+            # Порядок трендов меняется с каждым просмотром, курсор по нему не стабилен
+            if after:
+                raise HTTPException(status_code=400, detail="Курсор не поддерживается для sort=trending")
+            companies = trending_page(query, Company, 'company', limit, offset, Company.name)
+            meta = {"limit": limit, "next_cursor": None, "total": query.count(), "offset": offset}
+        else:
+            companies, meta = paginate_list(query, 'companies', Company.name, Company.id, limit, offset, after)
         
         return {
             "success": True,
@@ -284,9 +369,7 @@ async def get_companies_api(
                 }
                 for c in companies
             ],
-            "total": total,
-            "limit": limit,
-            "offset": offset
+            **meta
         }
     finally:
         db.close()
@@ -324,14 +407,50 @@ async def get_company_api(company_id: int = Path(...)):
 
 # === API для инвесторов ===
 
+@api_router.get("/companies/{company_id}/matching-investors")
+async def get_company_matching_investors_api(
+    company_id: int = Path(...),
+    limit: int = Query(10, ge=1, le=50)
+):
+    """Подходящие инвесторы для компании с объяснениями оценки"""
+    # Сборка модели и умножение матриц не должны блокировать цикл событий
+    model = await run_in_threadpool(matching_engine.model)
+    if company_id not in model.company_positions:
+        raise HTTPException(status_code=404, detail="Компания не найдена")
+    investors = await run_in_threadpool(matching_engine.investors_for_company, company_id, limit)
+    return {
+        "success": True,
+        "company_id": company_id,
+        "investors": investors
+    }
+
+@api_router.get("/investors/{investor_id}/matching-companies")
+async def get_investor_matching_companies_api(
+    investor_id: int = Path(...),
+    limit: int = Query(10, ge=1, le=50)
+):
+    """Подходящие компании для инвестора с объяснениями оценки"""
+    model = await run_in_threadpool(matching_engine.model)
+    if investor_id not in model.investor_positions:
+        raise HTTPException(status_code=404, detail="Инвестор не найден")
+    companies = await run_in_threadpool(matching_engine.companies_for_investor, investor_id, limit)
+    return {
+        "success": True,
+        "investor_id": investor_id,
+        "companies": companies
+    }
+
 @api_router.get("/investors")
 async def get_investors_api(
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
     country: Optional[str] = Query(None),
-    focus: Optional[str] = Query(None)
+    focus: Optional[str] = Query(None, description="Один или несколько тегов через запятую"),
+    stages: Optional[str] = Query(None, description="Один или несколько тегов через запятую"),
+    match: str = Query('any', pattern='^(any|all)$', description="any - любой из тегов, all - все"),
+    after: Optional[str] = Query(None, description="Курсор next_cursor предыдущей страницы")
 ):
-    """Получить список инвесторов"""
+    """Получить список инвесторов (по offset или по курсору after)"""
     db = SessionLocal()
     try:
         query = db.query(Investor).filter(Investor.status == 'active')
@@ -339,10 +458,11 @@ async def get_investors_api(
         if country:
             query = query.filter(Investor.country == country)
         if focus:
-            query = query.filter(Investor.focus.contains(focus))
+            query = tag_service.filter_query(query, 'investor', 'focus', focus, match_all=(match == 'all'))
+        if stages:
+            query = tag_service.filter_query(query, 'investor', 'stages', stages, match_all=(match == 'all'))
         
-        total = query.count()
-        investors = query.offset(offset).limit(limit).all()
+        investors, meta = paginate_list(query, 'investors', Investor.name, Investor.id, limit, offset, after)
         
         return {
             "success": True,
@@ -359,9 +479,7 @@ async def get_investors_api(
                 }
                 for i in investors
             ],
-            "total": total,
-            "limit": limit,
-            "offset": offset
+            **meta
         }
     finally:
         db.close()
@@ -373,20 +491,20 @@ async def get_jobs_api(
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
     city: Optional[str] = Query(None),
-    job_type: Optional[str] = Query(None)
+    job_type: Optional[str] = Query(None),
+    after: Optional[str] = Query(None, description="Курсор next_cursor предыдущей страницы")
 ):
-    """Получить список вакансий"""
+    """Получить список вакансий (новые первыми; по offset или по курсору after)"""
     db = SessionLocal()
     try:
-        query = db.query(Job).filter(Job.status == 'active')
+        query = db.query(Job).options(joinedload(Job.company)).filter(Job.status == 'active')
         
         if city:
             query = query.filter(Job.city == city)
         if job_type:
             query = query.filter(Job.job_type == job_type)
         
-        total = query.count()
-        jobs = query.offset(offset).limit(limit).all()
+        jobs, meta = paginate_list(query, 'jobs', None, Job.id, limit, offset, after, descending=True)
         
         return {
             "success": True,
@@ -405,13 +523,107 @@ async def get_jobs_api(
                 }
                 for j in jobs
             ],
-            "total": total,
-            "limit": limit,
-            "offset": offset
+            **meta
         }
     finally:
         db.close() 
 
+# === API для аналитики ===
+
+@api_router.get("/analytics")
+async def get_analytics_api(
+    year: Optional[int] = Query(None),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    group_by: Optional[str] = Query(None, pattern='^(year|month|country|stage|industry|deal_type)$'),
+    country: Optional[str] = Query(None),
+    stage: Optional[str] = Query(None),
+    industry: Optional[str] = Query(None),
+    deal_type: Optional[str] = Query(None)
+):
+    """Итоги сделок (количество, сумма, минимум, максимум, среднее) из агрегатов, с разрезом group_by"""
+    filters = {
+        'year': year, 'month': month, 'country': country,
+        'stage': stage, 'industry': industry, 'deal_type': deal_type
+    }
+    db = SessionLocal()
+    try:
+        totals = analytics_service.summary(filters=filters, db=db)
+        return {
+            "success": True,
+            "filters": {name: value for name, value in filters.items() if value not in (None, '')},
+            "totals": totals[0] if totals else None,
+            "group_by": group_by,
+            "groups": analytics_service.summary(group_by, filters, db) if group_by else []
+        }
+    finally:
+        db.close()
+
+def parse_funding_group_by(group_by: Optional[str]) -> List[str]:
+    """Разрезы группировки через запятую; неизвестный разрез - 400"""
+    names = [name.strip() for name in (group_by or '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in FUNDING_DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестный разрез: {', '.join(unknown)}")
+    return names
+
+@api_router.get("/analytics/distribution")
+async def get_funding_distribution_api(
+    value: str = Query('amount', pattern='^(amount|valuation)$'),
+    group_by: Optional[str] = Query(None, description="Разрезы через запятую: year, country, stage, industry, deal_type"),
+    year: Optional[int] = Query(None),
+    country: Optional[str] = Query(None),
+    stage: Optional[str] = Query(None),
+    industry: Optional[str] = Query(None),
+    deal_type: Optional[str] = Query(None),
+    q: str = Query('0.25,0.5,0.75', description="Перцентили через запятую, от 0 до 1")
+):
+    """Перцентили объема или оценки раундов по группам"""
+    try:
+        qs = [float(item) for item in q.split(',') if item.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный список перцентилей")
+    if not qs or any(not 0 <= item <= 1 for item in qs):
+        raise HTTPException(status_code=400, detail="Перцентили должны быть от 0 до 1")
+    filters = {'year': year, 'country': country, 'stage': stage, 'industry': industry, 'deal_type': deal_type}
+    return {
+        "success": True,
+        "value": value,
+        "groups": funding_analytics.distribution(value, parse_funding_group_by(group_by), filters, qs)
+    }
+
+@api_router.get("/analytics/step-ups")
+async def get_funding_step_ups_api(
+    group_by: Optional[str] = Query(None, description="Разрезы нового раунда через запятую"),
+    year: Optional[int] = Query(None),
+    country: Optional[str] = Query(None),
+    stage: Optional[str] = Query(None),
+    industry: Optional[str] = Query(None),
+    deal_type: Optional[str] = Query(None),
+    company_id: Optional[int] = Query(None, description="Раунды одной компании")
+):
+    """Рост оценки между соседними раундами компаний (перцентили) или по раундам одной компании"""
+    if company_id is not None:
+        return {"success": True, "company_id": company_id, "rounds": funding_analytics.company_step_ups(company_id)}
+    filters = {'year': year, 'country': country, 'stage': stage, 'industry': industry, 'deal_type': deal_type}
+    return {"success": True, "groups": funding_analytics.step_ups(parse_funding_group_by(group_by), filters)}
+
+@api_router.get("/analytics/concentration")
+async def get_funding_concentration_api(
+    group_by: str = Query('country,year', description="Разрезы через запятую"),
+    top: int = Query(10, ge=1, le=100),
+    year: Optional[int] = Query(None),
+    country: Optional[str] = Query(None),
+    stage: Optional[str] = Query(None),
+    industry: Optional[str] = Query(None)
+):
+    """Доля топ-N компаний в объеме финансирования групп"""
+    filters = {'year': year, 'country': country, 'stage': stage, 'industry': industry}
+    return {
+        "success": True,
+        "top": top,
+        "groups": funding_analytics.concentration(parse_funding_group_by(group_by), filters, top)
+    }
+
 # === API для обратной связи ===
 
 @api_router.post("/feedback")
@@ -0,0 +1,77 @@
+"""
+Первичное заполнение производных таблиц (индексы, агрегаты, счетчики) на существующей базе.
+
+Каждый воркер gunicorn при старте проверяет, пуста ли таблица. Без блокировки несколько воркеров
+одновременно видят пустую таблицу и заполняют ее параллельно: на PostgreSQL две транзакции
+read committed не видят строк друг друга, и upsert-счетчики удваиваются. Поэтому заполнение идет
+под блокировкой базы, а пустота перепроверяется уже под ней; остальные воркеры ждут и видят
+заполненную таблицу:
+
+- PostgreSQL - pg_advisory_lock на отдельном соединении (снимается и при обрыве соединения)
+- SQLite - строка в backfill_lock (INSERT ... ON CONFLICT DO NOTHING); блокировку упавшего
+  воркера можно занять через BACKFILL_LOCK_TIMEOUT секунд
+"""
+
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
+
+from sqlalchemy import text
+
+from models import BackfillLock
+
+# Через сколько секунд блокировка SQLite считается брошенной
+BACKFILL_LOCK_TIMEOUT = 600
+
+BACKFILL_POLL_INTERVAL = 0.2
+
+@contextmanager
+def backfill_lock(bind, name: str):
+    """Блокировка заполнения name, общая для всех процессов с этой базой"""
+    if bind.dialect.name == 'postgresql':
+        key = zlib.crc32(f"backfill:{name}".encode())
+        connection = bind.connect()
+        try:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+            connection.commit()
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+            connection.commit()
+            connection.close()
+        return
+    BackfillLock.__table__.create(bind, checkfirst=True)
+    while True:
+        with bind.begin() as connection:
+            now = datetime.utcnow()
+            connection.execute(
+                BackfillLock.__table__.delete().where(
+                    BackfillLock.name == name,
+                    BackfillLock.acquired_at < now - timedelta(seconds=BACKFILL_LOCK_TIMEOUT)
+                )
+            )
+            acquired = connection.execute(
+                text("INSERT INTO backfill_lock (name, acquired_at) VALUES (:name, :now) ON CONFLICT (name) DO NOTHING"),
+                {"name": name, "now": now}
+            ).rowcount == 1
+        if acquired:
+            break
+        time.sleep(BACKFILL_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        with bind.begin() as connection:
+            connection.execute(BackfillLock.__table__.delete().where(BackfillLock.name == name))
+
+def run_backfill(bind, name: str, is_empty: Callable[[Any], bool], fill: Callable[[], Any]) -> Optional[Any]:
+    """Вызывает fill(), если is_empty(connection) и до, и под блокировкой; возвращает результат fill или None"""
+    with bind.connect() as connection:
+        if not is_empty(connection):
+            return None
+    with backfill_lock(bind, name):
+        with bind.connect() as connection:
+            if not is_empty(connection):
+                return None
+        return fill()
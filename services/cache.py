@@ -1,96 +1,166 @@
 import hashlib
 import json
 import time
-from typing import Any, Optional, Dict, List
+import threading
+import sqlite3
+import struct
+from collections import OrderedDict
+from typing import Any, Optional, Dict, List, Tuple
 from functools import wraps
 from datetime import datetime, timedelta
 import pickle
 import os
 
-class CacheManager:
-    """Менеджер кеширования для оптимизации производительности"""
+from .snapshots import (
+    SnapshotCodec, CompanyRow, CompanyRefRow, InvestorRow, NewsRow, JobRow, EventRow, PodcastRow, snapshot_all
+)
+
+# Заголовок записи в файловом хранилище: время истечения (double)
+_EXPIRES_HEADER = struct.Struct('<d')
+# Значение счетчика поколения тега в общем хранилище
+_GENERATION = struct.Struct('<q')
+# Срок жизни счетчиков поколений (10 лет) - они не должны истекать сами
+_GENERATION_TTL = 10 * 365 * 24 * 3600
+
+class MemoryLRUCache:
+    """Ограниченный LRU кеш в памяти процесса (первый уровень)"""
+    
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Получает значение и помечает его как недавно использованное"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, expires_at, size = entry
+            if time.time() > expires_at:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+    
+    def set(self, key: str, data: Any, expires_at: float, size: int) -> None:
+        """Сохраняет значение, вытесняя самые старые записи при переполнении"""
+        if size > self.max_bytes:
+            # Слишком большие значения держим только во втором уровне
+            self.delete(key)
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, expires_at, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
     
-    def __init__(self, cache_dir: str = "cache", default_ttl: int = 300):
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                return True
+            return False
+    
+    def clear(self, prefix: Optional[str] = None) -> int:
+        with self._lock:
+            if prefix is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._size = 0
+                return count
+            keys = [k for k in self._entries if k.startswith(prefix)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+    
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._size -= size
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size_mb': round(self._size / (1024 * 1024), 2),
+                'max_entries': self.max_entries,
+                'max_size_mb': round(self.max_bytes / (1024 * 1024), 2)
+            }
+
+class FileCacheBackend:
+    """Общее хранилище кеша в файлах (второй уровень, общий для воркеров)"""
+    
+    name = 'file'
+    
+    def __init__(self, cache_dir: str = "cache"):
         self.cache_dir = cache_dir
-        self.default_ttl = default_ttl  # 5 минут по умолчанию
         
         # Создаем директорию для кеша если её нет
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
     
-    def _get_cache_key(self, prefix: str, *args, **kwargs) -> str:
-        """Генерирует ключ кеша на основе аргументов"""
-        # Создаем строку из аргументов
-        key_data = f"{prefix}:{args}:{sorted(kwargs.items())}"
-        
-        # Создаем хеш для короткого ключа
-        key_hash = hashlib.md5(key_data.encode()).hexdigest()
-        
-        return f"{prefix}_{key_hash}"
-    
     def _get_cache_path(self, key: str) -> str:
         """Получает путь к файлу кеша"""
         return os.path.join(self.cache_dir, f"{key}.cache")
     
-    def get(self, key: str) -> Optional[Any]:
-        """Получает данные из кеша"""
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """Возвращает (payload, expires_at) или None"""
         cache_path = self._get_cache_path(key)
-        
-        if not os.path.exists(cache_path):
-            return None
-        
         try:
             with open(cache_path, 'rb') as f:
-                cached_data = pickle.load(f)
-            
-            # Проверяем TTL
-            if time.time() > cached_data['expires_at']:
-                # Удаляем устаревший кеш
-                os.remove(cache_path)
-                return None
-            
-            return cached_data['data']
-        
-        except (pickle.PickleError, KeyError, EOFError):
-            # Удаляем поврежденный кеш
-            if os.path.exists(cache_path):
-                os.remove(cache_path)
+                raw = f.read()
+        except OSError:
             return None
-    
-    def set(self, key: str, data: Any, ttl: Optional[int] = None) -> bool:
-        """Сохраняет данные в кеш"""
-        if ttl is None:
-            ttl = self.default_ttl
         
-        cache_data = {
-            'data': data,
-            'created_at': time.time(),
-            'expires_at': time.time() + ttl
-        }
+        if len(raw) < _EXPIRES_HEADER.size:
+            self.delete(key)
+            return None
         
+        expires_at = _EXPIRES_HEADER.unpack_from(raw)[0]
+        if time.time() > expires_at:
+            # Удаляем устаревший кеш
+            self.delete(key)
+            return None
+        return raw[_EXPIRES_HEADER.size:], expires_at
+    
+    def set(self, key: str, payload: bytes, expires_at: float) -> bool:
         cache_path = self._get_cache_path(key)
-        
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
-            with open(cache_path, 'wb') as f:
-                pickle.dump(cache_data, f)
+            # Пишем во временный файл и атомарно подменяем, чтобы другие воркеры не прочитали половину записи
+            with open(tmp_path, 'wb') as f:
+                f.write(_EXPIRES_HEADER.pack(expires_at))
+                f.write(payload)
+            os.replace(tmp_path, cache_path)
             return True
-        except Exception:
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return False
     
     def delete(self, key: str) -> bool:
-        """Удаляет данные из кеша"""
-        cache_path = self._get_cache_path(key)
-        
-        if os.path.exists(cache_path):
-            try:
-                os.remove(cache_path)
-                return True
-            except Exception:
-                return False
-        return False
+        try:
+            os.remove(self._get_cache_path(key))
+            return True
+        except OSError:
+            return False
     
     def clear(self, prefix: Optional[str] = None) -> int:
-        """Очищает кеш"""
         deleted_count = 0
         
         for filename in os.listdir(self.cache_dir):
@@ -105,10 +175,10 @@ class CacheManager:
         return deleted_count
     
     def get_stats(self) -> Dict[str, Any]:
-        """Получает статистику кеша"""
         total_files = 0
         total_size = 0
         expired_files = 0
+        now = time.time()
         
         for filename in os.listdir(self.cache_dir):
             if filename.endswith('.cache'):
@@ -116,13 +186,13 @@ class CacheManager:
                 total_files += 1
                 total_size += os.path.getsize(file_path)
                 
-                # Проверяем, не истек ли срок действия
+                # Для проверки срока действия достаточно прочитать заголовок
                 try:
                     with open(file_path, 'rb') as f:
-                        cached_data = pickle.load(f)
-                    if time.time() > cached_data['expires_at']:
+                        header = f.read(_EXPIRES_HEADER.size)
+                    if now > _EXPIRES_HEADER.unpack(header)[0]:
                         expired_files += 1
-                except:
+                except (OSError, struct.error):
                     expired_files += 1
         
         return {
@@ -132,65 +202,516 @@ class CacheManager:
             'cache_dir': self.cache_dir
         }
 
+class SQLiteCacheBackend:
+    """Общее хранилище кеша в локальной SQLite базе (второй уровень)"""
+    
+    name = 'sqlite'
+    
+    def __init__(self, cache_dir: str = "cache", filename: str = "cache.sqlite3"):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, filename)
+        self._local = threading.local()
+        
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.commit()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Отдельное соединение на поток, WAL позволяет читать параллельно с записью"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        try:
+            row = self._connect().execute(
+                "SELECT value, expires_at FROM cache_entry WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        if time.time() > row[1]:
+            self.delete(key)
+            return None
+        return bytes(row[0]), row[1]
+    
+    def set(self, key: str, payload: bytes, expires_at: float) -> bool:
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(payload), expires_at)
+            )
+            return True
+        except sqlite3.Error:
+            return False
+    
+    def delete(self, key: str) -> bool:
+        try:
+            cursor = self._connect().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+            return cursor.rowcount > 0
+        except sqlite3.Error:
+            return False
+    
+    def clear(self, prefix: Optional[str] = None) -> int:
+        try:
+            conn = self._connect()
+            if prefix is None:
+                cursor = conn.execute("DELETE FROM cache_entry")
+            else:
+                # Диапазон по первичному ключу вместо LIKE - использует индекс
+                cursor = conn.execute(
+                    "DELETE FROM cache_entry WHERE key >= ? AND key < ?",
+                    (prefix, prefix + '\uffff')
+                )
+            return cursor.rowcount
+        except sqlite3.Error:
+            return 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        try:
+            total, size, expired = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0), "
+                "COALESCE(SUM(CASE WHEN expires_at < ? THEN 1 ELSE 0 END), 0) FROM cache_entry",
+                (time.time(),)
+            ).fetchone()
+        except sqlite3.Error:
+            total, size, expired = 0, 0, 0
+        return {
+            'total_files': total,
+            'total_size_mb': round(size / (1024 * 1024), 2),
+            'expired_files': expired,
+            'cache_dir': self.cache_dir
+        }
+
+class PickleCodec:
+    """Кодек кеша по умолчанию"""
+    
+    code = b'p'
+    
+    @staticmethod
+    def dumps(data: Any) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @staticmethod
+    def loads(payload: bytes) -> Any:
+        return pickle.loads(payload)
+
+CACHE_BACKENDS = {
+    FileCacheBackend.name: FileCacheBackend,
+    SQLiteCacheBackend.name: SQLiteCacheBackend
+}
+
+class SingleFlight:
+    """Объединение одновременных вычислений одного ключа в пределах процесса.
+    
+    Первый поток выполняет функцию, остальные ждут и получают тот же результат.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Dict[str, Any]] = {}
+    
+    def do(self, key: str, func) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+    
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._calls
+
+class CacheManager:
+    """Двухуровневый кеш: LRU в памяти воркера + общее хранилище (файлы или SQLite)"""
+    
+    def __init__(
+        self,
+        cache_dir: str = "cache",
+        default_ttl: int = 300,
+        backend: Optional[str] = None,
+        memory_max_entries: int = 1024,
+        memory_max_mb: int = 32,
+        memory_ttl: int = 60,
+        generation_ttl: float = 1.0
+    ):
+        self.cache_dir = cache_dir
+        self.default_ttl = default_ttl  # 5 минут по умолчанию
+        # Ограничиваем жизнь записи в памяти, чтобы воркеры не расходились надолго
+        self.memory_ttl = memory_ttl
+        
+        backend_name = backend or os.getenv("CACHE_BACKEND", FileCacheBackend.name)
+        backend_class = CACHE_BACKENDS.get(backend_name)
+        if backend_class is None:
+            # Опечатка в CACHE_BACKEND должна остановить старт, а не тихо включить файловый кеш
+            raise ValueError(f"Неизвестное хранилище кеша: {backend_name} (доступны: {', '.join(CACHE_BACKENDS)})")
+        self.backend = backend_class(cache_dir)
+        self.memory = MemoryLRUCache(
+            max_entries=memory_max_entries,
+            max_bytes=memory_max_mb * 1024 * 1024
+        )
+        self.backend_hits = 0
+        self.backend_misses = 0
+        # Локальная копия счетчиков поколений тегов: tag -> (generation, fetched_at)
+        self.generation_ttl = generation_ttl
+        self._generations: Dict[str, Tuple[int, float]] = {}
+        self._generations_lock = threading.Lock()
+        # Кодеки значений; код кодека записывается первым байтом значения
+        self.codecs: Dict[bytes, Any] = {PickleCodec.code: PickleCodec}
+        self.single_flight = SingleFlight()
+        self.refreshes = 0
+    
+    def _get_cache_key(self, prefix: str, *args, **kwargs) -> str:
+        """Генерирует ключ кеша на основе аргументов"""
+        # Создаем строку из аргументов
+        key_data = f"{prefix}:{args}:{sorted(kwargs.items())}"
+        
+        # Создаем хеш для короткого ключа
+        key_hash = hashlib.md5(key_data.encode()).hexdigest()
+        
+        return f"{prefix}_{key_hash}"
+    
+    def _get_tag_key(self, tag: str) -> str:
+        return f"tag_{tag}"
+    
+    def _read_tag_generation(self, tag: str) -> int:
+        stored = self.backend.get(self._get_tag_key(tag))
+        if stored is None:
+            return 0
+        try:
+            return _GENERATION.unpack(stored[0])[0]
+        except struct.error:
+            return 0
+    
+    def get_tag_generation(self, tag: str) -> int:
+        """Текущее поколение тега; общее хранилище опрашивается не чаще раза в generation_ttl"""
+        now = time.time()
+        with self._generations_lock:
+            local = self._generations.get(tag)
+        if local is not None and now - local[1] < self.generation_ttl:
+            return local[0]
+        
+        generation = self._read_tag_generation(tag)
+        with self._generations_lock:
+            self._generations[tag] = (generation, now)
+        return generation
+    
+    def get_tags_version(self, tags: Tuple[str, ...]) -> str:
+        """Строка поколений тегов, которая входит в ключ кеша"""
+        return ".".join(str(self.get_tag_generation(tag)) for tag in tags)
+    
+    def invalidate_tags(self, *tags: str) -> Dict[str, int]:
+        """Инвалидирует все записи с указанными тегами увеличением счетчика поколения.
+        
+        Старые записи не удаляются: они больше не находятся по ключу и вытесняются по TTL.
+        """
+        result = {}
+        now = time.time()
+        for tag in set(tags):
+            # Не опускаем поколение ниже текущего времени, чтобы после clear() ключи не повторились
+            generation = max(self._read_tag_generation(tag) + 1, int(now))
+            self.backend.set(
+                self._get_tag_key(tag),
+                _GENERATION.pack(generation),
+                now + _GENERATION_TTL
+            )
+            with self._generations_lock:
+                self._generations[tag] = (generation, now)
+            result[tag] = generation
+        return result
+    
+    def register_codec(self, codec) -> None:
+        """Регистрирует кодек значений (объект с code, dumps и loads)"""
+        self.codecs[codec.code] = codec
+    
+    def _serialize(self, data: Any, codec=None) -> bytes:
+        codec = codec or PickleCodec
+        if codec.code not in self.codecs:
+            self.register_codec(codec)
+        return codec.code + codec.dumps(data)
+    
+    def _deserialize(self, payload: bytes) -> Any:
+        codec = self.codecs.get(payload[:1])
+        if codec is None:
+            raise ValueError("Неизвестный формат записи кеша")
+        return codec.loads(payload[1:])
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Получает данные из кеша: сначала из памяти, затем из общего хранилища"""
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        
+        stored = self.backend.get(key)
+        if stored is None:
+            self.backend_misses += 1
+            return None
+        
+        payload, expires_at = stored
+        try:
+            data = self._deserialize(payload)
+        except (pickle.PickleError, EOFError, AttributeError, ImportError, ValueError, TypeError, IndexError):
+            # Удаляем поврежденный кеш
+            self.backend.delete(key)
+            self.backend_misses += 1
+            return None
+        
+        self.backend_hits += 1
+        self.memory.set(key, data, min(expires_at, time.time() + self.memory_ttl), len(payload))
+        return data
+    
+    def set(self, key: str, data: Any, ttl: Optional[int] = None, codec=None) -> bool:
+        """Сохраняет данные в оба уровня кеша"""
+        if ttl is None:
+            ttl = self.default_ttl
+        
+        try:
+            payload = self._serialize(data, codec)
+        except (pickle.PickleError, TypeError, AttributeError, ValueError):
+            return False
+        
+        expires_at = time.time() + ttl
+        self.memory.set(key, data, min(expires_at, time.time() + self.memory_ttl), len(payload))
+        return self.backend.set(key, payload, expires_at)
+    
+    def get_or_set(self, key: str, compute, ttl: Optional[int] = None, codec=None, stale_ttl: int = 0) -> Any:
+        """Возвращает значение из кеша или вычисляет его.
+        
+        Одновременные промахи по одному ключу объединяются: запрос к БД выполняет один поток.
+        Если stale_ttl > 0, после истечения ttl запись еще stale_ttl секунд отдается как есть,
+        а обновляется в фоне (stale-while-revalidate).
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        
+        entry = self.get(key)
+        if entry is not None:
+            if stale_ttl and time.time() > entry['fresh_until']:
+                self._refresh_in_background(key, compute, ttl, codec, stale_ttl)
+            return entry['data']
+        
+        def load():
+            # Пока ждали блокировку, значение мог положить другой поток
+            entry = self.get(key)
+            if entry is not None:
+                return entry['data']
+            return self._compute_and_store(key, compute, ttl, codec, stale_ttl)
+        
+        return self.single_flight.do(key, load)
+    
+    def _compute_and_store(self, key: str, compute, ttl: int, codec, stale_ttl: int) -> Any:
+        data = compute()
+        entry = {'data': data, 'fresh_until': time.time() + ttl}
+        self.set(key, entry, ttl + stale_ttl, codec)
+        return data
+    
+    def _refresh_in_background(self, key: str, compute, ttl: int, codec, stale_ttl: int) -> None:
+        if self.single_flight.in_flight(key):
+            return
+        
+        def refresh():
+            try:
+                self.single_flight.do(key, lambda: self._compute_and_store(key, compute, ttl, codec, stale_ttl))
+                self.refreshes += 1
+            except Exception as e:
+                print(f"Ошибка фонового обновления кеша {key}: {e}")
+        
+        threading.Thread(target=refresh, daemon=True).start()
+    
+    def delete(self, key: str) -> bool:
+        """Удаляет данные из кеша"""
+        in_memory = self.memory.delete(key)
+        in_backend = self.backend.delete(key)
+        return in_memory or in_backend
+    
+    def clear(self, prefix: Optional[str] = None) -> int:
+        """Очищает кеш"""
+        self.memory.clear(prefix)
+        if prefix is None:
+            with self._generations_lock:
+                self._generations.clear()
+        return self.backend.clear(prefix)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получает статистику кеша по уровням"""
+        stats = self.backend.get_stats()
+        stats['backend'] = self.backend.name
+        stats['tiers'] = {
+            'memory': self.memory.get_stats(),
+            'backend': {
+                'hits': self.backend_hits,
+                'misses': self.backend_misses
+            }
+        }
+        stats['background_refreshes'] = self.refreshes
+        with self._generations_lock:
+            stats['tags'] = {tag: generation for tag, (generation, _) in self._generations.items()}
+        return stats
+
 # Глобальный экземпляр кеш-менеджера
 cache_manager = CacheManager()
 
-def cached(prefix: str, ttl: Optional[int] = None):
-    """Декоратор для кеширования результатов функций"""
+def cached(prefix: str, ttl: Optional[int] = None, tags: Tuple[str, ...] = (), codec=None, stale_ttl: int = 0):
+    """Декоратор для кеширования результатов функций.
+    
+    tags - теги записи; CacheManager.invalidate_tags() по любому из них делает запись недоступной.
+    codec - формат хранения (по умолчанию pickle, для снимков строк - SnapshotCodec).
+    stale_ttl - сколько секунд после ttl отдавать старое значение, обновляя его в фоне.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Генерируем ключ кеша
             cache_key = cache_manager._get_cache_key(prefix, *args, **kwargs)
+            if tags:
+                cache_key = f"{cache_key}_g{cache_manager.get_tags_version(tags)}"
             
-            # Пытаемся получить из кеша
-            cached_result = cache_manager.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            # Выполняем функцию и кешируем результат
-            result = func(*args, **kwargs)
-            cache_manager.set(cache_key, result, ttl)
-            
-            return result
+            # Промах вычисляется один раз, даже если ключ запросили несколько потоков сразу
+            return cache_manager.get_or_set(
+                cache_key,
+                lambda: func(*args, **kwargs),
+                ttl=ttl,
+                codec=codec,
+                stale_ttl=stale_ttl
+            )
         return wrapper
     return decorator
 
+# Теги кеша, которые затрагивает изменение строк таблицы
+MODEL_CACHE_TAGS = {
+    'company': ('companies', 'analytics'),
+    'investor': ('investors', 'analytics'),
+    'portfolio_entry': ('investors', 'analytics'),
+    'deal': ('companies', 'investors', 'analytics'),
+    'news': ('news',),
+    'author': ('news',),
+    'job': ('jobs', 'analytics'),
+    'event': ('events',),
+    'podcast': ('podcasts',),
+    'country': ('events',),
+}
+
+# Колонки, изменение которых не влияет на закешированные данные (счетчики просмотров)
+CACHE_IGNORED_COLUMNS = {'views'}
+
+def table_cache_tag(tablename: str) -> str:
+    """Тег, который инвалидируется при любой записи в таблицу (кеш количеств строк)"""
+    return f"table:{tablename}"
+
+def _has_cache_relevant_changes(obj) -> bool:
+    """Проверяет, изменились ли у объекта атрибуты, влияющие на кеш"""
+    from sqlalchemy import inspect
+    
+    state = inspect(obj)
+    for attr in state.attrs:
+        if attr.key in CACHE_IGNORED_COLUMNS:
+            continue
+        if attr.history.has_changes():
+            return True
+    return False
+
+def _collect_cache_tags(session, flush_context):
+    """after_flush: запоминает теги затронутых таблиц до коммита"""
+    pending = session.info.setdefault('cache_tags', set())
+    for obj in list(session.new) + list(session.deleted):
+        tablename = getattr(obj, '__tablename__', None)
+        pending.update(MODEL_CACHE_TAGS.get(tablename, ()))
+        if tablename:
+            pending.add(table_cache_tag(tablename))
+    for obj in session.dirty:
+        tablename = getattr(obj, '__tablename__', None)
+        if tablename and _has_cache_relevant_changes(obj):
+            pending.update(MODEL_CACHE_TAGS.get(tablename, ()))
+            pending.add(table_cache_tag(tablename))
+
+def _invalidate_committed_tags(session):
+    """after_commit: увеличивает поколения тегов, изменения по которым закоммичены"""
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        cache_manager.invalidate_tags(*tags)
+
+def _discard_cache_tags(session):
+    session.info.pop('cache_tags', None)
+
+def install_invalidation_hooks(session_factory) -> None:
+    """Подключает автоматическую инвалидацию кеша к событиям сессий SQLAlchemy"""
+    from sqlalchemy import event
+    
+    if event.contains(session_factory, 'after_flush', _collect_cache_tags):
+        return
+    event.listen(session_factory, 'after_flush', _collect_cache_tags)
+    event.listen(session_factory, 'after_commit', _invalidate_committed_tags)
+    event.listen(session_factory, 'after_rollback', _discard_cache_tags)
+
 class QueryCache:
     """Кеширование для SQL запросов"""
     
     @staticmethod
-    @cached("query", ttl=600)  # 10 минут для запросов
-    def get_companies_with_filters(q: str = "", country: str = "", stage: str = "", industry: str = "", limit: int = 20, offset: int = 0):
-        """Кешированный запрос компаний с фильтрами"""
+    @cached("query_companies", ttl=600, tags=('companies',), codec=SnapshotCodec, stale_ttl=600)  # 10 минут для запросов
+    def get_companies_with_filters(q: str = "", country: str = "", stage: str = "", industry: str = "", limit: int = 20, offset: int = 0, match: str = ""):
+        """Кешированный запрос компаний с фильтрами.
+        
+        industry - один или несколько тегов через запятую; match='all' - нужны все теги, иначе любой.
+        """
         from db import SessionLocal
         from models import Company
         from sqlalchemy import and_, or_
+        from sqlalchemy.orm import selectinload
         
         db = SessionLocal()
         try:
-            query = db.query(Company).filter(Company.status == 'active')
+            query = QueryCache._companies_query(db, country, stage, industry, match)
             
             if q:
-                # Поиск по названию, описанию и индустрии
-                search_filter = or_(
-                    Company.name.ilike(f'%{q}%'),
-                    Company.description.ilike(f'%{q}%'),
-                    Company.industry.ilike(f'%{q}%')
-                )
-                query = query.filter(search_filter)
-            if country:
-                query = query.filter(Company.country == country)
-            if stage:
-                query = query.filter(Company.stage == stage)
-            if industry:
-                query = query.filter(Company.industry == industry)
-            
-            total = query.count()
-            companies = query.offset(offset).limit(limit).all()
+                # Поисковый индекс: полнотекстовые совпадения и похожие названия (транслитерация, опечатки)
+                from services.search import search_service
+                ranked_ids = search_service.match_ids('company', q)
+                allowed = {row[0] for row in query.filter(Company.id.in_(ranked_ids)).with_entities(Company.id)} if ranked_ids else set()
+                ranked_ids = [company_id for company_id in ranked_ids if company_id in allowed]
+                total = len(ranked_ids)
+                page_ids = ranked_ids[offset:offset + limit]
+                loaded = {c.id: c for c in db.query(Company).options(selectinload(Company.team)).filter(Company.id.in_(page_ids))} if page_ids else {}
+                companies = [loaded[company_id] for company_id in page_ids if company_id in loaded]
+            else:
+                # Количество кешируется отдельно от страниц: одно на набор фильтров
+                from services.counts import count_service
+                total = int(count_service.count(query, Company, filters={
+                    'status': 'active', 'country': country, 'stage': stage, 'industry': industry,
+                    'match': match if industry else ''
+                }))
+                # Команду загружаем явно: снимок должен рендериться без сессии
+                companies = query.options(selectinload(Company.team)).order_by(Company.name).offset(offset).limit(limit).all()
             
             return {
-                'companies': companies,
+                'companies': snapshot_all(companies, CompanyRow),
                 'total': total,
                 'limit': limit,
                 'offset': offset
@@ -199,9 +720,67 @@ class QueryCache:
             db.close()
     
     @staticmethod
-    @cached("query", ttl=600)
-    def get_investors_with_filters(country: str = "", focus: str = "", limit: int = 20, offset: int = 0):
-        """Кешированный запрос инвесторов с фильтрами"""
+    def _companies_query(db, country: str = "", stage: str = "", industry: str = "", match: str = ""):
+        """Активные компании с фильтрами списка"""
+        from models import Company
+        
+        query = db.query(Company).filter(Company.status == 'active')
+        if country:
+            query = query.filter(Company.country == country)
+        if stage:
+            query = query.filter(Company.stage == stage)
+        if industry:
+            from services.tags import tag_service
+            query = tag_service.filter_query(query, 'company', 'industry', industry, match_all=(match == 'all'))
+        return query
+    
+    @staticmethod
+    def get_trending_companies(country: str = "", stage: str = "", industry: str = "", limit: int = 20, offset: int = 0, match: str = ""):
+        """Компании по трендовой оценке, дальше по названию. Не кешируется: порядок меняется с каждым просмотром"""
+        from db import SessionLocal
+        from models import Company
+        from sqlalchemy.orm import selectinload
+        from services.counts import count_service
+        from services.trending import trending_page
+        
+        db = SessionLocal()
+        try:
+            query = QueryCache._companies_query(db, country, stage, industry, match)
+            total = int(count_service.count(query, Company, filters={
+                'status': 'active', 'country': country, 'stage': stage, 'industry': industry,
+                'match': match if industry else ''
+            }))
+            companies = trending_page(query, Company, 'company', limit, offset, Company.name, options=(selectinload(Company.team),))
+            return {
+                'companies': snapshot_all(companies, CompanyRow),
+                'total': total,
+                'limit': limit,
+                'offset': offset
+            }
+        finally:
+            db.close()
+    
+    @staticmethod
+    @cached("query_company_filters", ttl=1800, tags=('companies',), stale_ttl=1800)
+    def get_company_filters():
+        """Кешированные значения фильтров списка компаний с количествами (из индекса фасетов)"""
+        from services.facets import facet_index
+        
+        facets = facet_index.get('company')
+        return {
+            'countries': list(facets['country']),
+            'stages': list(facets['stage']),
+            'industries': list(facets['industry']),
+            'counts': facets
+        }
+    
+    @staticmethod
+    @cached("query_investors", ttl=600, tags=('investors',), codec=SnapshotCodec, stale_ttl=600)
+    def get_investors_with_filters(country: str = "", focus: str = "", limit: Optional[int] = 20, offset: int = 0, q: str = "", stages: str = "", match: str = ""):
+        """Кешированный запрос инвесторов с фильтрами.
+        
+        focus и stages - один или несколько тегов через запятую; match='all' - нужны все теги, иначе любой.
+        """
         from db import SessionLocal
         from models import Investor
         
@@ -209,16 +788,21 @@ class QueryCache:
         try:
             query = db.query(Investor).filter(Investor.status == 'active')
             
+            if q:
+                query = query.filter(Investor.name.ilike(f'%{q}%'))
             if country:
                 query = query.filter(Investor.country == country)
-            if focus:
-                query = query.filter(Investor.focus.contains(focus))
+            if focus or stages:
+                # Индексированные связи с тегами вместо ilike('%x%')
+                from services.tags import tag_service
+                query = tag_service.filter_query(query, 'investor', 'focus', focus, match_all=(match == 'all'))
+                query = tag_service.filter_query(query, 'investor', 'stages', stages, match_all=(match == 'all'))
             
             total = query.count()
-            investors = query.offset(offset).limit(limit).all()
+            investors = query.order_by(Investor.name).offset(offset).limit(limit).all()
             
             return {
-                'investors': investors,
+                'investors': snapshot_all(investors, InvestorRow),
                 'total': total,
                 'limit': limit,
                 'offset': offset
@@ -227,27 +811,185 @@ class QueryCache:
             db.close()
     
     @staticmethod
-    @cached("query", ttl=300)  # 5 минут для новостей
+    @cached("query_investor_filters", ttl=1800, tags=('investors',), stale_ttl=1800)
+    def get_investor_filters():
+        """Кешированные значения фильтров списка инвесторов с количествами (из индекса фасетов)"""
+        from services.facets import facet_index
+        
+        # focus и stages уже разбиты по запятым при индексации
+        facets = facet_index.get('investor')
+        return {
+            'countries': list(facets['country']),
+            'focus_list': list(facets['focus']),
+            'stages_list': list(facets['stages']),
+            'counts': facets
+        }
+    
+    @staticmethod
+    @cached("query_events", ttl=300, tags=('events',), codec=SnapshotCodec, stale_ttl=300)
+    def get_events_with_filters(q: str = "", date: str = "", format_: str = "", country: str = ""):
+        """Кешированный запрос мероприятий с фильтрами"""
+        from db import SessionLocal
+        from models import Event
+        
+        db = SessionLocal()
+        try:
+            query = db.query(Event)
+            
+            if q:
+                query = query.filter(Event.title.ilike(f'%{q}%'))
+            if date:
+                try:
+                    filter_date = datetime.strptime(date, '%Y-%m-%d').date()
+                    query = query.filter(Event.date >= filter_date, Event.date < filter_date + timedelta(days=1))
+                except ValueError:
+                    pass
+            if format_:
+                query = query.filter(Event.format == format_)
+            if country:
+                query = query.filter(Event.country == country)
+            
+            return snapshot_all(query.order_by(Event.date.asc()).all(), EventRow)
+        finally:
+            db.close()
+    
+    @staticmethod
+    @cached("query_event_filters", ttl=1800, tags=('events',), stale_ttl=1800)
+    def get_event_filters():
+        """Кешированные значения фильтров списка мероприятий"""
+        from db import SessionLocal
+        from models import Event, Country
+        
+        db = SessionLocal()
+        try:
+            return {
+                'formats': [f[0] for f in db.query(Event.format).distinct().order_by(Event.format) if f[0]],
+                'countries': [c[0] for c in db.query(Country.name).filter(Country.status == 'active').order_by(Country.name)]
+            }
+        finally:
+            db.close()
+    
+    @staticmethod
+    @cached("query_jobs", ttl=600, tags=('jobs', 'companies'), codec=SnapshotCodec, stale_ttl=600)
+    def get_jobs_with_filters(q: str = "", city: str = "", job_type: str = "", company: str = ""):
+        """Кешированный запрос активных вакансий с фильтрами (тот же набор, что у фасетов)"""
+        from db import SessionLocal
+        from models import Job
+        from sqlalchemy.orm import joinedload
+        
+        db = SessionLocal()
+        try:
+            query = db.query(Job).options(joinedload(Job.company)).filter(Job.status == 'active')
+            
+            if q:
+                query = query.filter(Job.title.ilike(f'%{q}%'))
+            if city:
+                query = query.filter(Job.city == city)
+            if job_type:
+                query = query.filter(Job.job_type == job_type)
+            if company:
+                query = query.filter(Job.company_id == company)
+            
+            return snapshot_all(query.order_by(Job.id.desc()).all(), JobRow)
+        finally:
+            db.close()
+    
+    @staticmethod
+    @cached("query_job_filters", ttl=1800, tags=('jobs', 'companies'), codec=SnapshotCodec, stale_ttl=1800)
+    def get_job_filters():
+        """Кешированные значения фильтров списка вакансий с количествами (из индекса фасетов)"""
+        from db import SessionLocal
+        from models import Company
+        from services.facets import facet_index
+        
+        facets = facet_index.get('job')
+        company_counts = {int(company_id): count for company_id, count in facets['company_id'].items()}
+        
+        db = SessionLocal()
+        try:
+            # Только компании, у которых есть активные вакансии
+            companies = [
+                CompanyRefRow(*row)
+                for row in db.query(Company.id, Company.name, Company.logo).filter(
+                    Company.id.in_(list(company_counts))
+                ).order_by(Company.name)
+            ] if company_counts else []
+        finally:
+            db.close()
+        
+        return {
+            'cities': list(facets['city']),
+            'job_types': list(facets['job_type']),
+            'companies': companies,
+            'counts': {'city': facets['city'], 'job_type': facets['job_type'], 'company': company_counts}
+        }
+    
+    @staticmethod
+    @cached(
+        "query_homepage", ttl=120,
+        tags=('companies', 'investors', 'news', 'podcasts', 'jobs', 'events'),
+        codec=SnapshotCodec, stale_ttl=600
+    )
+    def get_homepage():
+        """Кешированные блоки главной страницы"""
+        from db import SessionLocal
+        from models import Company, Investor, News, Podcast, Job, Event
+        from sqlalchemy.orm import joinedload, selectinload
+        
+        db = SessionLocal()
+        try:
+            return {
+                'companies': snapshot_all(
+                    db.query(Company).options(selectinload(Company.team)).filter(Company.status == 'active').order_by(Company.id.desc()).limit(20),
+                    CompanyRow
+                ),
+                'investors': snapshot_all(
+                    db.query(Investor).filter(Investor.status == 'active').order_by(Investor.id.desc()).limit(20),
+                    InvestorRow
+                ),
+                'news': snapshot_all(
+                    db.query(News).options(joinedload(News.author)).filter(News.status == 'active').order_by(News.date.desc()).limit(10),
+                    NewsRow
+                ),
+                'podcasts': snapshot_all(
+                    db.query(Podcast).filter(Podcast.status == 'active').order_by(Podcast.date.desc()).limit(10),
+                    PodcastRow
+                ),
+                'jobs': snapshot_all(
+                    db.query(Job).options(joinedload(Job.company)).filter(Job.status == 'active').order_by(Job.id.desc()).limit(10),
+                    JobRow
+                ),
+                'events': snapshot_all(
+                    db.query(Event).filter(Event.status == 'active').order_by(Event.date.desc()).limit(10),
+                    EventRow
+                )
+            }
+        finally:
+            db.close()
+    
+    @staticmethod
+    @cached("query_news", ttl=300, tags=('news',), codec=SnapshotCodec)  # 5 минут для новостей
     def get_latest_news(limit: int = 10):
         """Кешированный запрос последних новостей"""
         from db import SessionLocal
         from models import News
+        from sqlalchemy.orm import joinedload
         
         db = SessionLocal()
         try:
-            news = db.query(News).filter(News.status == 'active').order_by(News.created_at.desc()).limit(limit).all()
-            return news
+            news = db.query(News).options(joinedload(News.author)).filter(News.status == 'active').order_by(News.created_at.desc()).limit(limit).all()
+            return snapshot_all(news, NewsRow)
         finally:
             db.close()
     
     @staticmethod
-    @cached("query", ttl=1800)  # 30 минут для статистики
+    @cached("query_analytics", ttl=1800, tags=('analytics', 'news'))  # 30 минут для статистики
     def get_analytics_stats(year: Optional[int] = None):
-        """Кешированная статистика"""
+        """Кешированная статистика: сделки из агрегатов deal_rollup, компании из фасетов"""
         from db import SessionLocal
         from models import Company, Investor, News, Job
-        from sqlalchemy import func
-        from datetime import datetime
+        from services.analytics import analytics_service
+        from services.facets import facet_index
         
         db = SessionLocal()
         try:
@@ -257,25 +999,29 @@ class QueryCache:
             total_news = db.query(News).filter(News.status == 'active').count()
             total_jobs = db.query(Job).filter(Job.status == 'active').count()
             
-            # Статистика по странам
-            companies_by_country = db.query(
-                Company.country, 
-                func.count(Company.id)
-            ).filter(Company.status == 'active').group_by(Company.country).all()
+            # Распределения компаний - из фасетов, без GROUP BY по таблице
+            company_facets = facet_index.get('company', db)
             
-            # Статистика по стадиям
-            companies_by_stage = db.query(
-                Company.stage, 
-                func.count(Company.id)
-            ).filter(Company.status == 'active').group_by(Company.stage).all()
+            # Сделки - только агрегаты
+            years = analytics_service.years(db)
+            filters = {'year': year} if year else {}
+            totals = analytics_service.summary(filters=filters, db=db)
             
             return {
                 'total_companies': total_companies,
                 'total_investors': total_investors,
                 'total_news': total_news,
                 'total_jobs': total_jobs,
-                'companies_by_country': dict(companies_by_country),
-                'companies_by_stage': dict(companies_by_stage)
+                'companies_by_country': company_facets['country'],
+                'companies_by_stage': company_facets['stage'],
+                'years': years,
+                'year': year,
+                'deals': totals[0] if totals else {'count': 0, 'sum': 0},
+                'deals_by_country': analytics_service.summary('country', filters, db),
+                'deals_by_stage': analytics_service.summary('stage', filters, db),
+                'deals_by_industry': analytics_service.summary('industry', filters, db),
+                'deals_by_type': analytics_service.summary('deal_type', filters, db),
+                'deals_by_month': analytics_service.summary('month', filters, db) if year else analytics_service.summary('year', filters, db),
             }
         finally:
             db.close()
@@ -286,21 +1032,19 @@ class CacheInvalidator:
     @staticmethod
     def invalidate_companies():
         """Инвалидирует кеш компаний"""
-        cache_manager.clear("query_companies")
-        cache_manager.clear("query_analytics")
+        cache_manager.invalidate_tags('companies', 'analytics')
     
     @staticmethod
     def invalidate_investors():
         """Инвалидирует кеш инвесторов"""
-        cache_manager.clear("query_investors")
-        cache_manager.clear("query_analytics")
+        cache_manager.invalidate_tags('investors', 'analytics')
     
     @staticmethod
     def invalidate_news():
         """Инвалидирует кеш новостей"""
-        cache_manager.clear("query_news")
+        cache_manager.invalidate_tags('news')
     
     @staticmethod
     def invalidate_all():
         """Инвалидирует весь кеш"""
-        cache_manager.clear() 
\ No newline at end of file
+        cache_manager.clear()
@@ -0,0 +1,420 @@
+"""
+Граф соинвестиций: кто с кем инвестирует и какие инвесторы активны в стране/стадии компании.
+
+Раунд - активные сделки и записи портфеля одной компании за одну дату (сделка без даты - отдельный
+раунд). Участники раунда - инвесторы сделки (deal_investor) и записей портфеля. Ребро между двумя
+инвесторами хранит число общих раундов и их суммарный объем.
+
+Таблицы coinvest_round, coinvest_round_member и coinvest_edge обновляются в транзакции записи:
+после flush пересчитываются только затронутые раунды, и к ребрам применяется разница старого и нового
+состава. Страницы читают граф из памяти воркера - компактные массивы смежности (CSR), где соседи
+каждого инвестора отсортированы по весу, так что top-k - это срез. Снимок перечитывается, когда
+меняется поколение тегов таблиц сделок, портфеля, инвесторов или компаний.
+"""
+
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import date as date_type
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, event, func, inspect, or_, select, text
+from sqlalchemy.orm import object_session
+
+from db import engine, SessionLocal
+from models import (
+    Company, Deal, Investor, PortfolioEntry, CoinvestRound, CoinvestRoundMember, CoinvestEdge, deal_investor
+)
+from .backfill import run_backfill
+from .cache import cache_manager, table_cache_tag
+from .history import previous_value, track_previous
+
+# Записи в эти таблицы меняют граф или панели активных инвесторов
+GRAPH_TAGS = tuple(table_cache_tag(name) for name in ('deal', 'portfolio_entry', 'investor', 'company'))
+
+# Сколько активных инвесторов хранится на страну/стадию
+ACTIVE_TOP_K = 20
+
+def round_key(company_id: Optional[int], date, deal_id: Optional[int] = None) -> str:
+    """Ключ раунда: компания и дата; сделка без даты или компании - отдельный раунд"""
+    if company_id and date:
+        return f"c{company_id}:{date.isoformat()}"
+    return f"d{deal_id}"
+
+def build_rounds(deals: Iterable[tuple], links: Iterable[tuple], entries: Iterable[tuple]) -> Dict[str, tuple]:
+    """Раунды из строк (id, company_id, date, amount) сделок, (deal_id, investor_id) и
+    (investor_id, company_id, date, amount) записей портфеля: {ключ: (company_id, объем, участники)}.
+
+    Объем раунда - сумма сделок; если сделок нет, сумма записей портфеля.
+    """
+    deal_keys = {}
+    rounds = defaultdict(lambda: [None, 0.0, 0.0, False, set()])
+    for deal_id, company_id, date, amount in deals:
+        key = round_key(company_id, date, deal_id)
+        deal_keys[deal_id] = key
+        state = rounds[key]
+        state[0] = company_id
+        state[1] += amount or 0
+        state[3] = True
+    for deal_id, investor_id in links:
+        if deal_id in deal_keys:
+            rounds[deal_keys[deal_id]][4].add(investor_id)
+    for investor_id, company_id, date, amount in entries:
+        state = rounds[round_key(company_id, date)]
+        state[0] = company_id
+        state[2] += amount or 0
+        state[4].add(investor_id)
+    return {
+        key: (company_id, deal_amount if has_deal else entries_amount, frozenset(members))
+        for key, (company_id, deal_amount, entries_amount, has_deal, members) in rounds.items()
+        if members
+    }
+
+def edge_delta(members: Iterable[int], amount: float, sign: int, rounds: Counter, amounts: Counter) -> None:
+    """Добавляет (sign=1) или вычитает (sign=-1) вклад раунда в ребра всех пар участников"""
+    members = sorted(members)
+    for investor_id in members:
+        for peer_id in members:
+            if investor_id != peer_id:
+                rounds[(investor_id, peer_id)] += sign
+                amounts[(investor_id, peer_id)] += sign * amount
+
+_ACTIVE_DEAL = or_(Deal.status == 'active', Deal.status.is_(None))
+
+class GraphSnapshot:
+    """Граф в памяти: смежность в массивах CSR и активные инвесторы по стране/стадии"""
+
+    def __init__(self, edges: Iterable[tuple] = (), activity: Iterable[tuple] = ()):
+        # Ребра отсортированы по investor_id, затем по весу: соседи строки - срез массивов
+        self.ids = array('q')
+        self.offsets = array('q', [0])
+        self.peers = array('q')
+        self.rounds = array('q')
+        self.amounts = array('d')
+        for investor_id, peer_id, rounds, amount in edges:
+            if not self.ids or self.ids[-1] != investor_id:
+                if self.ids:
+                    self.offsets.append(len(self.peers))
+                self.ids.append(investor_id)
+            self.peers.append(peer_id)
+            self.rounds.append(rounds)
+            self.amounts.append(amount)
+        if self.ids:
+            self.offsets.append(len(self.peers))
+
+        by_pair, by_country, by_stage = Counter(), Counter(), Counter()
+        for investor_id, country, stage, rounds in activity:
+            by_pair[(country, stage, investor_id)] += rounds
+            by_country[(country, investor_id)] += rounds
+            by_stage[(stage, investor_id)] += rounds
+        self.active = {
+            'pair': self._top(((country, stage), investor_id, count) for (country, stage, investor_id), count in by_pair.items()),
+            'country': self._top((country, investor_id, count) for (country, investor_id), count in by_country.items()),
+            'stage': self._top((stage, investor_id, count) for (stage, investor_id), count in by_stage.items()),
+        }
+
+    @staticmethod
+    def _top(rows: Iterable[tuple]) -> Dict[object, List[Tuple[int, int]]]:
+        groups = defaultdict(list)
+        for key, investor_id, count in rows:
+            if key is not None and key != (None, None):
+                groups[key].append((investor_id, count))
+        return {
+            key: sorted(items, key=lambda item: (-item[1], item[0]))[:ACTIVE_TOP_K]
+            for key, items in groups.items()
+        }
+
+    def neighbours(self, investor_id: int, limit: int = 10) -> List[Tuple[int, int, float]]:
+        """Top-k соинвесторов: [(peer_id, общих раундов, объем)]"""
+        index = bisect_left(self.ids, investor_id)
+        if index == len(self.ids) or self.ids[index] != investor_id:
+            return []
+        start = self.offsets[index]
+        end = min(self.offsets[index + 1], start + limit)
+        return [(self.peers[i], self.rounds[i], self.amounts[i]) for i in range(start, end)]
+
+    def active_investors(self, country: Optional[str], stage: Optional[str], limit: int = 10,
+                         exclude: Iterable[int] = ()) -> List[Tuple[int, int]]:
+        """Инвесторы, активные в стране и стадии: сначала совпадение по обоим, затем по одному"""
+        seen = set(exclude)
+        result = []
+        for group, key in (('pair', (country, stage)), ('country', country), ('stage', stage)):
+            for investor_id, count in self.active[group].get(key, ()):
+                if len(result) >= limit:
+                    return result
+                if investor_id not in seen:
+                    seen.add(investor_id)
+                    result.append((investor_id, count))
+        return result
+
+class CoInvestmentGraph:
+    """Граф соинвестиций: инкрементальное обновление таблиц и снимок в памяти"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+        self._snapshot = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def ensure_schema(self) -> None:
+        """Создает таблицы графа, если их нет"""
+        with self.engine.begin() as connection:
+            for model in (CoinvestRound, CoinvestRoundMember, CoinvestEdge):
+                model.__table__.create(connection, checkfirst=True)
+
+    # --- Запись ---
+
+    def _current_rounds(self, connection, keys: Set[str]) -> Dict[str, tuple]:
+        """Текущее состояние раундов по исходным таблицам"""
+        deal_ids, company_dates = [], []
+        for key in keys:
+            if key.startswith('d'):
+                deal_ids.append(int(key[1:]))
+            else:
+                company_id, date = key[1:].split(':', 1)
+                company_dates.append((int(company_id), date))
+        deal_conditions = [Deal.id.in_(deal_ids)] if deal_ids else []
+        entry_conditions = []
+        for company_id, date in company_dates:
+            date_value = date_type.fromisoformat(date)
+            deal_conditions.append(and_(Deal.company_id == company_id, Deal.date == date_value))
+            entry_conditions.append(and_(PortfolioEntry.company_id == company_id, PortfolioEntry.date == date_value))
+        deals = connection.execute(
+            select(Deal.id, Deal.company_id, Deal.date, Deal.amount).where(_ACTIVE_DEAL, or_(*deal_conditions))
+        ).all() if deal_conditions else []
+        links = connection.execute(
+            select(deal_investor.c.deal_id, deal_investor.c.investor_id)
+            .where(deal_investor.c.deal_id.in_([row[0] for row in deals]))
+        ).all() if deals else []
+        entries = connection.execute(
+            select(PortfolioEntry.investor_id, PortfolioEntry.company_id, PortfolioEntry.date, PortfolioEntry.amount)
+            .where(or_(*entry_conditions))
+        ).all() if entry_conditions else []
+        rounds = build_rounds(deals, links, entries)
+        return {key: rounds[key] for key in keys if key in rounds}
+
+    def _stored_rounds(self, connection, keys: Set[str]) -> Dict[str, tuple]:
+        """Состояние раундов на момент прошлого пересчета"""
+        stored = {
+            key: (company_id, amount, set())
+            for key, company_id, amount in connection.execute(
+                select(CoinvestRound.round_key, CoinvestRound.company_id, CoinvestRound.amount)
+                .where(CoinvestRound.round_key.in_(list(keys)))
+            )
+        }
+        for key, investor_id in connection.execute(
+            select(CoinvestRoundMember.round_key, CoinvestRoundMember.investor_id)
+            .where(CoinvestRoundMember.round_key.in_(list(keys)))
+        ):
+            if key in stored:
+                stored[key][2].add(investor_id)
+        return stored
+
+    def apply_edges(self, connection, rounds: Counter, amounts: Counter) -> None:
+        """Применяет изменение ребер; INSERT ... ON CONFLICT есть и в SQLite, и в PostgreSQL"""
+        changes = [
+            {"investor_id": investor_id, "peer_id": peer_id, "rounds": count, "amount": amounts[(investor_id, peer_id)]}
+            for (investor_id, peer_id), count in rounds.items()
+            if count or amounts[(investor_id, peer_id)]
+        ]
+        if not changes:
+            return
+        connection.execute(text(
+            "INSERT INTO coinvest_edge (investor_id, peer_id, rounds, amount) "
+            "VALUES (:investor_id, :peer_id, :rounds, :amount) "
+            "ON CONFLICT (investor_id, peer_id) DO UPDATE SET "
+            "rounds = coinvest_edge.rounds + excluded.rounds, amount = coinvest_edge.amount + excluded.amount"
+        ), changes)
+        investor_ids = sorted({change["investor_id"] for change in changes})
+        connection.execute(CoinvestEdge.__table__.delete().where(
+            CoinvestEdge.investor_id.in_(investor_ids), CoinvestEdge.rounds <= 0
+        ))
+
+    def refresh_rounds(self, connection, keys: Set[str]) -> int:
+        """Пересчитывает раунды и применяет к ребрам разницу составов; возвращает число измененных раундов"""
+        if not keys:
+            return 0
+        current = self._current_rounds(connection, keys)
+        stored = self._stored_rounds(connection, keys)
+        rounds, amounts = Counter(), Counter()
+        changed = []
+        for key in keys:
+            old = stored.get(key)
+            new = current.get(key)
+            if old and new and old[1] == new[1] and old[2] == new[2] and old[0] == new[0]:
+                continue
+            if old:
+                edge_delta(old[2], old[1], -1, rounds, amounts)
+            if new:
+                edge_delta(new[2], new[1], 1, rounds, amounts)
+            changed.append(key)
+        if not changed:
+            return 0
+        self.apply_edges(connection, rounds, amounts)
+        connection.execute(CoinvestRoundMember.__table__.delete().where(CoinvestRoundMember.round_key.in_(changed)))
+        connection.execute(CoinvestRound.__table__.delete().where(CoinvestRound.round_key.in_(changed)))
+        self._store_rounds(connection, {key: current[key] for key in changed if key in current})
+        return len(changed)
+
+    def _store_rounds(self, connection, rounds: Dict[str, tuple]) -> None:
+        if not rounds:
+            return
+        connection.execute(CoinvestRound.__table__.insert(), [
+            {"round_key": key, "company_id": company_id, "amount": amount}
+            for key, (company_id, amount, _) in rounds.items()
+        ])
+        connection.execute(CoinvestRoundMember.__table__.insert(), [
+            {"round_key": key, "investor_id": investor_id}
+            for key, (_, _, members) in rounds.items() for investor_id in members
+        ])
+
+    def investor_round_keys(self, connection, investor_ids: Set[int]) -> Set[str]:
+        """Раунды, где инвестор был или стал участником (после переименования, создания, удаления)"""
+        keys = set(connection.execute(
+            select(CoinvestRoundMember.round_key).where(CoinvestRoundMember.investor_id.in_(list(investor_ids)))
+        ).scalars())
+        for deal_id, company_id, date in connection.execute(
+            select(Deal.id, Deal.company_id, Deal.date)
+            .join(deal_investor, deal_investor.c.deal_id == Deal.id)
+            .where(deal_investor.c.investor_id.in_(list(investor_ids)))
+        ):
+            keys.add(round_key(company_id, date, deal_id))
+        return keys
+
+    def rebuild(self) -> Dict[str, int]:
+        """Полностью пересчитывает граф по сделкам и портфелям"""
+        with self.engine.begin() as connection:
+            deals = connection.execute(
+                select(Deal.id, Deal.company_id, Deal.date, Deal.amount).where(_ACTIVE_DEAL)
+            ).all()
+            links = connection.execute(select(deal_investor.c.deal_id, deal_investor.c.investor_id)).all()
+            entries = connection.execute(
+                select(PortfolioEntry.investor_id, PortfolioEntry.company_id, PortfolioEntry.date, PortfolioEntry.amount)
+            ).all()
+            rounds = build_rounds(deals, links, entries)
+
+            for model in (CoinvestEdge, CoinvestRoundMember, CoinvestRound):
+                connection.execute(model.__table__.delete())
+            self._store_rounds(connection, rounds)
+            edge_rounds, edge_amounts = Counter(), Counter()
+            for _, amount, members in rounds.values():
+                edge_delta(members, amount, 1, edge_rounds, edge_amounts)
+            self.apply_edges(connection, edge_rounds, edge_amounts)
+        self._version = None
+        return {'rounds': len(rounds), 'edges': len(edge_rounds)}
+
+    def rebuild_if_empty(self) -> None:
+        """Заполняет граф при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'coinvest',
+            lambda connection: connection.execute(select(CoinvestRound.round_key).limit(1)).first() is None,
+            self.rebuild
+        )
+        if counts and counts['rounds']:
+            print(f"Граф соинвестиций построен: {counts}")
+
+    # --- Чтение ---
+
+    def load(self) -> GraphSnapshot:
+        """Читает граф из таблиц в снимок"""
+        with self.engine.connect() as connection:
+            edges = connection.execute(
+                select(CoinvestEdge.investor_id, CoinvestEdge.peer_id, CoinvestEdge.rounds, CoinvestEdge.amount)
+                .order_by(CoinvestEdge.investor_id, CoinvestEdge.rounds.desc(), CoinvestEdge.amount.desc(), CoinvestEdge.peer_id)
+            )
+            activity = connection.execute(
+                select(CoinvestRoundMember.investor_id, Company.country, Company.stage, func.count())
+                .join(CoinvestRound, CoinvestRound.round_key == CoinvestRoundMember.round_key)
+                .join(Company, Company.id == CoinvestRound.company_id)
+                .where(Company.status == 'active')
+                .group_by(CoinvestRoundMember.investor_id, Company.country, Company.stage)
+            )
+            return GraphSnapshot(edges, activity)
+
+    def snapshot(self) -> GraphSnapshot:
+        """Снимок графа в памяти; перечитывается после записи в сделки, портфели, инвесторов или компании"""
+        version = cache_manager.get_tags_version(GRAPH_TAGS)
+        snapshot = self._snapshot
+        if snapshot is not None and version == self._version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or version != self._version:
+                self._snapshot = self.load()
+                self._version = version
+            return self._snapshot
+
+    def co_investors(self, db, investor_id: int, limit: int = 8) -> List[dict]:
+        """Соинвесторы для страницы инвестора: [{'investor', 'rounds', 'amount'}]"""
+        neighbours = self.snapshot().neighbours(investor_id, limit)
+        investors = _active_investors_by_id(db, [peer_id for peer_id, _, _ in neighbours])
+        return [
+            {'investor': investors[peer_id], 'rounds': rounds, 'amount': amount}
+            for peer_id, rounds, amount in neighbours if peer_id in investors
+        ]
+
+    def active_investors(self, db, country: Optional[str], stage: Optional[str], limit: int = 8,
+                         exclude: Iterable[int] = ()) -> List[dict]:
+        """Инвесторы, активные в стране/стадии компании: [{'investor', 'rounds'}]"""
+        active = self.snapshot().active_investors(country, stage, limit, exclude)
+        investors = _active_investors_by_id(db, [investor_id for investor_id, _ in active])
+        return [
+            {'investor': investors[investor_id], 'rounds': rounds}
+            for investor_id, rounds in active if investor_id in investors
+        ]
+
+    def install_hooks(self, session_factory=SessionLocal) -> None:
+        """Подписывает граф на изменения сделок, портфелей и инвесторов"""
+        if event.contains(session_factory, 'after_flush', _after_flush):
+            return
+        for model in (Deal, PortfolioEntry):
+            event.listen(model, 'after_insert', _round_changed)
+            event.listen(model, 'after_update', _round_changed)
+            event.listen(model, 'after_delete', _round_changed)
+            # Старые компания и дата нужны, чтобы пересчитать раунд, из которого запись ушла
+            for field in ('company_id', 'date'):
+                track_previous(getattr(model, field))
+        # Создание, переименование и удаление инвестора меняют связи сделок с ним
+        event.listen(Investor, 'after_insert', _investor_changed)
+        event.listen(Investor, 'after_update', _investor_renamed)
+        event.listen(Investor, 'after_delete', _investor_changed)
+        event.listen(session_factory, 'after_flush', _after_flush)
+
+def _active_investors_by_id(db, investor_ids: List[int]) -> Dict[int, Investor]:
+    if not investor_ids:
+        return {}
+    rows = db.query(Investor).filter(Investor.id.in_(investor_ids), Investor.status == 'active').all()
+    return {investor.id: investor for investor in rows}
+
+def _round_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    keys = session.info.setdefault('coinvest_rounds', set())
+    deal_id = target.id if isinstance(target, Deal) else None
+    state = inspect(target)
+    keys.add(round_key(target.company_id, target.date, deal_id))
+    keys.add(round_key(previous_value(state, 'company_id'), previous_value(state, 'date'), deal_id))
+
+def _investor_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('coinvest_investors', set()).add(target.id)
+
+def _investor_renamed(mapper, connection, target):
+    if inspect(target).attrs.name.history.has_changes():
+        _investor_changed(mapper, connection, target)
+
+def _after_flush(session, flush_context):
+    keys = session.info.pop('coinvest_rounds', set())
+    investor_ids = session.info.pop('coinvest_investors', set())
+    if not keys and not investor_ids:
+        return
+    connection = session.connection()
+    if investor_ids:
+        # Связи deal_investor к этому моменту уже пересобраны (services/deals.py)
+        keys |= coinvest_graph.investor_round_keys(connection, investor_ids)
+    coinvest_graph.refresh_rounds(connection, keys)
+
+# Глобальный экземпляр графа соинвестиций
+coinvest_graph = CoInvestmentGraph()
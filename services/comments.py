@@ -1,8 +1,98 @@
-from db import SessionLocal
-from models import Comment, User
+from db import SessionLocal, engine
+from models import Comment, CommentCount, User
 from datetime import datetime
-from typing import Optional, List, Dict
-from sqlalchemy import and_
+from typing import Optional, List, Dict, Iterable, Tuple
+from sqlalchemy import and_, func, literal, select, text
+from sqlalchemy.orm import joinedload
+
+from .backfill import run_backfill
+from .pagination import DatabasePagination
+
+# Глубина вложенности ответов, загружаемых вместе с корневыми комментариями
+COMMENT_THREAD_DEPTH = 5
+
+class CommentThread:
+    """Комментарий с загруженным автором и деревом ответов"""
+    __slots__ = ('comment', 'depth', 'replies')
+
+    def __init__(self, comment: Comment, depth: int = 0):
+        self.comment = comment
+        self.depth = depth
+        self.replies: List['CommentThread'] = []
+
+class CommentCounter:
+    """Количество активных комментариев по сущностям (таблица comment_count)"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу счетчиков, если ее нет"""
+        CommentCount.__table__.create(self.engine, checkfirst=True)
+
+    def adjust(self, db, entity_type: str, entity_id: int, delta: int) -> None:
+        """Меняет счетчик в транзакции сессии db - вместе с записью комментария"""
+        db.execute(
+            text("INSERT INTO comment_count (entity_type, entity_id, count) VALUES (:entity_type, :entity_id, :delta) "
+                 "ON CONFLICT (entity_type, entity_id) DO UPDATE SET count = comment_count.count + excluded.count"),
+            {"entity_type": entity_type, "entity_id": entity_id, "delta": delta}
+        )
+
+    def counts(self, entity_type: str, ids: Iterable[int]) -> Dict[int, int]:
+        """Количества комментариев для страницы сущностей одним запросом (0 - без комментариев)"""
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        with self.engine.connect() as connection:
+            stored = dict(connection.execute(
+                select(CommentCount.entity_id, CommentCount.count)
+                .where(CommentCount.entity_type == entity_type, CommentCount.entity_id.in_(ids))
+            ).all())
+        return {entity_id: stored.get(entity_id, 0) for entity_id in ids}
+
+    def count(self, entity_type: str, entity_id: int) -> int:
+        """Количество комментариев одной сущности"""
+        return self.counts(entity_type, [entity_id])[entity_id]
+
+    def reconcile(self) -> int:
+        """Сверяет счетчики с таблицей comment и исправляет расхождения; возвращает число исправленных"""
+        with self.engine.begin() as connection:
+            actual = {
+                (entity_type, entity_id): count
+                for entity_type, entity_id, count in connection.execute(
+                    select(Comment.entity_type, Comment.entity_id, func.count())
+                    .where(Comment.status == 'active')
+                    .group_by(Comment.entity_type, Comment.entity_id)
+                )
+            }
+            stored = {
+                (entity_type, entity_id): count
+                for entity_type, entity_id, count in connection.execute(
+                    select(CommentCount.entity_type, CommentCount.entity_id, CommentCount.count)
+                )
+            }
+            drifted = [key for key in set(actual) | set(stored) if actual.get(key, 0) != stored.get(key, 0)]
+            if drifted:
+                # Значение пересчитывается в самом запросе - параллельный комментарий между чтением и записью не теряется
+                connection.execute(
+                    text("INSERT INTO comment_count (entity_type, entity_id, count) VALUES (:entity_type, :entity_id, "
+                         "(SELECT COUNT(*) FROM comment WHERE entity_type = :entity_type AND entity_id = :entity_id "
+                         "AND status = 'active')) "
+                         "ON CONFLICT (entity_type, entity_id) DO UPDATE SET count = excluded.count"),
+                    [{"entity_type": entity_type, "entity_id": entity_id} for entity_type, entity_id in sorted(drifted)]
+                )
+        return len(drifted)
+
+    def reconcile_if_empty(self) -> None:
+        """Первичное заполнение счетчиков на существующей базе (один воркер, под блокировкой)"""
+        run_backfill(
+            self.engine, 'comment_count',
+            lambda connection: connection.execute(select(CommentCount.entity_id).limit(1)).first() is None,
+            self.reconcile
+        )
+
+# Глобальный экземпляр счетчиков комментариев
+comment_counter = CommentCounter()
 
 class CommentService:
     """Сервис для работы с комментариями"""
@@ -26,6 +116,7 @@ class CommentService:
                 parent_id=parent_id
             )
             db.add(comment)
+            comment_counter.adjust(db, entity_type, entity_id, 1)
             db.commit()
             db.refresh(comment)
             return comment
@@ -67,6 +158,59 @@ class CommentService:
         finally:
             db.close()
     
+    @staticmethod
+    def get_threads(
+        entity_type: str,
+        entity_id: int,
+        limit: int = 50,
+        offset: int = 0,
+        after: Optional[str] = None,
+        max_depth: int = COMMENT_THREAD_DEPTH
+    ) -> Tuple[List[CommentThread], Optional[str]]:
+        """Страница корневых комментариев (новые первыми) с ответами до max_depth и курсор следующей.
+
+        Два запроса независимо от числа комментариев: корни с авторами и все ответы с авторами
+        рекурсивным CTE по parent_id. Ответы внутри ветки - по времени создания.
+        """
+        db = SessionLocal()
+        try:
+            query = db.query(Comment).options(joinedload(Comment.user)).filter(
+                and_(
+                    Comment.entity_type == entity_type,
+                    Comment.entity_id == entity_id,
+                    Comment.status == 'active',
+                    Comment.parent_id.is_(None)
+                )
+            )
+            roots, next_cursor = DatabasePagination.paginate_after(
+                query, f'comments:{entity_type}:{entity_id}', Comment.created_at, Comment.id,
+                after=after, per_page=limit, descending=True, offset=offset
+            )
+            nodes = {root.id: CommentThread(root) for root in roots}
+            if roots and max_depth > 0:
+                tree = select(Comment.id, literal(1).label('depth')).where(
+                    Comment.parent_id.in_(list(nodes)), Comment.status == 'active'
+                ).cte('comment_tree', recursive=True)
+                tree = tree.union_all(
+                    select(Comment.id, tree.c.depth + 1)
+                    .join(tree, Comment.parent_id == tree.c.id)
+                    .where(Comment.status == 'active', tree.c.depth < max_depth)
+                )
+                replies = (
+                    db.query(Comment, tree.c.depth)
+                    .options(joinedload(Comment.user))
+                    .join(tree, Comment.id == tree.c.id)
+                    .order_by(tree.c.depth, Comment.created_at.asc(), Comment.id.asc())
+                    .all()
+                )
+                # По уровням: родитель уже в nodes, когда до него доходит ответ
+                for reply, depth in replies:
+                    node = nodes[reply.id] = CommentThread(reply, depth)
+                    nodes[reply.parent_id].replies.append(node)
+            return [nodes[root.id] for root in roots], next_cursor
+        finally:
+            db.close()
+    
     @staticmethod
     def update_comment(comment_id: int, user_id: int, content: str) -> bool:
         """Обновляет комментарий"""
@@ -99,7 +243,13 @@ class CommentService:
             
             comment = query.first()
             if comment:
-                comment.status = 'deleted'
+                # Условный UPDATE: при повторном или параллельном удалении счетчик уменьшается один раз
+                deleted = db.query(Comment).filter(
+                    Comment.id == comment.id,
+                    Comment.status == 'active'
+                ).update({Comment.status: 'deleted'}, synchronize_session=False)
+                if deleted:
+                    comment_counter.adjust(db, comment.entity_type, comment.entity_id, -1)
                 db.commit()
                 return True
             return False
@@ -108,18 +258,8 @@ class CommentService:
     
     @staticmethod
     def get_comment_count(entity_type: str, entity_id: int) -> int:
-        """Получает количество комментариев для сущности"""
-        db = SessionLocal()
-        try:
-            return db.query(Comment).filter(
-                and_(
-                    Comment.entity_type == entity_type,
-                    Comment.entity_id == entity_id,
-                    Comment.status == 'active'
-                )
-            ).count()
-        finally:
-            db.close()
+        """Получает количество комментариев для сущности (из счетчика comment_count)"""
+        return comment_counter.count(entity_type, entity_id)
     
     @staticmethod
     def get_user_comments(user_id: int, limit: int = 20) -> List[Comment]:
@@ -0,0 +1,171 @@
+"""
+Количества записей для пагинации без COUNT(*) на каждый просмотр страницы.
+
+Точные количества кешируются по нормализованному набору фильтров и инвалидируются тегом
+таблицы при коммите записи в нее. Для списков без фильтров есть приблизительный режим:
+на PostgreSQL - оценка планировщика (pg_class.reltuples), на SQLite - счетчик строк,
+который ведется в той же транзакции, что и вставка/удаление через ORM. Записи мимо ORM
+(Query.delete(), insert() из core, скрипты, ручной SQL) счетчик не видит, поэтому он сверяется
+с COUNT(*) не реже раза в ROW_COUNT_RECONCILE_TTL секунд.
+"""
+
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event, text
+
+from db import engine, Base
+from models import TableRowCount
+from .cache import cache_manager, table_cache_tag
+
+# Время жизни закешированного количества (инвалидация по записи срабатывает раньше)
+COUNT_TTL = 600
+
+# На маленьких таблицах точный COUNT(*) дешевле, чем неточная оценка планировщика
+ESTIMATE_MIN_ROWS = 10000
+
+# Сверка счетчика строк SQLite с COUNT(*) - не реже, чем раз в столько секунд на воркер
+ROW_COUNT_RECONCILE_TTL = 600
+
+class TotalCount(int):
+    """Количество записей; estimated=True - оценка, а не точный COUNT(*)"""
+
+    def __new__(cls, value: int, estimated: bool = False):
+        count = super().__new__(cls, value)
+        count.estimated = estimated
+        return count
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Tuple[Tuple[str, str], ...]:
+    """Набор фильтров без пустых значений в стабильном порядке - ключ кеша"""
+    normalized = []
+    for name, value in (filters or {}).items():
+        if value is None:
+            continue
+        value = str(value).strip()
+        if value:
+            normalized.append((name, value))
+    return tuple(sorted(normalized))
+
+class CountService:
+    """Сервис количеств записей для пагинации"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+        self._reconciled: Dict[str, float] = {}
+
+    def count(self, query, *models, filters: Optional[Dict[str, Any]] = None,
+              estimate_unfiltered: bool = False) -> TotalCount:
+        """Количество строк запроса.
+
+        models - все таблицы, от которых зависит запрос (первая - основная);
+        filters - значения, которые полностью определяют условия запроса.
+        estimate_unfiltered=True - без фильтров вернуть приблизительное количество строк таблицы.
+        """
+        normalized = normalize_filters(filters)
+        if estimate_unfiltered and not normalized:
+            return self.estimate(models[0])
+
+        tables = tuple(model.__tablename__ for model in models)
+        value = self._cached(tables, normalized, lambda: query.order_by(None).count())
+        return TotalCount(value)
+
+    def estimate(self, model) -> TotalCount:
+        """Приблизительное количество строк таблицы"""
+        table = model.__tablename__
+        if self.engine.dialect.name == 'postgresql':
+            estimate = self._postgres_estimate(table)
+        else:
+            estimate = self._sqlite_counter(table)
+        if estimate is None:
+            return TotalCount(self._exact_table_count(table))
+        return TotalCount(estimate, estimated=True)
+
+    def _cached(self, tables: Tuple[str, ...], normalized, compute) -> int:
+        tags = tuple(table_cache_tag(table) for table in tables)
+        cache_key = cache_manager._get_cache_key(f"count_{'_'.join(tables)}", *normalized)
+        cache_key = f"{cache_key}_g{cache_manager.get_tags_version(tags)}"
+        return cache_manager.get_or_set(cache_key, compute, ttl=COUNT_TTL)
+
+    def _exact_table_count(self, table: str) -> int:
+        def compute():
+            with self.engine.connect() as connection:
+                return connection.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
+        return self._cached((table,), (), compute)
+
+    def _postgres_estimate(self, table: str) -> Optional[int]:
+        """Оценка планировщика; None - таблица маленькая или еще не анализировалась"""
+        with self.engine.connect() as connection:
+            estimate = connection.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+                {"table": f'"{table}"'}
+            ).scalar()
+        if estimate is None or estimate < ESTIMATE_MIN_ROWS:
+            return None
+        return int(estimate)
+
+    def _sqlite_counter(self, table: str) -> int:
+        """Счетчик строк таблицы; при первом обращении и раз в ROW_COUNT_RECONCILE_TTL сверяется с COUNT(*)"""
+        if time.time() - self._reconciled.get(table, 0) > ROW_COUNT_RECONCILE_TTL:
+            self.reconcile([table])
+        with self.engine.begin() as connection:
+            row_count = connection.execute(
+                text("SELECT row_count FROM table_row_count WHERE table_name = :table"), {"table": table}
+            ).scalar()
+            if row_count is None:
+                connection.execute(
+                    text(f'INSERT OR IGNORE INTO table_row_count (table_name, row_count) '
+                         f'SELECT :table, COUNT(*) FROM "{table}"'),
+                    {"table": table}
+                )
+                row_count = connection.execute(
+                    text("SELECT row_count FROM table_row_count WHERE table_name = :table"), {"table": table}
+                ).scalar()
+        return row_count
+
+    def reconcile(self, tables: Optional[Iterable[str]] = None) -> int:
+        """Сверяет отслеживаемые счетчики строк SQLite с COUNT(*) и исправляет расхождения; возвращает число исправленных"""
+        if self.engine.dialect.name == 'postgresql':
+            return 0
+        fixed = 0
+        with self.engine.begin() as connection:
+            stored = dict(connection.execute(text("SELECT table_name, row_count FROM table_row_count")).all())
+            if tables is not None:
+                stored = {table: stored[table] for table in tables if table in stored}
+            for table, row_count in stored.items():
+                actual = connection.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
+                if actual != row_count:
+                    connection.execute(
+                        text("UPDATE table_row_count SET row_count = :actual WHERE table_name = :table"),
+                        {"actual": actual, "table": table}
+                    )
+                    fixed += 1
+        now = time.time()
+        for table in (stored if tables is None else tables):
+            self._reconciled[table] = now
+        return fixed
+
+    def install_hooks(self) -> None:
+        """На SQLite ведет счетчики строк в транзакции вставки/удаления"""
+        if self.engine.dialect.name == 'postgresql':
+            return
+        TableRowCount.__table__.create(self.engine, checkfirst=True)
+        if event.contains(Base, 'after_insert', _increment_row_count):
+            return
+        event.listen(Base, 'after_insert', _increment_row_count, propagate=True)
+        event.listen(Base, 'after_delete', _decrement_row_count, propagate=True)
+
+def _change_row_count(connection, table: str, delta: int) -> None:
+    # Счетчик обновляется, только если таблица уже отслеживается (строка создана в _sqlite_counter)
+    connection.execute(
+        text("UPDATE table_row_count SET row_count = row_count + :delta WHERE table_name = :table"),
+        {"delta": delta, "table": table}
+    )
+
+def _increment_row_count(mapper, connection, target):
+    _change_row_count(connection, mapper.local_table.name, 1)
+
+def _decrement_row_count(mapper, connection, target):
+    _change_row_count(connection, mapper.local_table.name, -1)
+
+# Глобальный экземпляр сервиса количеств
+count_service = CountService()
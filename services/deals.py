@@ -0,0 +1,146 @@
+"""
+Участие инвесторов в сделках.
+
+Поле Deal.investors - свободный текст с именами через запятую (формы add_deal, admin_create_deal,
+admin_edit_deal). Таблица deal_investor хранит разобранные связи сделка -> Investor.id и
+синхронизируется с полем в транзакции записи. Портфель инвестора - один индексированный join
+вместо перебора всех сделок с поиском подстроки ("Alpha" находился в "Alpha Ventures II").
+"""
+
+import re
+from typing import Dict, List
+
+from sqlalchemy import event, func, inspect, or_, select
+from sqlalchemy.orm import joinedload
+
+from db import engine, SessionLocal
+from models import Deal, Investor, deal_investor
+from .backfill import run_backfill
+
+_SPACES = re.compile(r'\s+')
+
+def investor_key(name: str) -> str:
+    """Ключ сравнения имени инвестора: нижний регистр, одиночные пробелы"""
+    return _SPACES.sub(' ', name.strip()).lower()
+
+def parse_investor_names(value: str) -> List[str]:
+    """Имена инвесторов из поля Deal.investors без повторов, в исходном порядке"""
+    if not value:
+        return []
+    names = {}
+    for part in value.split(','):
+        name = _SPACES.sub(' ', part.strip())
+        if name:
+            names.setdefault(name.lower(), name)
+    return list(names.values())
+
+class DealInvestorIndex:
+    """Синхронизация deal_investor и выборки по ней"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу связей, если ее нет"""
+        with self.engine.begin() as connection:
+            deal_investor.create(connection, checkfirst=True)
+
+    def resolve(self, connection, names: List[str]) -> List[int]:
+        """id инвесторов по именам; имена без инвестора в базе пропускаются"""
+        if not names:
+            return []
+        keys = {investor_key(name) for name in names}
+        # lower() в SQLite понимает только ASCII, поэтому точное имя проверяется отдельно
+        rows = connection.execute(
+            select(Investor.id, Investor.name).where(or_(
+                Investor.name.in_(names),
+                func.lower(Investor.name).in_(keys)
+            ))
+        ).all()
+        return sorted({investor_id for investor_id, name in rows if name and investor_key(name) in keys})
+
+    def sync(self, connection, deal_id: int, investors: str) -> None:
+        """Приводит связи сделки к значению поля investors"""
+        connection.execute(deal_investor.delete().where(deal_investor.c.deal_id == deal_id))
+        investor_ids = self.resolve(connection, parse_investor_names(investors))
+        if investor_ids:
+            connection.execute(deal_investor.insert(), [
+                {"deal_id": deal_id, "investor_id": investor_id} for investor_id in investor_ids
+            ])
+
+    def resync_investor(self, connection, investor_id: int, *names: str) -> None:
+        """Пересобирает связи сделок, где инвестор указан по имени или уже связан (создание и переименование)"""
+        conditions = [Deal.id.in_(select(deal_investor.c.deal_id).where(deal_investor.c.investor_id == investor_id))]
+        conditions += [Deal.investors.ilike(f'%{name.strip()}%') for name in names if name and name.strip()]
+        rows = connection.execute(select(Deal.id, Deal.investors).where(or_(*conditions))).all()
+        for deal_id, investors in rows:
+            self.sync(connection, deal_id, investors)
+
+    def deals_query(self, db, investor_id: int):
+        """Сделки инвестора с компаниями - один join по индексу (investor_id, deal_id)"""
+        return (
+            db.query(Deal)
+            .join(deal_investor, deal_investor.c.deal_id == Deal.id)
+            .filter(deal_investor.c.investor_id == investor_id)
+            .options(joinedload(Deal.company))
+        )
+
+    def backfill(self, batch_size: int = 500) -> Dict[str, int]:
+        """Разбирает поле investors всех сделок в связи (миграция данных)"""
+        counts = {'deals': 0, 'links': 0}
+        db = SessionLocal()
+        try:
+            with self.engine.begin() as connection:
+                for deal_id, investors in db.query(Deal.id, Deal.investors).yield_per(batch_size):
+                    self.sync(connection, deal_id, investors)
+                    counts['deals'] += 1
+                counts['links'] = connection.execute(select(func.count()).select_from(deal_investor)).scalar()
+        finally:
+            db.close()
+        return counts
+
+    def backfill_if_empty(self) -> None:
+        """Заполняет связи при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'deal_investor',
+            lambda connection: connection.execute(select(deal_investor.c.deal_id).limit(1)).first() is None,
+            self.backfill
+        )
+        if counts and counts['links']:
+            print(f"Связи сделок с инвесторами заполнены: {counts}")
+
+    def install_hooks(self) -> None:
+        """Подписывает связи на изменения сделок и инвесторов"""
+        if event.contains(Deal, 'after_insert', _deal_after_insert):
+            return
+        event.listen(Deal, 'after_insert', _deal_after_insert)
+        event.listen(Deal, 'after_update', _deal_after_update)
+        event.listen(Deal, 'after_delete', _deal_after_delete)
+        event.listen(Investor, 'after_insert', _investor_after_insert)
+        event.listen(Investor, 'after_update', _investor_after_update)
+        event.listen(Investor, 'after_delete', _investor_after_delete)
+
+def _deal_after_insert(mapper, connection, target):
+    deal_investor_index.sync(connection, target.id, target.investors)
+
+def _deal_after_update(mapper, connection, target):
+    if inspect(target).attrs.investors.history.has_changes():
+        deal_investor_index.sync(connection, target.id, target.investors)
+
+def _deal_after_delete(mapper, connection, target):
+    # Связи удаляем явно: каскад внешних ключей в SQLite по умолчанию выключен
+    connection.execute(deal_investor.delete().where(deal_investor.c.deal_id == target.id))
+
+def _investor_after_insert(mapper, connection, target):
+    # Сделки могли упоминать инвестора до того, как его завели в базе
+    deal_investor_index.resync_investor(connection, target.id, target.name)
+
+def _investor_after_update(mapper, connection, target):
+    if inspect(target).attrs.name.history.has_changes():
+        deal_investor_index.resync_investor(connection, target.id, target.name)
+
+def _investor_after_delete(mapper, connection, target):
+    connection.execute(deal_investor.delete().where(deal_investor.c.investor_id == target.id))
+
+# Глобальный экземпляр индекса участия в сделках
+deal_investor_index = DealInvestorIndex()
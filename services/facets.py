@@ -0,0 +1,165 @@
+"""
+Фасеты фильтров списков: значения фильтров компаний, инвесторов и вакансий с количеством записей.
+
+Значения хранятся в таблице facet_count и обновляются в транзакции записи (события
+after_insert/after_update/after_delete) на разницу старых и новых значений. Страницы получают
+их через QueryCache из памяти воркера - без SELECT DISTINCT на каждый запрос.
+"""
+
+from collections import Counter
+from typing import Any, Dict, List
+
+from sqlalchemy import event, inspect, text
+
+from db import engine, SessionLocal
+from models import Company, Investor, Job, FacetCount
+from .backfill import run_backfill
+from .history import previous_value, track_previous
+from .tags import parse_tags
+
+# Поля фасетов: поле -> значения через запятую (focus, stages) или одно значение
+FACET_FIELDS = {
+    'company': {'country': False, 'stage': False, 'industry': True},
+    'investor': {'country': False, 'focus': True, 'stages': True},
+    'job': {'city': False, 'job_type': False, 'company_id': False},
+}
+
+FACET_MODELS = {
+    'company': Company,
+    'investor': Investor,
+    'job': Job,
+}
+
+_VALUE_MAX_LENGTH = 128
+
+def split_facet_value(value: Any, multiple: bool) -> List[str]:
+    """Значения фасета из поля записи; списки разбираются так же, как теги (services/tags.py)"""
+    if value is None:
+        return []
+    if multiple:
+        return [name for _, name in parse_tags(str(value))]
+    value = str(value).strip()
+    return [value[:_VALUE_MAX_LENGTH]] if value else []
+
+def facet_values(entity_type: str, values: Dict[str, Any]) -> Counter:
+    """Пары (фасет, значение) записи; пустой Counter - запись не активна"""
+    result = Counter()
+    if values.get('status', 'active') != 'active':
+        return result
+    for field, multiple in FACET_FIELDS[entity_type].items():
+        # set: "Fintech, Fintech" в одной записи считается один раз
+        for value in set(split_facet_value(values.get(field), multiple)):
+            result[(field, value)] += 1
+    return result
+
+def _current_values(entity_type: str, obj: Any) -> Dict[str, Any]:
+    fields = list(FACET_FIELDS[entity_type]) + ['status']
+    return {field: getattr(obj, field) for field in fields}
+
+def _previous_values(entity_type: str, obj: Any) -> Dict[str, Any]:
+    """Значения полей до текущего flush (старые значения загружаются благодаря active_history)"""
+    state = inspect(obj)
+    return {field: previous_value(state, field) for field in list(FACET_FIELDS[entity_type]) + ['status']}
+
+class FacetIndex:
+    """Материализованные фасеты с количествами"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу фасетов, если ее нет"""
+        FacetCount.__table__.create(self.engine, checkfirst=True)
+
+    def apply(self, connection, entity_type: str, delta: Counter) -> None:
+        """Применяет изменение количеств; INSERT ... ON CONFLICT есть и в SQLite, и в PostgreSQL"""
+        changes = [
+            {"entity_type": entity_type, "facet": facet, "value": value, "delta": count}
+            for (facet, value), count in delta.items() if count
+        ]
+        if not changes:
+            return
+        connection.execute(text(
+            "INSERT INTO facet_count (entity_type, facet, value, count) "
+            "VALUES (:entity_type, :facet, :value, :delta) "
+            "ON CONFLICT (entity_type, facet, value) DO UPDATE SET count = facet_count.count + excluded.count"
+        ), changes)
+
+    def get(self, entity_type: str, db=None) -> Dict[str, Dict[str, int]]:
+        """Фасеты сущности: {фасет: {значение: количество}}, значения по алфавиту"""
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            rows = db.query(FacetCount.facet, FacetCount.value, FacetCount.count).filter(
+                FacetCount.entity_type == entity_type,
+                FacetCount.count > 0
+            ).order_by(FacetCount.facet, FacetCount.value).all()
+        finally:
+            if own_session:
+                db.close()
+        facets = {field: {} for field in FACET_FIELDS[entity_type]}
+        for facet, value, count in rows:
+            if facet in facets:
+                facets[facet][value] = count
+        return facets
+
+    def rebuild(self, batch_size: int = 1000) -> Dict[str, int]:
+        """Полностью пересчитывает фасеты по активным записям"""
+        counts = {}
+        db = SessionLocal()
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(FacetCount.__table__.delete())
+                for entity_type, model in FACET_MODELS.items():
+                    columns = [getattr(model, field) for field in FACET_FIELDS[entity_type]]
+                    totals = Counter()
+                    for row in db.query(*columns).filter(model.status == 'active').yield_per(batch_size):
+                        totals.update(facet_values(entity_type, dict(zip(FACET_FIELDS[entity_type], row))))
+                    self.apply(connection, entity_type, totals)
+                    counts[entity_type] = len(totals)
+        finally:
+            db.close()
+        return counts
+
+    def rebuild_if_empty(self) -> None:
+        """Заполняет фасеты при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'facet_count',
+            lambda connection: connection.execute(text("SELECT 1 FROM facet_count LIMIT 1")).first() is None,
+            self.rebuild
+        )
+        if counts and any(counts.values()):
+            print(f"Фасеты фильтров заполнены: {counts}")
+
+    def install_hooks(self) -> None:
+        """Подписывает фасеты на изменения моделей"""
+        for entity_type, model in FACET_MODELS.items():
+            if event.contains(model, 'after_insert', _after_insert):
+                continue
+            event.listen(model, 'after_insert', _after_insert)
+            event.listen(model, 'after_update', _after_update)
+            event.listen(model, 'after_delete', _after_delete)
+            # Старое значение поля нужно для разницы, даже если до изменения его не читали
+            for field in list(FACET_FIELDS[entity_type]) + ['status']:
+                track_previous(getattr(model, field))
+
+_ENTITY_TYPES_BY_TABLE = {model.__tablename__: entity_type for entity_type, model in FACET_MODELS.items()}
+
+def _after_insert(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    facet_index.apply(connection, entity_type, facet_values(entity_type, _current_values(entity_type, target)))
+
+def _after_update(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    delta = facet_values(entity_type, _current_values(entity_type, target))
+    delta.subtract(facet_values(entity_type, _previous_values(entity_type, target)))
+    facet_index.apply(connection, entity_type, delta)
+
+def _after_delete(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    delta = Counter()
+    delta.subtract(facet_values(entity_type, _previous_values(entity_type, target)))
+    facet_index.apply(connection, entity_type, delta)
+
+# Глобальный экземпляр индекса фасетов
+facet_index = FacetIndex()
@@ -0,0 +1,282 @@
+"""
+Колоночный снимок раундов финансирования для распределений и перцентилей.
+
+Раунд - активная сделка с датой или записи портфеля одной компании за одну дату, для которых нет
+сделки (как раунды графа соинвестиций). Снимок хранит раунды массивами NumPy, упорядоченными по
+(компания, дата); категориальные колонки (страна, стадия, индустрия, тип сделки) закодированы словарем:
+int32-коды и отсортированный список значений. Запросы считаются векторно:
+
+- перцентили объема или оценки по группам - одна сортировка и интерполяция по позициям
+- рост оценки между соседними раундами компании - сдвиг массива внутри компании
+- доля топ-10 компаний в объеме группы - bincount по парам (группа, компания) и ранг внутри группы
+
+Снимок держится в памяти воркера и перестраивается при смене поколения тегов таблиц сделок,
+портфелей и компаний.
+"""
+
+import threading
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import or_, select
+
+from db import engine
+from models import Company, Deal, PortfolioEntry
+from .analytics import primary_industry
+from .cache import cache_manager, table_cache_tag
+
+# Записи в эти таблицы меняют раунды
+FUNDING_TAGS = tuple(table_cache_tag(name) for name in ('deal', 'portfolio_entry', 'company'))
+
+# Категориальные колонки снимка
+CATEGORICAL_COLUMNS = ('country', 'stage', 'industry', 'deal_type')
+
+# Разрезы группировки и фильтров: категориальные колонки и год
+FUNDING_DIMENSIONS = ('year',) + CATEGORICAL_COLUMNS
+
+# Числовые колонки для распределений
+FUNDING_VALUES = ('amount', 'valuation')
+
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75)
+
+Round = Tuple[int, date, Optional[float], Optional[float], str, str, str, str]
+
+def encode_categories(values: Sequence[str]) -> Tuple[np.ndarray, List[str]]:
+    """Словарное кодирование: int32-коды и отсортированные значения"""
+    if not len(values):
+        return np.zeros(0, dtype=np.int32), []
+    categories, codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+    return codes.reshape(-1).astype(np.int32), [str(value) for value in categories]
+
+def quantile_label(q: float) -> str:
+    """Имя перцентиля в ответе: 0.5 -> 'p50'"""
+    return f"p{q * 100:g}"
+
+def grouped_quantiles(codes: np.ndarray, values: np.ndarray, qs: Sequence[float]):
+    """Перцентили значений по кодам групп (линейная интерполяция, как np.quantile): группы, размеры, матрица"""
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    groups, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+    positions = starts[:, None] + np.asarray(qs, dtype=np.float64)[None, :] * (counts[:, None] - 1)
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    fraction = positions - low
+    return groups, counts, values[low] * (1 - fraction) + values[high] * fraction
+
+class FundingColumns:
+    """Раунды финансирования в колонках NumPy"""
+
+    def __init__(self, rounds: Iterable[Round]):
+        rounds = sorted(rounds, key=lambda item: (item[0], item[1]))
+        self.size = len(rounds)
+        self.company = np.array([item[0] for item in rounds], dtype=np.int64)
+        self.day = np.array([item[1].toordinal() for item in rounds], dtype=np.int32)
+        self.year = np.array([item[1].year for item in rounds], dtype=np.int32)
+        self.amount = np.array([np.nan if item[2] is None else item[2] for item in rounds], dtype=np.float64)
+        self.valuation = np.array([np.nan if item[3] is None else item[3] for item in rounds], dtype=np.float64)
+        self.codes: Dict[str, np.ndarray] = {}
+        self.categories: Dict[str, List[str]] = {}
+        for offset, name in enumerate(CATEGORICAL_COLUMNS, start=4):
+            self.codes[name], self.categories[name] = encode_categories([item[offset] or '' for item in rounds])
+
+    # --- Маски и группы ---
+
+    def mask(self, filters: Optional[Dict[str, object]] = None) -> np.ndarray:
+        """Булева маска раундов по фильтрам разрезов; неизвестное значение категории - пустая маска"""
+        mask = np.ones(self.size, dtype=bool)
+        for name, value in (filters or {}).items():
+            if value in (None, ''):
+                continue
+            if name not in FUNDING_DIMENSIONS:
+                raise ValueError(f"Неизвестный разрез аналитики: {name}")
+            if name == 'year':
+                mask &= self.year == int(value)
+                continue
+            categories = self.categories[name]
+            position = int(np.searchsorted(categories, value)) if categories else 0
+            if position >= len(categories) or categories[position] != value:
+                return np.zeros(self.size, dtype=bool)
+            mask &= self.codes[name] == position
+        return mask
+
+    def _column(self, name: str) -> np.ndarray:
+        return self.year if name == 'year' else self.codes[name]
+
+    def _decode(self, name: str, code) -> object:
+        return int(code) if name == 'year' else self.categories[name][int(code)]
+
+    def group_codes(self, group_by: Sequence[str], rows: np.ndarray) -> Tuple[np.ndarray, List[dict]]:
+        """Код группы для каждой строки rows и значения разрезов групп"""
+        for name in group_by:
+            if name not in FUNDING_DIMENSIONS:
+                raise ValueError(f"Неизвестный разрез аналитики: {name}")
+        if not group_by:
+            return np.zeros(len(rows), dtype=np.int64), [{}]
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), []
+        stacked = np.stack([self._column(name)[rows].astype(np.int64) for name in group_by])
+        keys, inverse = np.unique(stacked, axis=1, return_inverse=True)
+        labels = [
+            {name: self._decode(name, keys[index, column]) for index, name in enumerate(group_by)}
+            for column in range(keys.shape[1])
+        ]
+        return inverse.reshape(-1), labels
+
+    def _quantile_rows(self, codes, labels, values, qs) -> List[dict]:
+        if not len(values):
+            return []
+        groups, counts, matrix = grouped_quantiles(codes, values, qs)
+        return [
+            {**labels[group], 'count': int(count),
+             'quantiles': {quantile_label(q): float(value) for q, value in zip(qs, row)}}
+            for group, count, row in zip(groups, counts, matrix)
+        ]
+
+    # --- Запросы ---
+
+    def distribution(self, value: str = 'amount', group_by: Sequence[str] = (),
+                     filters: Optional[Dict[str, object]] = None,
+                     qs: Sequence[float] = DEFAULT_QUANTILES) -> List[dict]:
+        """Перцентили объема или оценки раундов по группам"""
+        if value not in FUNDING_VALUES:
+            raise ValueError(f"Неизвестная величина: {value}")
+        column = getattr(self, value)
+        rows = np.flatnonzero(self.mask(filters) & ~np.isnan(column))
+        codes, labels = self.group_codes(group_by, rows)
+        return self._quantile_rows(codes, labels, column[rows], qs)
+
+    def step_ups(self, group_by: Sequence[str] = (), filters: Optional[Dict[str, object]] = None,
+                 qs: Sequence[float] = DEFAULT_QUANTILES) -> List[dict]:
+        """Перцентили роста оценки к предыдущему оцененному раунду компании; разрезы и фильтры - по новому раунду"""
+        valued = np.flatnonzero(~np.isnan(self.valuation) & (np.nan_to_num(self.valuation) > 0))
+        previous, current = valued[:-1], valued[1:]
+        # Сделки без компании (код 0) не образуют пар
+        pairs = (self.company[previous] == self.company[current]) & (self.company[current] != 0)
+        previous, current = previous[pairs], current[pairs]
+        selected = self.mask(filters)[current]
+        previous, current = previous[selected], current[selected]
+        ratios = self.valuation[current] / self.valuation[previous]
+        codes, labels = self.group_codes(group_by, current)
+        return self._quantile_rows(codes, labels, ratios, qs)
+
+    def company_step_ups(self, company_id: int) -> List[dict]:
+        """Оцененные раунды компании по порядку с ростом к предыдущему"""
+        start, end = np.searchsorted(self.company, [company_id, company_id + 1])
+        rounds, previous = [], None
+        for index in range(start, end):
+            valuation = self.valuation[index]
+            if np.isnan(valuation) or valuation <= 0:
+                continue
+            rounds.append({
+                'date': date.fromordinal(int(self.day[index])),
+                'deal_type': self.categories['deal_type'][self.codes['deal_type'][index]],
+                'valuation': float(valuation),
+                'step_up': float(valuation / previous) if previous else None,
+            })
+            previous = valuation
+        return rounds
+
+    def concentration(self, group_by: Sequence[str] = ('country', 'year'),
+                      filters: Optional[Dict[str, object]] = None, top: int = 10) -> List[dict]:
+        """Доля топ-N компаний в объеме финансирования каждой группы"""
+        rows = np.flatnonzero(self.mask(filters) & ~np.isnan(self.amount))
+        codes, labels = self.group_codes(group_by, rows)
+        if not len(rows):
+            return []
+        # Объем каждой компании в группе
+        pairs, inverse = np.unique(np.stack([codes, self.company[rows]]), axis=1, return_inverse=True)
+        totals = np.bincount(inverse.reshape(-1), weights=self.amount[rows], minlength=pairs.shape[1])
+        pair_groups = pairs[0]
+        # Внутри группы компании по убыванию объема; ранг - позиция от начала группы
+        order = np.lexsort((-totals, pair_groups))
+        pair_groups, totals = pair_groups[order], totals[order]
+        groups, starts, companies = np.unique(pair_groups, return_index=True, return_counts=True)
+        rank = np.arange(len(pair_groups)) - np.repeat(starts, companies)
+        group_index = np.repeat(np.arange(len(groups)), companies)
+        amount = np.bincount(group_index, weights=totals, minlength=len(groups))
+        leaders = np.bincount(group_index[rank < top], weights=totals[rank < top], minlength=len(groups))
+        return [
+            {**labels[group], 'companies': int(count), 'amount': float(total),
+             'top_amount': float(lead), 'top_share': float(lead / total) if total else None}
+            for group, count, total, lead in zip(groups, companies, amount, leaders)
+        ]
+
+class FundingAnalytics:
+    """Колоночный снимок раундов в памяти воркера"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+        self._snapshot = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def load(self) -> FundingColumns:
+        """Читает сделки и записи портфеля с признаками компаний"""
+        with self.engine.connect() as connection:
+            deals = connection.execute(
+                select(Deal.company_id, Deal.date, Deal.amount, Deal.valuation, Deal.type,
+                       Company.country, Company.stage, Company.industry)
+                .select_from(Deal).outerjoin(Company, Company.id == Deal.company_id)
+                .where(or_(Deal.status == 'active', Deal.status.is_(None)), Deal.date.isnot(None))
+            ).all()
+            entries = connection.execute(
+                select(PortfolioEntry.company_id, PortfolioEntry.date, PortfolioEntry.amount, PortfolioEntry.valuation,
+                       Company.country, Company.stage, Company.industry)
+                .join(Company, Company.id == PortfolioEntry.company_id)
+            ).all()
+        rounds = []
+        seen = set()
+        for company_id, deal_date, amount, valuation, deal_type, country, stage, industry in deals:
+            seen.add((company_id, deal_date))
+            rounds.append((company_id or 0, deal_date, amount, valuation, country, stage,
+                           primary_industry(industry), deal_type))
+        # Записи портфеля без сделки за ту же дату - отдельный раунд: объемы складываются, оценка - наибольшая
+        portfolio = defaultdict(lambda: [0.0, None, None])
+        for company_id, entry_date, amount, valuation, country, stage, industry in entries:
+            if (company_id, entry_date) in seen:
+                continue
+            item = portfolio[(company_id, entry_date)]
+            item[0] += amount or 0
+            if valuation is not None:
+                item[1] = valuation if item[1] is None else max(item[1], valuation)
+            item[2] = (country, stage, primary_industry(industry))
+        for (company_id, entry_date), (amount, valuation, (country, stage, industry)) in portfolio.items():
+            rounds.append((company_id, entry_date, amount, valuation, country, stage, industry, ''))
+        return FundingColumns(rounds)
+
+    def snapshot(self) -> FundingColumns:
+        """Снимок в памяти; перестраивается после записи в сделки, портфели или компании"""
+        version = cache_manager.get_tags_version(FUNDING_TAGS)
+        snapshot = self._snapshot
+        if snapshot is not None and version == self._version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or version != self._version:
+                self._snapshot = self.load()
+                self._version = version
+            return self._snapshot
+
+    def distribution(self, value: str = 'amount', group_by: Sequence[str] = (),
+                     filters: Optional[Dict[str, object]] = None,
+                     qs: Sequence[float] = DEFAULT_QUANTILES) -> List[dict]:
+        """Перцентили объема или оценки раундов: [{разрезы..., 'count', 'quantiles': {'p50': ...}}]"""
+        return self.snapshot().distribution(value, group_by, filters, qs)
+
+    def step_ups(self, group_by: Sequence[str] = (), filters: Optional[Dict[str, object]] = None,
+                 qs: Sequence[float] = DEFAULT_QUANTILES) -> List[dict]:
+        """Перцентили роста оценки между соседними раундами компаний"""
+        return self.snapshot().step_ups(group_by, filters, qs)
+
+    def company_step_ups(self, company_id: int) -> List[dict]:
+        """Оцененные раунды компании с ростом к предыдущему"""
+        return self.snapshot().company_step_ups(company_id)
+
+    def concentration(self, group_by: Sequence[str] = ('country', 'year'),
+                      filters: Optional[Dict[str, object]] = None, top: int = 10) -> List[dict]:
+        """Доля топ-N компаний в объеме финансирования групп"""
+        return self.snapshot().concentration(group_by, filters, top)
+
+# Глобальный экземпляр колоночной аналитики
+funding_analytics = FundingAnalytics()
@@ -0,0 +1,20 @@
+"""
+Старые значения полей моделей в событиях flush (общие для фасетов, графа соинвестиций и агрегатов сделок).
+"""
+
+from typing import Any
+
+from sqlalchemy import event
+
+def _noop_set(target, value, oldvalue, initiator):
+    return value
+
+def track_previous(attribute) -> None:
+    """Загружает старое значение поля при присваивании (active_history), даже если до изменения его не читали"""
+    if not event.contains(attribute, 'set', _noop_set):
+        event.listen(attribute, 'set', _noop_set, active_history=True)
+
+def previous_value(state, field: str) -> Any:
+    """Значение поля до текущего flush; state - inspect(obj)"""
+    history = state.attrs[field].history
+    return history.deleted[0] if history.deleted else getattr(state.object, field)
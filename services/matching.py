@@ -0,0 +1,280 @@
+"""
+Подбор инвесторов для компании и компаний для инвестора.
+
+Компании и инвесторы кодируются в матрицы признаков NumPy над общими словарями тегов индустрий,
+стадий и стран. Оценка пары - скалярное произведение строк, поэтому все инвесторы для компании
+(или все пары сразу, пачками) считаются одним умножением матриц:
+
+- фокус: доля индустрий компании из Investor.focus
+- стадия: стадия компании есть в Investor.stages
+- страна: совпадает со страной инвестора
+- история: доля портфеля инвестора (PortfolioEntry и сделки) в индустриях компании
+
+Модель держится в памяти воркера и перестраивается при смене поколения тегов таблиц компаний,
+инвесторов, портфелей и сделок.
+"""
+
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from sqlalchemy import select, union
+
+from db import engine
+from models import Company, Deal, Investor, PortfolioEntry, deal_investor
+from .cache import cache_manager, table_cache_tag
+from .tags import parse_tags, tag_slug
+
+# Записи в эти таблицы меняют признаки
+MATCHING_TAGS = tuple(table_cache_tag(name) for name in ('company', 'investor', 'portfolio_entry', 'deal'))
+
+# Веса составляющих оценки (в сумме 1)
+MATCH_WEIGHTS = {
+    'focus': 0.4,
+    'stage': 0.25,
+    'country': 0.15,
+    'history': 0.2,
+}
+
+class _Vocabulary:
+    """Словарь значений признака: значение -> столбец, плюс отображаемое имя"""
+
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def add(self, key: str, name: str) -> int:
+        if key not in self.index:
+            self.index[key] = len(self.names)
+            self.names.append(name)
+        return self.index[key]
+
+def _binary(rows: List[List[int]], width: int) -> np.ndarray:
+    matrix = np.zeros((len(rows), max(width, 1)), dtype=np.float32)
+    for row, columns in enumerate(rows):
+        matrix[row, columns] = 1
+    return matrix
+
+class MatchingModel:
+    """Закодированные компании и инвесторы"""
+
+    def __init__(self, companies: List[tuple], investors: List[tuple], history: Iterable[tuple]):
+        """companies: (id, name, country, stage, industry); investors: (id, name, country, focus, stages);
+        history: (investor_id, company_id, industry) - компании портфеля и сделок инвестора.
+        """
+        self.tags, self.stages, self.countries = _Vocabulary(), _Vocabulary(), _Vocabulary()
+
+        def tag_columns(value):
+            return [self.tags.add(slug, name) for slug, name in parse_tags(value)]
+
+        def stage_columns(value):
+            return [self.stages.add(slug, name) for slug, name in parse_tags(value)]
+
+        def country_columns(value):
+            value = (value or '').strip()
+            return [self.countries.add(tag_slug(value), value)] if value else []
+
+        self.company_ids = np.array([row[0] for row in companies], dtype=np.int64)
+        self.company_names = [row[1] for row in companies]
+        company_tags = [tag_columns(row[4]) for row in companies]
+        company_stages = [stage_columns(row[3])[:1] for row in companies]
+        company_countries = [country_columns(row[2]) for row in companies]
+
+        self.investor_ids = np.array([row[0] for row in investors], dtype=np.int64)
+        self.investor_names = [row[1] for row in investors]
+        investor_focus = [tag_columns(row[3]) for row in investors]
+        investor_stages = [stage_columns(row[4]) for row in investors]
+        investor_countries = [country_columns(row[2]) for row in investors]
+
+        self.company_positions = {int(company_id): row for row, company_id in enumerate(self.company_ids)}
+        self.investor_positions = {int(investor_id): row for row, investor_id in enumerate(self.investor_ids)}
+
+        # История: сколько компаний портфеля инвестора в каждой индустрии
+        self.existing = defaultdict(set)
+        self.portfolio = defaultdict(set)
+        history_counts = defaultdict(lambda: defaultdict(int))
+        for investor_id, company_id, industry in history:
+            if investor_id not in self.investor_positions:
+                continue
+            self.existing[company_id].add(investor_id)
+            self.portfolio[investor_id].add(company_id)
+            for column in tag_columns(industry):
+                history_counts[self.investor_positions[investor_id]][column] += 1
+
+        width_tags, width_stages, width_countries = len(self.tags.names), len(self.stages.names), len(self.countries.names)
+        self.company_tags = _binary(company_tags, width_tags)
+        self.company_stages = _binary(company_stages, width_stages)
+        self.company_countries = _binary(company_countries, width_countries)
+        self.investor_focus = _binary(investor_focus, width_tags)
+        self.investor_stages = _binary(investor_stages, width_stages)
+        self.investor_countries = _binary(investor_countries, width_countries)
+        self.investor_history = np.zeros((len(investors), max(width_tags, 1)), dtype=np.float32)
+        for row, counts in history_counts.items():
+            for column, count in counts.items():
+                self.investor_history[row, column] = count
+
+        # Оценка = company_features @ investor_features.T; доли и веса заложены в строки компаний
+        tag_counts = self.company_tags.sum(axis=1, keepdims=True)
+        tag_counts[tag_counts == 0] = 1
+        history_totals = self.investor_history.sum(axis=1, keepdims=True)
+        history_totals[history_totals == 0] = 1
+        self.company_features = np.hstack([
+            self.company_tags / tag_counts * MATCH_WEIGHTS['focus'],
+            self.company_stages * MATCH_WEIGHTS['stage'],
+            self.company_countries * MATCH_WEIGHTS['country'],
+            self.company_tags * MATCH_WEIGHTS['history'],
+        ])
+        self.investor_features = np.hstack([
+            self.investor_focus,
+            self.investor_stages,
+            self.investor_countries,
+            self.investor_history / history_totals,
+        ])
+
+    # --- Оценки ---
+
+    def _top(self, scores: np.ndarray, limit: int) -> np.ndarray:
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return np.array([], dtype=np.int64)
+        candidates = np.argpartition(-scores, limit - 1)[:limit]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return candidates[scores[candidates] > 0]
+
+    def investors_for_company(self, company_id: int, limit: int = 10,
+                              exclude_existing: bool = True) -> List[Tuple[int, float]]:
+        """Top-k инвесторов для компании: [(investor_id, оценка)]"""
+        row = self.company_positions.get(company_id)
+        if row is None or not len(self.investor_ids):
+            return []
+        scores = self.investor_features @ self.company_features[row]
+        if exclude_existing:
+            for investor_id in self.existing.get(company_id, ()):
+                scores[self.investor_positions[investor_id]] = 0
+        return [(int(self.investor_ids[i]), float(scores[i])) for i in self._top(scores, limit)]
+
+    def companies_for_investor(self, investor_id: int, limit: int = 10,
+                               exclude_existing: bool = True) -> List[Tuple[int, float]]:
+        """Top-k компаний для инвестора: [(company_id, оценка)]"""
+        row = self.investor_positions.get(investor_id)
+        if row is None or not len(self.company_ids):
+            return []
+        scores = self.company_features @ self.investor_features[row]
+        if exclude_existing:
+            for company_id in self.portfolio.get(investor_id, ()):
+                if company_id in self.company_positions:
+                    scores[self.company_positions[company_id]] = 0
+        return [(int(self.company_ids[i]), float(scores[i])) for i in self._top(scores, limit)]
+
+    def score_all(self, limit: int = 10, batch_size: int = 1024) -> Iterable[Tuple[int, np.ndarray, np.ndarray]]:
+        """Top-k инвесторов для всех компаний пачками: (company_id, investor_ids, оценки)"""
+        limit = min(limit, len(self.investor_ids))
+        if limit <= 0:
+            return
+        investor_features = self.investor_features.T
+        for start in range(0, len(self.company_ids), batch_size):
+            scores = self.company_features[start:start + batch_size] @ investor_features
+            candidates = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            for offset in range(len(scores)):
+                yield int(self.company_ids[start + offset]), self.investor_ids[candidates[offset]], candidate_scores[offset]
+
+    # --- Объяснения ---
+
+    def explain(self, company_id: int, investor_id: int) -> Dict[str, object]:
+        """Составляющие оценки пары и причины текстом"""
+        company = self.company_positions[company_id]
+        investor = self.investor_positions[investor_id]
+        tags = np.nonzero(self.company_tags[company])[0]
+        focus = [self.tags.names[i] for i in tags if self.investor_focus[investor, i]]
+        stage = [self.stages.names[i] for i in np.nonzero(self.company_stages[company] * self.investor_stages[investor])[0]]
+        country = [self.countries.names[i] for i in np.nonzero(self.company_countries[company] * self.investor_countries[investor])[0]]
+        history = [(self.tags.names[i], int(self.investor_history[investor, i])) for i in tags if self.investor_history[investor, i]]
+        history_total = self.investor_history[investor].sum() or 1
+
+        components = {
+            'focus': MATCH_WEIGHTS['focus'] * len(focus) / max(len(tags), 1),
+            'stage': MATCH_WEIGHTS['stage'] if stage else 0.0,
+            'country': MATCH_WEIGHTS['country'] if country else 0.0,
+            'history': MATCH_WEIGHTS['history'] * sum(count for _, count in history) / history_total,
+        }
+        reasons = []
+        if focus:
+            reasons.append(f"Фокус: {', '.join(focus)}")
+        if stage:
+            reasons.append(f"Стадия: {stage[0]}")
+        if country:
+            reasons.append(f"Страна: {country[0]}")
+        if history:
+            reasons.append("В портфеле: " + ", ".join(f"{name} ×{count}" for name, count in history))
+        return {'components': {key: round(float(value), 4) for key, value in components.items()}, 'reasons': reasons}
+
+class MatchingEngine:
+    """Модель подбора в памяти воркера"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+        self._model = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def load(self) -> MatchingModel:
+        """Читает компании, инвесторов и их историю и кодирует в матрицы"""
+        with self.engine.connect() as connection:
+            companies = connection.execute(
+                select(Company.id, Company.name, Company.country, Company.stage, Company.industry)
+                .where(Company.status == 'active').order_by(Company.id)
+            ).all()
+            investors = connection.execute(
+                select(Investor.id, Investor.name, Investor.country, Investor.focus, Investor.stages)
+                .where(Investor.status == 'active').order_by(Investor.id)
+            ).all()
+            # Пара инвестор-компания учитывается один раз, даже если есть и запись портфеля, и сделка
+            pairs = union(
+                select(PortfolioEntry.investor_id, PortfolioEntry.company_id),
+                select(deal_investor.c.investor_id, Deal.company_id)
+                .join(Deal, Deal.id == deal_investor.c.deal_id)
+                .where(Deal.company_id.isnot(None))
+            ).subquery()
+            history = connection.execute(
+                select(pairs.c.investor_id, pairs.c.company_id, Company.industry)
+                .join(Company, Company.id == pairs.c.company_id)
+            ).all()
+        return MatchingModel(companies, investors, history)
+
+    def model(self) -> MatchingModel:
+        """Модель в памяти; перестраивается после записи в компании, инвесторов, портфели или сделки"""
+        version = cache_manager.get_tags_version(MATCHING_TAGS)
+        model = self._model
+        if model is not None and version == self._version:
+            return model
+        with self._lock:
+            if self._model is None or version != self._version:
+                self._model = self.load()
+                self._version = version
+            return self._model
+
+    def investors_for_company(self, company_id: int, limit: int = 10) -> List[dict]:
+        """Подходящие инвесторы с объяснениями: [{'investor_id', 'name', 'score', 'components', 'reasons'}]"""
+        model = self.model()
+        return [
+            {'investor_id': investor_id, 'name': model.investor_names[model.investor_positions[investor_id]],
+             'score': round(score, 4), **model.explain(company_id, investor_id)}
+            for investor_id, score in model.investors_for_company(company_id, limit)
+        ]
+
+    def companies_for_investor(self, investor_id: int, limit: int = 10) -> List[dict]:
+        """Подходящие компании с объяснениями: [{'company_id', 'name', 'score', 'components', 'reasons'}]"""
+        model = self.model()
+        return [
+            {'company_id': company_id, 'name': model.company_names[model.company_positions[company_id]],
+             'score': round(score, 4), **model.explain(company_id, investor_id)}
+            for company_id, score in model.companies_for_investor(investor_id, limit)
+        ]
+
+# Глобальный экземпляр подбора инвесторов
+matching_engine = MatchingEngine()
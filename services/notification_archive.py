@@ -0,0 +1,83 @@
+"""
+Хранение уведомлений: архив старых прочитанных.
+
+Горячая таблица notification растет с каждой рассылкой, а список и счетчик непрочитанных читают ее по
+user_id. Архивация переносит прочитанные уведомления старше NOTIFICATION_RETENTION_DAYS в компактную
+notification_archive (без текста сообщения) пачками по NOTIFICATION_ARCHIVE_BATCH строк: каждая пачка -
+INSERT ... SELECT и DELETE в одной короткой транзакции, поэтому повторный запуск после сбоя не дублирует
+строки, а запись в notification не блокируется надолго. Непрочитанные уведомления не переносятся.
+"""
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import DateTime, insert, inspect, literal, select, text
+
+from db import engine
+from models import Notification, NotificationArchive
+
+NOTIFICATION_RETENTION_DAYS = 90
+
+NOTIFICATION_ARCHIVE_BATCH = 1000
+
+_ARCHIVE_COLUMNS = ('id', 'user_id', 'title', 'type', 'entity_type', 'entity_id', 'group_count', 'created_at')
+
+class NotificationArchiver:
+    """Перенос старых прочитанных уведомлений в архив"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу архива и колонку group_count на существующей базе; индекс notification - в /run-migration"""
+        NotificationArchive.__table__.create(self.engine, checkfirst=True)
+        if self._has_group_count():
+            return
+        # Без колонки падает любой запрос уведомлений; на SQLite нет ADD COLUMN IF NOT EXISTS
+        if self.engine.dialect.name == 'postgresql':
+            statement = "ALTER TABLE notification ADD COLUMN IF NOT EXISTS group_count INTEGER NOT NULL DEFAULT 1"
+        else:
+            statement = "ALTER TABLE notification ADD COLUMN group_count INTEGER NOT NULL DEFAULT 1"
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(text(statement))
+        except Exception:
+            # Колонку мог добавить параллельно стартующий воркер
+            if not self._has_group_count():
+                raise
+
+    def _has_group_count(self) -> bool:
+        return 'group_count' in {column['name'] for column in inspect(self.engine).get_columns('notification')}
+
+    def archive(self, older_than_days: int = NOTIFICATION_RETENTION_DAYS, batch_size: int = NOTIFICATION_ARCHIVE_BATCH,
+                max_batches: Optional[int] = None) -> int:
+        """Переносит прочитанные уведомления старше older_than_days; возвращает число перенесенных"""
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        source = Notification.__table__
+        archived, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            with self.engine.begin() as connection:
+                ids = connection.execute(
+                    select(source.c.id)
+                    .where(source.c.is_read == True, source.c.created_at < cutoff)
+                    .order_by(source.c.created_at, source.c.id)
+                    .limit(batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                connection.execute(
+                    insert(NotificationArchive.__table__).from_select(
+                        list(_ARCHIVE_COLUMNS) + ['archived_at'],
+                        select(*[source.c[name] for name in _ARCHIVE_COLUMNS], literal(datetime.utcnow(), DateTime))
+                        .where(source.c.id.in_(ids))
+                    )
+                )
+                connection.execute(source.delete().where(source.c.id.in_(ids)))
+            archived += len(ids)
+            batches += 1
+            if len(ids) < batch_size:
+                break
+        return archived
+
+# Глобальный экземпляр архивации уведомлений
+notification_archiver = NotificationArchiver()
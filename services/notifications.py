@@ -1,7 +1,49 @@
 from db import SessionLocal
 from models import Notification, User
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timedelta
+from typing import Optional, List, Iterable, Iterator, Tuple
+from sqlalchemy import func, insert, select, update
+from .pagination import DatabasePagination
+from .realtime import realtime_notifications
+
+def notification_json(notification: Notification) -> dict:
+    """Уведомление для SSE-события"""
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "message": notification.message,
+        "type": notification.type,
+        "entity_type": notification.entity_type,
+        "entity_id": notification.entity_id,
+        "created_at": notification.created_at.isoformat(),
+        "count": notification.group_count,
+    }
+
+# Окно дайджеста: непрочитанное уведомление того же типа о той же сущности не старше окна
+# поглощает новое (group_count + 1) вместо новой строки
+NOTIFICATION_DIGEST_WINDOW = timedelta(hours=1)
+
+def _digest_filter(notification_type: str, entity_type: str, entity_id: int, since: datetime) -> list:
+    return [
+        Notification.type == notification_type,
+        Notification.entity_type == entity_type,
+        Notification.entity_id == entity_id,
+        Notification.is_read == False,
+        Notification.created_at >= since,
+    ]
+
+# Размер пачки рассылки: строк в одном многострочном INSERT и получателей в одном событии
+NOTIFICATION_FANOUT_BATCH = 1000
+
+def _chunks(ids: Iterable[int], size: int) -> Iterator[List[int]]:
+    chunk = []
+    for user_id in ids:
+        chunk.append(user_id)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 class NotificationService:
     """Сервис для работы с уведомлениями"""
@@ -13,26 +55,146 @@ class NotificationService:
         message: str,
         notification_type: str = 'info',
         entity_type: Optional[str] = None,
-        entity_id: Optional[int] = None
+        entity_id: Optional[int] = None,
+        digest: bool = True
     ) -> Notification:
-        """Создает новое уведомление"""
+        """Создает новое уведомление или сворачивает его в недавнее такое же (дайджест)"""
         db = SessionLocal()
         try:
-            notification = Notification(
-                user_id=user_id,
-                title=title,
-                message=message,
-                type=notification_type,
-                entity_type=entity_type,
-                entity_id=entity_id
+            notification = None
+            if digest and entity_type and entity_id is not None:
+                now = datetime.utcnow()
+                notification = db.query(Notification).filter(
+                    Notification.user_id == user_id,
+                    *_digest_filter(notification_type, entity_type, entity_id, now - NOTIFICATION_DIGEST_WINDOW)
+                ).order_by(Notification.created_at.desc()).first()
+            if notification is not None:
+                # Свернутое уведомление поднимается наверх с текстом последнего; непрочитанных не прибавляется
+                notification.title = title
+                notification.message = message
+                notification.group_count = Notification.group_count + 1
+                notification.created_at = now
+                db.flush()
+                unread_delta = 0
+            else:
+                notification = Notification(
+                    user_id=user_id,
+                    title=title,
+                    message=message,
+                    type=notification_type,
+                    entity_type=entity_type,
+                    entity_id=entity_id
+                )
+                db.add(notification)
+                db.flush()
+                unread_delta = 1
+            realtime_notifications.publish(
+                db, user_id, 'notification', notification_json(notification), unread_delta=unread_delta
             )
-            db.add(notification)
             db.commit()
             db.refresh(notification)
             return notification
         finally:
             db.close()
     
+    @staticmethod
+    def fan_out(
+        title: str,
+        message: str,
+        notification_type: str = 'info',
+        entity_type: Optional[str] = None,
+        entity_id: Optional[int] = None,
+        user_ids: Optional[Iterable[int]] = None,
+        role: Optional[str] = None,
+        query=None,
+        batch_size: int = NOTIFICATION_FANOUT_BATCH,
+        digest: bool = True
+    ) -> int:
+        """Рассылка одного уведомления аудитории: списку user_ids, роли или select(...) с id пользователей.
+
+        Одна транзакция, уведомления пишутся многострочными INSERT по batch_size строк, в SSE и брокер
+        уходит одно событие на пачку. Получателям с недавним таким же непрочитанным уведомлением оно
+        сворачивается в дайджест одним UPDATE на пачку. id из user_ids, которых нет в user, пропускаются
+        (на PostgreSQL внешний ключ откатил бы всю рассылку). Возвращает число получателей.
+        """
+        db = SessionLocal()
+        try:
+            if user_ids is not None:
+                # Повторы в списке не дают двух одинаковых уведомлений
+                audience = list(dict.fromkeys(user_ids))
+            else:
+                if query is None:
+                    if not role:
+                        raise ValueError("Не задана аудитория рассылки")
+                    query = select(User.id).where(User.role == role, User.status == 'active').order_by(User.id)
+                # Только id: даже 100 000 получателей - несколько мегабайт
+                audience = db.execute(query).scalars().all()
+            created_at = datetime.utcnow()
+            data = {
+                "title": title,
+                "message": message,
+                "type": notification_type,
+                "entity_type": entity_type,
+                "entity_id": entity_id,
+                "created_at": created_at.isoformat(),
+            }
+            use_digest = digest and entity_type and entity_id is not None
+            total = 0
+            for chunk in _chunks(audience, batch_size):
+                if user_ids is not None:
+                    existing = set(db.execute(select(User.id).where(User.id.in_(chunk))).scalars())
+                    chunk = [user_id for user_id in chunk if user_id in existing]
+                    if not chunk:
+                        continue
+                total += len(chunk)
+                if use_digest:
+                    collapsed = dict(db.execute(
+                        select(Notification.user_id, func.max(Notification.id))
+                        .where(
+                            Notification.user_id.in_(chunk),
+                            *_digest_filter(notification_type, entity_type, entity_id, created_at - NOTIFICATION_DIGEST_WINDOW)
+                        )
+                        .group_by(Notification.user_id)
+                    ).all())
+                    if collapsed:
+                        db.execute(
+                            update(Notification)
+                            .where(Notification.id.in_(list(collapsed.values())))
+                            .values(group_count=Notification.group_count + 1, title=title, message=message,
+                                    created_at=created_at)
+                            .execution_options(synchronize_session=False)
+                        )
+                        realtime_notifications.publish_batch(
+                            db, list(collapsed), list(collapsed.values()), 'notification', data, unread_delta=0
+                        )
+                        chunk = [user_id for user_id in chunk if user_id not in collapsed]
+                        if not chunk:
+                            continue
+                notification_ids = db.execute(
+                    insert(Notification).returning(Notification.id, sort_by_parameter_order=True),
+                    [
+                        {
+                            "user_id": user_id,
+                            "title": title,
+                            "message": message,
+                            "type": notification_type,
+                            "entity_type": entity_type,
+                            "entity_id": entity_id,
+                            "is_read": False,
+                            "created_at": created_at,
+                        }
+                        for user_id in chunk
+                    ]
+                ).scalars().all()
+                realtime_notifications.publish_batch(db, chunk, notification_ids, 'notification', data)
+            db.commit()
+            return total
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
     @staticmethod
     def get_user_notifications(user_id: int, limit: int = 20, unread_only: bool = False) -> List[Notification]:
         """Получает уведомления пользователя"""
@@ -45,6 +207,26 @@ class NotificationService:
         finally:
             db.close()
     
+    @staticmethod
+    def get_user_notifications_page(
+        user_id: int,
+        limit: int = 20,
+        unread_only: bool = False,
+        after: Optional[str] = None
+    ) -> Tuple[List[Notification], Optional[str]]:
+        """Страница уведомлений пользователя по курсору (новые первыми) и курсор следующей"""
+        db = SessionLocal()
+        try:
+            query = db.query(Notification).filter(Notification.user_id == user_id)
+            if unread_only:
+                query = query.filter(Notification.is_read == False)
+            return DatabasePagination.paginate_after(
+                query, 'notifications', Notification.created_at, Notification.id,
+                after=after, per_page=limit, descending=True
+            )
+        finally:
+            db.close()
+    
     @staticmethod
     def mark_as_read(notification_id: int, user_id: int) -> bool:
         """Отмечает уведомление как прочитанное"""
@@ -55,7 +237,13 @@ class NotificationService:
                 Notification.user_id == user_id
             ).first()
             if notification:
-                notification.is_read = True
+                # Условный UPDATE: повторная отметка не уменьшает счетчик непрочитанных
+                updated = db.query(Notification).filter(
+                    Notification.id == notification_id,
+                    Notification.is_read == False
+                ).update({"is_read": True}, synchronize_session=False)
+                if updated:
+                    realtime_notifications.publish(db, user_id, 'read', {"id": notification_id}, unread_delta=-1)
                 db.commit()
                 return True
             return False
@@ -71,6 +259,8 @@ class NotificationService:
                 Notification.user_id == user_id,
                 Notification.is_read == False
             ).update({"is_read": True})
+            if count:
+                realtime_notifications.publish(db, user_id, 'read_all', unread_reset=True)
             db.commit()
             return count
         finally:
@@ -86,6 +276,9 @@ class NotificationService:
                 Notification.user_id == user_id
             ).first()
             if notification:
+                realtime_notifications.publish(
+                    db, user_id, 'deleted', {"id": notification_id}, unread_delta=0 if notification.is_read else -1
+                )
                 db.delete(notification)
                 db.commit()
                 return True
@@ -95,15 +288,8 @@ class NotificationService:
     
     @staticmethod
     def get_unread_count(user_id: int) -> int:
-        """Получает количество непрочитанных уведомлений"""
-        db = SessionLocal()
-        try:
-            return db.query(Notification).filter(
-                Notification.user_id == user_id,
-                Notification.is_read == False
-            ).count()
-        finally:
-            db.close()
+        """Получает количество непрочитанных уведомлений (из кеша воркера)"""
+        return realtime_notifications.unread_count(user_id)
 
 # Предустановленные типы уведомлений
 class NotificationTypes:
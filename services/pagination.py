@@ -1,6 +1,66 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from math import ceil
 from urllib.parse import urlencode
+from datetime import date, datetime
+import base64
+import hashlib
+import hmac
+import json
+
+from sqlalchemy import and_, or_
+
+from utils.security import SECRET_KEY
+
+class InvalidCursor(ValueError):
+    """Курсор поврежден, подделан или выдан для другого списка"""
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _cursor_signature(payload: bytes) -> bytes:
+    return hmac.new(SECRET_KEY.encode(), payload, hashlib.sha256).digest()[:12]
+
+def _encode_cursor_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    return value
+
+def _decode_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+        raise InvalidCursor("Неизвестный тип значения курсора")
+    return value
+
+def encode_cursor(key: str, values: Tuple[Any, ...]) -> str:
+    """Непрозрачный подписанный курсор: имя списка и значения (sort_key, id) последней записи"""
+    payload = json.dumps(
+        {'k': key, 'v': [_encode_cursor_value(v) for v in values]},
+        separators=(',', ':'), ensure_ascii=False
+    ).encode()
+    return f"{_b64encode(payload)}.{_b64encode(_cursor_signature(payload))}"
+
+def decode_cursor(key: str, token: str) -> Tuple[Any, ...]:
+    """Проверяет подпись курсора и возвращает значения (sort_key, id)"""
+    try:
+        encoded_payload, encoded_signature = token.split('.', 1)
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Неверный формат курсора")
+    if not hmac.compare_digest(signature, _cursor_signature(payload)):
+        raise InvalidCursor("Неверная подпись курсора")
+    data = json.loads(payload)
+    if data.get('k') != key:
+        raise InvalidCursor("Курсор выдан для другого списка")
+    return tuple(_decode_cursor_value(v) for v in data['v'])
 
 class Pagination:
     """Класс для работы с пагинацией"""
@@ -12,12 +72,15 @@ class Pagination:
         per_page: int = 20,
         total: Optional[int] = None,
         base_url: str = "",
-        query_params: Optional[Dict[str, Any]] = None
+        query_params: Optional[Dict[str, Any]] = None,
+        total_estimated: Optional[bool] = None
     ):
         self.items = items
         self.page = max(1, page)
         self.per_page = max(1, per_page)
         self.total = total or len(items)
+        # Приблизительное ли количество (TotalCount из services.counts несет признак сам)
+        self.total_estimated = getattr(total, 'estimated', False) if total_estimated is None else total_estimated
         self.base_url = base_url
         self.query_params = query_params or {}
         
@@ -81,6 +144,7 @@ class Pagination:
             'page': self.page,
             'per_page': self.per_page,
             'total': self.total,
+            'total_estimated': self.total_estimated,
             'pages': self.pages,
             'has_prev': self.has_prev,
             'has_next': self.has_next,
@@ -151,6 +215,51 @@ class Pagination:
         
         return links
 
+class CursorPagination:
+    """Пагинация по курсору (keyset): без OFFSET и без подсчета общего количества"""
+    
+    def __init__(
+        self,
+        items: List[Any],
+        per_page: int = 20,
+        next_cursor: Optional[str] = None,
+        after: Optional[str] = None,
+        base_url: str = "",
+        query_params: Optional[Dict[str, Any]] = None
+    ):
+        self.items = items
+        self.per_page = max(1, per_page)
+        self.next_cursor = next_cursor
+        self.after = after
+        self.base_url = base_url
+        self.query_params = query_params or {}
+    
+    @property
+    def has_next(self) -> bool:
+        """Есть ли следующая страница"""
+        return self.next_cursor is not None
+    
+    def get_next_url(self) -> str:
+        """URL следующей страницы"""
+        if not self.base_url or not self.has_next:
+            return ""
+        
+        params = self.query_params.copy()
+        params.pop('page', None)
+        params['after'] = self.next_cursor
+        separator = "&" if "?" in self.base_url else "?"
+        return f"{self.base_url}{separator}{urlencode(params)}"
+    
+    def get_pagination_info(self) -> Dict[str, Any]:
+        """Возвращает информацию о пагинации"""
+        return {
+            'per_page': self.per_page,
+            'after': self.after,
+            'next_cursor': self.next_cursor,
+            'has_next': self.has_next,
+            'items_count': len(self.items)
+        }
+
 class PaginationHelper:
     """Хелпер для работы с пагинацией в FastAPI"""
     
@@ -177,7 +286,8 @@ class PaginationHelper:
         page: int,
         per_page: int,
         request_url: str,
-        query_params: Optional[Dict[str, Any]] = None
+        query_params: Optional[Dict[str, Any]] = None,
+        total_estimated: Optional[bool] = None
     ) -> Pagination:
         """Создает объект пагинации"""
         # Очищаем параметры от None значений
@@ -190,6 +300,29 @@ class PaginationHelper:
             per_page=per_page,
             total=total,
             base_url=request_url,
+            query_params=query_params,
+            total_estimated=total_estimated
+        )
+    
+    @staticmethod
+    def create_cursor_pagination(
+        items: List[Any],
+        per_page: int,
+        next_cursor: Optional[str],
+        request_url: str,
+        after: Optional[str] = None,
+        query_params: Optional[Dict[str, Any]] = None
+    ) -> CursorPagination:
+        """Создает объект пагинации по курсору"""
+        if query_params:
+            query_params = {k: v for k, v in query_params.items() if v is not None}
+        
+        return CursorPagination(
+            items=items,
+            per_page=per_page,
+            next_cursor=next_cursor,
+            after=after,
+            base_url=request_url,
             query_params=query_params
         )
 
@@ -197,12 +330,16 @@ class DatabasePagination:
     """Пагинация для работы с базой данных"""
     
     @staticmethod
-    def paginate_query(query, page: int = 1, per_page: int = 20):
-        """Применяет пагинацию к SQLAlchemy запросу"""
+    def paginate_query(query, page: int = 1, per_page: int = 20, total: Optional[int] = None):
+        """Применяет пагинацию к SQLAlchemy запросу.
+        
+        total - готовое количество (например, из services.counts), тогда COUNT(*) не выполняется.
+        """
         offset = (page - 1) * per_page
         
         # Получаем общее количество записей
-        total = query.count()
+        if total is None:
+            total = query.count()
         
         # Применяем пагинацию
         paginated_query = query.offset(offset).limit(per_page)
@@ -210,15 +347,60 @@ class DatabasePagination:
         return paginated_query, total
     
     @staticmethod
-    def get_paginated_results(query, page: int = 1, per_page: int = 20):
+    def get_paginated_results(query, page: int = 1, per_page: int = 20, total: Optional[int] = None):
         """Получает пагинированные результаты из запроса"""
-        paginated_query, total = DatabasePagination.paginate_query(query, page, per_page)
+        paginated_query, total = DatabasePagination.paginate_query(query, page, per_page, total)
         items = paginated_query.all()
         
         return {
             'items': items,
             'total': total,
+            'total_estimated': getattr(total, 'estimated', False),
             'page': page,
             'per_page': per_page,
             'pages': ceil(total / per_page) if total > 0 else 1
-        } 
\ No newline at end of file
+        }
+    
+    @staticmethod
+    def paginate_after(query, key: str, sort_column, id_column, after: Optional[str] = None,
+                       per_page: int = 20, descending: bool = False, offset: int = 0):
+        """Keyset пагинация по (sort_column, id_column): WHERE вместо OFFSET, без query.count().
+        
+        Возвращает записи страницы и курсор следующей страницы (None - страница последняя).
+        Для сортировки только по id передайте sort_column=None. offset учитывается только
+        без курсора - чтобы выдать next_cursor и в режиме страниц.
+        """
+        columns = (id_column,) if sort_column is None else (sort_column, id_column)
+        
+        if after:
+            values = decode_cursor(key, after)
+            if len(values) != len(columns):
+                raise InvalidCursor("Курсор выдан для другого списка")
+            query = query.filter(DatabasePagination._keyset_filter(columns, values, descending))
+        
+        order = [column.desc() if descending else column.asc() for column in columns]
+        query = query.order_by(*order)
+        if offset and not after:
+            query = query.offset(offset)
+        items = query.limit(per_page + 1).all()
+        
+        next_cursor = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_cursor = DatabasePagination.cursor_for(key, items[-1], columns)
+        return items, next_cursor
+    
+    @staticmethod
+    def cursor_for(key: str, item, columns) -> str:
+        """Курсор, указывающий на позицию сразу после записи"""
+        return encode_cursor(key, tuple(getattr(item, column.key) for column in columns))
+    
+    @staticmethod
+    def _keyset_filter(columns, values, descending: bool):
+        """(a, b) > (x, y) в виде a > x OR (a = x AND b > y) - работает на SQLite и PostgreSQL"""
+        conditions = []
+        for index, column in enumerate(columns):
+            compare = column < values[index] if descending else column > values[index]
+            equal = [columns[i] == values[i] for i in range(index)]
+            conditions.append(and_(*equal, compare) if equal else compare)
+        return or_(*conditions)
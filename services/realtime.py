@@ -0,0 +1,408 @@
+"""
+Уведомления в реальном времени (Server-Sent Events) и кеш непрочитанных.
+
+NotificationService публикует событие в транзакции записи: создание, прочтение, удаление. После коммита
+воркер применяет событие сам - меняет счетчик непрочитанных пользователя в памяти и отправляет его в
+открытые SSE-подключения пользователя. Другие воркеры узнают о событии через брокер:
+
+- memory - только текущий процесс (один воркер, тесты)
+- database - таблица notification_event: событие записывается в той же транзакции, что и уведомление,
+  каждый воркер раз в BROKER_POLL_INTERVAL секунд читает новые строки одним запросом по id. На PostgreSQL
+  id выдается при вставке, а виден после коммита, поэтому меньший id может появиться позже большего:
+  пропуски ниже последнего прочитанного id перечитываются, пока не появятся или не пройдет BROKER_GAP_TIMEOUT
+
+Счетчик загружается одним COUNT(*) при первом обращении и дальше меняется на разницу из событий;
+UNREAD_TTL страхует от пропущенных событий.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, insert, or_, select
+from starlette.concurrency import run_in_threadpool
+
+from db import engine, SessionLocal
+from models import Notification, NotificationEvent
+
+NOTIFICATION_BROKER = os.getenv("NOTIFICATION_BROKER", "database")
+
+BROKER_POLL_INTERVAL = 1.0
+BROKER_POLL_BATCH = 1000
+
+# Сколько ждать событие с пропущенным id (транзакция еще не закоммичена); откаченные оставляют пропуск навсегда
+BROKER_GAP_TIMEOUT = 60
+BROKER_MAX_GAPS = 1000
+
+# Сколько хранить события в notification_event
+EVENT_RETENTION = timedelta(minutes=10)
+
+# Сверка кеша непрочитанных с базой
+UNREAD_TTL = 300
+
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Комментарий-пинг держит подключение открытым через прокси
+SSE_KEEPALIVE = 15
+
+class UnreadCounter:
+    """Непрочитанные уведомления пользователей в памяти воркера"""
+
+    def __init__(self, ttl: float = UNREAD_TTL):
+        self.ttl = ttl
+        # user_id -> (количество, id последнего события брокера на момент подсчета, время загрузки)
+        self._entries: Dict[int, Tuple[int, int, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[int]:
+        """Количество из кеша; None - нет или устарело"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.time() - entry[2] > self.ttl:
+                return None
+            return entry[0]
+
+    def store(self, user_id: int, count: int, since_id: int = 0) -> None:
+        with self._lock:
+            self._entries[user_id] = (count, since_id, time.time())
+
+    def apply(self, user_id: int, delta: int = 0, reset: bool = False, event_id: Optional[int] = None) -> None:
+        """Применяет событие к загруженному счетчику; события до подсчета уже в нем учтены"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            count, since_id, loaded_at = entry
+            if event_id is not None and event_id <= since_id:
+                return
+            self._entries[user_id] = (0 if reset else max(0, count + delta), since_id, loaded_at)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+class NotificationHub:
+    """SSE-подписки воркера: очередь asyncio на каждое подключение"""
+
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Set[Tuple[asyncio.Queue, asyncio.AbstractEventLoop]]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        """Новое подключение пользователя (вызывается в цикле событий)"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add((queue, asyncio.get_running_loop()))
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            for subscriber in [s for s in subscribers if s[0] is queue]:
+                subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def deliver(self, user_id: int, message: dict) -> int:
+        """Отправляет сообщение во все подключения пользователя из любого потока"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put_latest, queue, message)
+            except RuntimeError:
+                # Цикл событий уже закрыт - подключение отвалилось вместе с ним
+                self.unsubscribe(user_id, queue)
+        return len(subscribers)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+def _put_latest(queue: asyncio.Queue, message: dict) -> None:
+    # Медленный клиент: старые сообщения отбрасываются, счетчик в новом сообщении актуален
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+class MemoryBroker:
+    """События только внутри процесса"""
+    name = 'memory'
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+
+    def publish(self, session, events: List[dict]) -> None:
+        pass
+
+    def start(self, dispatch) -> None:
+        pass
+
+    def poll(self, dispatch=None) -> int:
+        return 0
+
+    def last_event_id(self, connection) -> int:
+        return 0
+
+class DatabaseBroker:
+    """События через таблицу notification_event - общий канал воркеров без отдельного брокера"""
+    name = 'database'
+
+    def __init__(self, bind=engine, interval: float = BROKER_POLL_INTERVAL, origin: Optional[str] = None):
+        self.engine = bind
+        self.interval = interval
+        self.origin = origin or uuid.uuid4().hex
+        self._dispatch = None
+        self._last_id: Optional[int] = None
+        self._gaps: Dict[int, float] = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, session, events: List[dict]) -> None:
+        """Записывает события в транзакции сессии; id событий проставляются в event['id']"""
+        if not events:
+            return
+        ids = session.execute(
+            insert(NotificationEvent).returning(NotificationEvent.id, sort_by_parameter_order=True),
+            [
+                {
+                    "user_id": item.get('user_id'),
+                    "origin": self.origin,
+                    "payload": json.dumps(item, ensure_ascii=False, default=str),
+                    "created_at": datetime.utcnow(),
+                }
+                for item in events
+            ]
+        ).scalars().all()
+        for item, event_id in zip(events, ids):
+            item['id'] = event_id
+
+    def last_event_id(self, connection) -> int:
+        return connection.execute(select(func.max(NotificationEvent.id))).scalar() or 0
+
+    def start(self, dispatch) -> None:
+        """Запускает опрос таблицы событий в фоне (один раз на процесс)"""
+        with self._lock:
+            self._dispatch = dispatch
+            if self._thread is not None:
+                return
+            if self._last_id is None:
+                with self.engine.connect() as connection:
+                    self._last_id = self.last_event_id(connection)
+            self._thread = threading.Thread(target=self._run, name="notification-broker", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        last_prune = time.time()
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+                if time.time() - last_prune > EVENT_RETENTION.total_seconds() / 10:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"Ошибка чтения событий уведомлений: {e}")
+
+    def poll(self, dispatch=None) -> int:
+        """Читает и доставляет события других воркеров; возвращает их число"""
+        dispatch = dispatch or self._dispatch
+        with self._lock:
+            if self._last_id is None:
+                with self.engine.connect() as connection:
+                    self._last_id = self.last_event_id(connection)
+                return 0
+            condition = NotificationEvent.id > self._last_id
+            if self._gaps:
+                condition = or_(condition, NotificationEvent.id.in_(sorted(self._gaps)))
+            with self.engine.connect() as connection:
+                rows = connection.execute(
+                    select(NotificationEvent.id, NotificationEvent.origin, NotificationEvent.payload)
+                    .where(condition)
+                    .order_by(NotificationEvent.id)
+                    .limit(BROKER_POLL_BATCH)
+                ).all()
+            self._track(row[0] for row in rows)
+        delivered = 0
+        for event_id, origin, payload in rows:
+            if origin == self.origin or dispatch is None:
+                continue
+            item = json.loads(payload)
+            item['id'] = event_id
+            dispatch(item)
+            delivered += 1
+        return delivered
+
+    def _track(self, event_ids) -> None:
+        """Сдвигает последний прочитанный id и запоминает пропуски ниже него"""
+        now = time.time()
+        for event_id in event_ids:
+            if self._gaps.pop(event_id, None) is not None or event_id <= self._last_id:
+                continue
+            for missing in range(self._last_id + 1, min(event_id, self._last_id + 1 + BROKER_MAX_GAPS)):
+                self._gaps[missing] = now
+            self._last_id = event_id
+        expired = [event_id for event_id, since in self._gaps.items() if now - since > BROKER_GAP_TIMEOUT]
+        for event_id in expired:
+            del self._gaps[event_id]
+        if len(self._gaps) > BROKER_MAX_GAPS:
+            for event_id in sorted(self._gaps)[:len(self._gaps) - BROKER_MAX_GAPS]:
+                del self._gaps[event_id]
+
+    def prune(self) -> int:
+        """Удаляет события старше EVENT_RETENTION"""
+        with self.engine.begin() as connection:
+            return connection.execute(
+                NotificationEvent.__table__.delete()
+                .where(NotificationEvent.created_at < datetime.utcnow() - EVENT_RETENTION)
+            ).rowcount
+
+NOTIFICATION_BROKERS = {
+    MemoryBroker.name: MemoryBroker,
+    DatabaseBroker.name: DatabaseBroker,
+}
+
+def _sse(event_name: str, data: dict) -> str:
+    return f"event: {event_name}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+class RealtimeNotifications:
+    """Публикация событий уведомлений, кеш непрочитанных и SSE-потоки воркера"""
+
+    def __init__(self, broker: Optional[str] = None, bind=engine):
+        self.engine = bind
+        broker_name = broker or NOTIFICATION_BROKER
+        broker_class = NOTIFICATION_BROKERS.get(broker_name)
+        if broker_class is None:
+            raise ValueError(f"Неизвестный брокер уведомлений: {broker_name} (доступны: {', '.join(NOTIFICATION_BROKERS)})")
+        self.broker = broker_class(bind) if broker_class is DatabaseBroker else broker_class()
+        self.counter = UnreadCounter()
+        self.hub = NotificationHub()
+        self._started = False
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу событий брокера"""
+        NotificationEvent.__table__.create(self.engine, checkfirst=True)
+
+    def _ensure_started(self) -> None:
+        if not self._started:
+            self._started = True
+            self.broker.start(self.dispatch)
+
+    # --- Публикация ---
+
+    def publish(self, session, user_id: int, event_name: str, data: Optional[dict] = None,
+                unread_delta: int = 0, unread_reset: bool = False) -> None:
+        """Событие в транзакции сессии; доставляется после коммита, при откате отбрасывается"""
+        self.publish_many(session, [{
+            "user_id": user_id,
+            "event": event_name,
+            "data": data or {},
+            "unread_delta": unread_delta,
+            "unread_reset": unread_reset,
+        }])
+
+    def publish_many(self, session, events: List[dict]) -> None:
+        """Пачка событий одной записью в брокер"""
+        self.broker.publish(session, events)
+        session.info.setdefault('realtime_events', []).extend(events)
+
+    def publish_batch(self, session, user_ids: List[int], notification_ids: List[int], event_name: str,
+                      data: dict, unread_delta: int = 1) -> None:
+        """Одно событие на пачку получателей рассылки: общие данные и id уведомления каждого получателя"""
+        self.publish_many(session, [{
+            "user_ids": list(user_ids),
+            "notification_ids": list(notification_ids),
+            "event": event_name,
+            "data": data,
+            "unread_delta": unread_delta,
+            "unread_reset": False,
+        }])
+
+    def dispatch(self, item: dict) -> None:
+        """Применяет событие к счетчикам и отправляет его в подключения получателей"""
+        if 'user_ids' in item:
+            for user_id, notification_id in zip(item['user_ids'], item['notification_ids']):
+                self._deliver(user_id, item, {**item['data'], "id": notification_id})
+        else:
+            self._deliver(item['user_id'], item, item.get('data', {}))
+
+    def _deliver(self, user_id: int, item: dict, data: dict) -> None:
+        self.counter.apply(user_id, item.get('unread_delta', 0), item.get('unread_reset', False), item.get('id'))
+        self.hub.deliver(user_id, {
+            "event": item['event'],
+            "data": data,
+            "unread": self.counter.get(user_id),
+        })
+
+    # --- Непрочитанные ---
+
+    def unread_count(self, user_id: int) -> int:
+        """Непрочитанные уведомления: из памяти, COUNT(*) - при первом обращении и раз в UNREAD_TTL"""
+        self._ensure_started()
+        count = self.counter.get(user_id)
+        if count is not None:
+            return count
+        with self.engine.connect() as connection:
+            since_id = self.broker.last_event_id(connection)
+            count = connection.execute(
+                select(func.count()).select_from(Notification)
+                .where(Notification.user_id == user_id, Notification.is_read == False)
+            ).scalar()
+        self.counter.store(user_id, count, since_id)
+        return count
+
+    def badge(self, user_id: Optional[int]) -> int:
+        """Число для значка в меню; ошибки не ломают страницу"""
+        if not user_id:
+            return 0
+        try:
+            return self.unread_count(user_id)
+        except Exception as e:
+            print(f"Ошибка подсчета непрочитанных уведомлений: {e}")
+            return 0
+
+    # --- SSE ---
+
+    async def stream(self, user_id: int, request=None):
+        """Поток SSE пользователя: текущий счетчик, затем события уведомлений"""
+        self._ensure_started()
+        queue = self.hub.subscribe(user_id)
+        try:
+            unread = await run_in_threadpool(self.unread_count, user_id)
+            yield f"retry: 5000\n{_sse('unread', {'unread': unread})}"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if request is not None and await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if message['unread'] is None:
+                    message['unread'] = await run_in_threadpool(self.unread_count, user_id)
+                yield _sse(message['event'], message)
+        finally:
+            self.hub.unsubscribe(user_id, queue)
+
+    def install_hooks(self, session_factory=SessionLocal) -> None:
+        """Доставляет события после коммита транзакции"""
+        if event.contains(session_factory, 'after_commit', _after_commit):
+            return
+        event.listen(session_factory, 'after_commit', _after_commit)
+        event.listen(session_factory, 'after_rollback', _discard_events)
+
+def _after_commit(session):
+    for item in session.info.pop('realtime_events', ()):
+        realtime_notifications.dispatch(item)
+
+def _discard_events(session):
+    session.info.pop('realtime_events', None)
+
+# Глобальный экземпляр уведомлений в реальном времени
+realtime_notifications = RealtimeNotifications()
@@ -0,0 +1,383 @@
+"""
+Полнотекстовый поиск по компаниям, инвесторам, новостям и вакансиям.
+
+Индекс хранится в той же базе: на SQLite - виртуальная таблица FTS5 (ранжирование bm25),
+на PostgreSQL - колонка tsvector с GIN индексом (ранжирование ts_rank_cd).
+Для названий дополнительно ведется триграммный индекс по нормализованному ключу (транслитерация
+кириллицы в латиницу): он находит "Uzum" по запросу "Узум" и терпит опечатки.
+Индексы обновляются в той же транзакции, что и сами записи (события after_insert/after_update/after_delete).
+"""
+
+import math
+import re
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from markupsafe import Markup, escape
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.orm import joinedload
+
+from db import engine, SessionLocal
+from models import Company, Investor, News, Job, SearchName, SearchTrigram
+from utils.transliteration import normalize_search_key, trigrams
+from .backfill import run_backfill
+
+# Поля документа: (заголовок, поля текста). Заголовок весит больше при ранжировании
+SEARCH_FIELDS = {
+    'company': ('name', ('description', 'industry', 'country', 'city', 'stage')),
+    'investor': ('name', ('description', 'focus', 'country', 'stages')),
+    'news': ('title', ('summary', 'content')),
+    'job': ('title', ('description', 'city', 'job_type', 'contact')),
+}
+
+SEARCH_MODELS = {
+    'company': Company,
+    'investor': Investor,
+    'news': News,
+    'job': Job,
+}
+
+# Связи, которые нужны шаблону результатов поиска
+SEARCH_RELATIONS = {
+    'news': ('author',),
+    'job': ('company',),
+}
+
+SearchHit = namedtuple('SearchHit', ['entity_type', 'entity_id', 'rank', 'snippet'])
+
+# Маркеры подсветки внутри сниппета; заменяются на <mark> после экранирования текста
+_HIGHLIGHT_START = '\x02'
+_HIGHLIGHT_END = '\x03'
+
+def tokenize_query(q: str) -> List[str]:
+    """Слова запроса без спецсимволов синтаксиса FTS"""
+    return re.findall(r'\w+', q.lower())
+
+def build_document(entity_type: str, obj: Any) -> Optional[Tuple[str, str]]:
+    """Заголовок и текст документа; None - запись не должна быть в индексе"""
+    if getattr(obj, 'status', 'active') != 'active':
+        return None
+    title_field, body_fields = SEARCH_FIELDS[entity_type]
+    title = getattr(obj, title_field) or ''
+    body = ' · '.join(str(getattr(obj, field)) for field in body_fields if getattr(obj, field))
+    return title, body
+
+# Доля триграмм запроса, которая должна найтись в названии
+FUZZY_MIN_COVERAGE = 0.5
+
+def _render_snippet(raw: Optional[str]) -> Markup:
+    """Экранирует сниппет и превращает маркеры в <mark>"""
+    if not raw:
+        return Markup('')
+    escaped = str(escape(raw))
+    return Markup(escaped.replace(_HIGHLIGHT_START, '<mark>').replace(_HIGHLIGHT_END, '</mark>'))
+
+class SQLiteSearchBackend:
+    """Индекс на FTS5; rowid кодирует тип и id сущности, поэтому обновление - поиск по первичному ключу"""
+
+    _TYPE_CODES = {'company': 1, 'investor': 2, 'news': 3, 'job': 4}
+
+    def _rowid(self, entity_type: str, entity_id: int) -> int:
+        return entity_id * 8 + self._TYPE_CODES[entity_type]
+
+    def create_schema(self, connection) -> None:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "title, body, entity_type UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+
+    def is_empty(self, connection) -> bool:
+        return connection.execute(text("SELECT 1 FROM search_index LIMIT 1")).first() is None
+
+    def upsert(self, connection, entity_type: str, entity_id: int, title: str, body: str) -> None:
+        rowid = self._rowid(entity_type, entity_id)
+        connection.execute(text("DELETE FROM search_index WHERE rowid = :rowid"), {"rowid": rowid})
+        connection.execute(
+            text("INSERT INTO search_index (rowid, title, body, entity_type) VALUES (:rowid, :title, :body, :entity_type)"),
+            {"rowid": rowid, "title": title, "body": body, "entity_type": entity_type}
+        )
+
+    def delete(self, connection, entity_type: str, entity_id: int) -> None:
+        connection.execute(
+            text("DELETE FROM search_index WHERE rowid = :rowid"),
+            {"rowid": self._rowid(entity_type, entity_id)}
+        )
+
+    def clear(self, connection) -> None:
+        connection.execute(text("DELETE FROM search_index"))
+
+    def search(self, connection, entity_type: str, tokens: List[str], limit: int) -> List[SearchHit]:
+        # Каждое слово - префиксный поиск, слова объединяются через AND
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        rows = connection.execute(text(
+            "SELECT rowid, bm25(search_index, 10.0, 1.0) AS rank, "
+            "snippet(search_index, 1, :start, :end, '…', 16) "
+            "FROM search_index WHERE search_index MATCH :match AND entity_type = :entity_type "
+            "ORDER BY rank LIMIT :limit"
+        ), {
+            "match": match, "entity_type": entity_type, "limit": limit,
+            "start": _HIGHLIGHT_START, "end": _HIGHLIGHT_END
+        })
+        # bm25 в SQLite тем лучше, чем меньше - переворачиваем знак
+        return [SearchHit(entity_type, rowid >> 3, -rank, _render_snippet(snippet)) for rowid, rank, snippet in rows]
+
+class PostgresSearchBackend:
+    """Индекс на tsvector с GIN индексом"""
+
+    def create_schema(self, connection) -> None:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS search_document ("
+            "entity_type VARCHAR(16) NOT NULL, entity_id INTEGER NOT NULL, "
+            "title TEXT, body TEXT, document TSVECTOR, "
+            "PRIMARY KEY (entity_type, entity_id))"
+        ))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_document_document ON search_document USING GIN (document)"
+        ))
+
+    def is_empty(self, connection) -> bool:
+        return connection.execute(text("SELECT 1 FROM search_document LIMIT 1")).first() is None
+
+    def upsert(self, connection, entity_type: str, entity_id: int, title: str, body: str) -> None:
+        connection.execute(text(
+            "INSERT INTO search_document (entity_type, entity_id, title, body, document) "
+            "VALUES (:entity_type, :entity_id, :title, :body, "
+            "setweight(to_tsvector('simple', :title), 'A') || setweight(to_tsvector('simple', :body), 'B')) "
+            "ON CONFLICT (entity_type, entity_id) DO UPDATE SET "
+            "title = EXCLUDED.title, body = EXCLUDED.body, document = EXCLUDED.document"
+        ), {"entity_type": entity_type, "entity_id": entity_id, "title": title, "body": body})
+
+    def delete(self, connection, entity_type: str, entity_id: int) -> None:
+        connection.execute(
+            text("DELETE FROM search_document WHERE entity_type = :entity_type AND entity_id = :entity_id"),
+            {"entity_type": entity_type, "entity_id": entity_id}
+        )
+
+    def clear(self, connection) -> None:
+        connection.execute(text("DELETE FROM search_document"))
+
+    def search(self, connection, entity_type: str, tokens: List[str], limit: int) -> List[SearchHit]:
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        rows = connection.execute(text(
+            "SELECT entity_id, ts_rank_cd(document, query) AS rank, "
+            "ts_headline('simple', coalesce(body, ''), query, :options) "
+            "FROM search_document, to_tsquery('simple', :tsquery) query "
+            "WHERE entity_type = :entity_type AND document @@ query "
+            "ORDER BY rank DESC LIMIT :limit"
+        ), {
+            "tsquery": tsquery, "entity_type": entity_type, "limit": limit,
+            "options": f'StartSel="{_HIGHLIGHT_START}", StopSel="{_HIGHLIGHT_END}", MaxWords=30, MinWords=10'
+        })
+        return [SearchHit(entity_type, entity_id, rank, _render_snippet(snippet)) for entity_id, rank, snippet in rows]
+
+class TrigramNameIndex:
+    """Нечеткий поиск по названиям: триграммы нормализованного ключа в таблице search_trigram.
+
+    Число триграмм каждого названия хранится заранее, поэтому сходство (доля общих триграмм)
+    считается одним запросом по первичному ключу (entity_type, trigram) без обращения к search_name.
+    Других индексов у search_trigram нет: иначе SQLite без ANALYZE выбирает индекс по entity_type
+    и читает все триграммы типа. Строки названия удаляются по первичному ключу - триграммы
+    восстанавливаются из ключа в search_name.
+    """
+
+    def is_empty(self, connection) -> bool:
+        return connection.execute(select(SearchName.entity_id).limit(1)).first() is None
+
+    def upsert(self, connection, entity_type: str, entity_id: int, name: str, is_active: bool) -> None:
+        self.delete(connection, entity_type, entity_id)
+        key = normalize_search_key(name)[:512]
+        key_trigrams = trigrams(key)
+        if not key_trigrams:
+            return
+        connection.execute(SearchName.__table__.insert(), {
+            "entity_type": entity_type, "entity_id": entity_id, "search_key": key[:512],
+            "trigram_count": len(key_trigrams), "is_active": is_active
+        })
+        connection.execute(SearchTrigram.__table__.insert(), [
+            {"entity_type": entity_type, "trigram": trigram, "entity_id": entity_id,
+             "trigram_count": len(key_trigrams), "is_active": is_active}
+            for trigram in key_trigrams
+        ])
+
+    def delete(self, connection, entity_type: str, entity_id: int) -> None:
+        names = SearchName.__table__
+        key = connection.execute(
+            select(names.c.search_key).where(names.c.entity_type == entity_type, names.c.entity_id == entity_id)
+        ).scalar()
+        if key is None:
+            return
+        index = SearchTrigram.__table__
+        connection.execute(index.delete().where(
+            index.c.entity_type == entity_type, index.c.trigram.in_(sorted(trigrams(key))),
+            index.c.entity_id == entity_id
+        ))
+        connection.execute(names.delete().where(names.c.entity_type == entity_type, names.c.entity_id == entity_id))
+
+    def clear(self, connection) -> None:
+        connection.execute(SearchTrigram.__table__.delete())
+        connection.execute(SearchName.__table__.delete())
+
+    def search(self, connection, entity_type: str, q: str, limit: int,
+               active_only: bool = True, prefix: bool = False) -> List[SearchHit]:
+        query_trigrams = trigrams(normalize_search_key(q), prefix=prefix)
+        if not query_trigrams:
+            return []
+        index = SearchTrigram.__table__
+        shared = func.count()
+        statement = (
+            select(index.c.entity_id, shared, index.c.trigram_count)
+            .where(index.c.entity_type == entity_type, index.c.trigram.in_(sorted(query_trigrams)))
+            .group_by(index.c.entity_id, index.c.trigram_count)
+            .having(shared >= max(1, math.ceil(len(query_trigrams) * FUZZY_MIN_COVERAGE)))
+            # Больше общих триграмм, затем короче название - выше сходство
+            .order_by(shared.desc(), index.c.trigram_count, index.c.entity_id)
+            .limit(limit)
+        )
+        if active_only:
+            statement = statement.where(index.c.is_active == True)
+        return [
+            SearchHit(entity_type, entity_id, count / (len(query_trigrams) + trigram_count - count), Markup(''))
+            for entity_id, count, trigram_count in connection.execute(statement)
+        ]
+
+class SearchService:
+    """Сервис полнотекстового поиска"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+        if bind.dialect.name == 'postgresql':
+            self.backend = PostgresSearchBackend()
+        else:
+            self.backend = SQLiteSearchBackend()
+        self.names = TrigramNameIndex()
+
+    def ensure_schema(self) -> None:
+        """Создает таблицы индексов, если их нет"""
+        with self.engine.begin() as connection:
+            self.backend.create_schema(connection)
+            SearchName.__table__.create(connection, checkfirst=True)
+            SearchTrigram.__table__.create(connection, checkfirst=True)
+
+    def index_object(self, connection, entity_type: str, obj: Any) -> None:
+        """Добавляет, обновляет или убирает запись из индекса"""
+        document = build_document(entity_type, obj)
+        if document is None:
+            self.backend.delete(connection, entity_type, obj.id)
+        else:
+            self.backend.upsert(connection, entity_type, obj.id, *document)
+        # Названия индексируются для всех статусов: автокомплит админки ищет и по неактивным
+        title_field = SEARCH_FIELDS[entity_type][0]
+        self.names.upsert(connection, entity_type, obj.id, getattr(obj, title_field) or '', obj.status == 'active')
+
+    def remove_object(self, connection, entity_type: str, entity_id: int) -> None:
+        self.backend.delete(connection, entity_type, entity_id)
+        self.names.delete(connection, entity_type, entity_id)
+
+    def search(self, q: str, entity_types: Iterable[str] = tuple(SEARCH_FIELDS), limit: int = 20) -> Dict[str, List[SearchHit]]:
+        """Результаты по типам сущностей, отсортированные по релевантности"""
+        tokens = tokenize_query(q)
+        if not tokens:
+            return {entity_type: [] for entity_type in entity_types}
+        with self.engine.connect() as connection:
+            return {
+                entity_type: self.backend.search(connection, entity_type, tokens, limit)
+                for entity_type in entity_types
+            }
+
+    def fuzzy_search(self, entity_type: str, q: str, limit: int = 20,
+                     active_only: bool = True, prefix: bool = False) -> List[SearchHit]:
+        """Нечеткий поиск по названиям с учетом транслитерации и опечаток"""
+        with self.engine.connect() as connection:
+            return self.names.search(connection, entity_type, q, limit, active_only=active_only, prefix=prefix)
+
+    def match_ids(self, entity_type: str, q: str, limit: int = 1000) -> List[int]:
+        """id активных сущностей по релевантности: сначала полнотекстовые совпадения, затем похожие названия"""
+        hits = self.search(q, entity_types=[entity_type], limit=limit)[entity_type]
+        hits += self.fuzzy_search(entity_type, q, limit=limit)
+        return list(dict.fromkeys(hit.entity_id for hit in hits))[:limit]
+
+    def search_entities(self, db, q: str, limit: int = 20) -> Tuple[Dict[str, list], Dict[str, Markup]]:
+        """Объекты найденных сущностей в порядке релевантности и сниппеты по ключу 'тип:id'"""
+        hits = self.search(q, limit=limit)
+        results = {}
+        snippets = {}
+        for entity_type, entity_hits in hits.items():
+            # Похожие названия (другая письменность, опечатки) - после полнотекстовых совпадений
+            found = {hit.entity_id for hit in entity_hits}
+            fuzzy_hits = [hit for hit in self.fuzzy_search(entity_type, q, limit=limit) if hit.entity_id not in found]
+            entity_hits = (entity_hits + fuzzy_hits)[:limit]
+            results[entity_type] = self.load_objects(db, entity_type, [hit.entity_id for hit in entity_hits])
+            for hit in entity_hits:
+                snippets[f"{entity_type}:{hit.entity_id}"] = hit.snippet
+        return results, snippets
+
+    def load_objects(self, db, entity_type: str, ids: List[int]) -> list:
+        """Загружает сущности по id, сохраняя порядок"""
+        if not ids:
+            return []
+        model = SEARCH_MODELS[entity_type]
+        options = [joinedload(getattr(model, relation)) for relation in SEARCH_RELATIONS.get(entity_type, ())]
+        objects = db.query(model).options(*options).filter(model.id.in_(ids)).all()
+        by_id = {obj.id: obj for obj in objects}
+        return [by_id[entity_id] for entity_id in ids if entity_id in by_id]
+
+    def rebuild(self, batch_size: int = 500) -> Dict[str, int]:
+        """Полностью перестраивает индексы (для первичного заполнения и восстановления)"""
+        counts = {}
+        db = SessionLocal()
+        try:
+            with self.engine.begin() as connection:
+                self.backend.clear(connection)
+                self.names.clear(connection)
+                for entity_type, model in SEARCH_MODELS.items():
+                    counts[entity_type] = 0
+                    for obj in db.query(model).yield_per(batch_size):
+                        self.index_object(connection, entity_type, obj)
+                        counts[entity_type] += 1
+        finally:
+            db.close()
+        return counts
+
+    def rebuild_if_empty(self) -> None:
+        """Заполняет индексы при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'search',
+            lambda connection: self.backend.is_empty(connection) or self.names.is_empty(connection),
+            self.rebuild
+        )
+        if counts and any(counts.values()):
+            print(f"Поисковый индекс заполнен: {counts}")
+
+    def install_hooks(self) -> None:
+        """Подписывает индекс на изменения моделей"""
+        for entity_type, model in SEARCH_MODELS.items():
+            if event.contains(model, 'after_insert', _after_insert):
+                continue
+            event.listen(model, 'after_insert', _after_insert)
+            event.listen(model, 'after_update', _after_update)
+            event.listen(model, 'after_delete', _after_delete)
+
+_ENTITY_TYPES_BY_TABLE = {model.__tablename__: entity_type for entity_type, model in SEARCH_MODELS.items()}
+
+def _search_fields_changed(entity_type: str, obj: Any) -> bool:
+    """Изменились ли поля, попадающие в индекс (например, счетчик просмотров не в счет)"""
+    title_field, body_fields = SEARCH_FIELDS[entity_type]
+    state = inspect(obj)
+    for field in (title_field, 'status') + tuple(body_fields):
+        if state.attrs[field].history.has_changes():
+            return True
+    return False
+
+def _after_insert(mapper, connection, target):
+    search_service.index_object(connection, _ENTITY_TYPES_BY_TABLE[target.__tablename__], target)
+
+def _after_update(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    if _search_fields_changed(entity_type, target):
+        search_service.index_object(connection, entity_type, target)
+
+def _after_delete(mapper, connection, target):
+    search_service.remove_object(connection, _ENTITY_TYPES_BY_TABLE[target.__tablename__], target.id)
+
+# Глобальный экземпляр сервиса поиска
+search_service = SearchService()
@@ -0,0 +1,477 @@
+"""
+Похожие компании: косинусная близость векторов признаков с предрассчитанными списками соседей.
+
+Признаки компании - страна и стадия (one-hot), теги индустрии (как в services/tags.py) и термины
+описания (хеширование в фиксированное число измерений, TF-IDF). Блоки нормируются, умножаются на
+веса и склеиваются в одну строку матрицы NumPy; top-k соседей считается умножением матриц пачками
+и хранится в таблице company_similar. Страница компании читает готовый список.
+
+Матрица признаков и близость k-го соседа каждого списка хранятся в памяти воркера. После коммита
+изменений компаний в фоне перекодируются только измененные строки: их списки и списки, где они уже
+есть, пересчитываются целиком, а в списки, куда они теперь проходят по порогу, вставляются без
+пересчета. Словари и IDF фиксируются при полном чтении матрицы (раз в FEATURE_CACHE_TTL секунд или
+при новой стране, стадии или теге).
+"""
+
+import re
+import threading
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import event, func, inspect, or_, select
+from sqlalchemy.orm import object_session
+
+from db import engine, SessionLocal
+from models import Company, CompanySimilar
+from .backfill import run_backfill
+from .tags import parse_tags
+
+# Сколько соседей хранится на компанию
+SIMILAR_TOP_K = 10
+
+# Измерения хешированных терминов описания
+TERM_DIMENSIONS = 1024
+
+# Веса блоков признаков
+FEATURE_WEIGHTS = {
+    'industry': 2.0,
+    'description': 1.5,
+    'stage': 1.0,
+    'country': 1.0,
+}
+
+# Поля, изменение которых меняет признаки
+SIMILARITY_FIELDS = ('country', 'stage', 'industry', 'description', 'status')
+
+# Через сколько секунд матрица признаков в памяти перечитывается целиком (обновляются словари и IDF)
+FEATURE_CACHE_TTL = 3600
+
+# Запас по updated_at при поиске компаний, измененных другими воркерами
+_SYNC_SKEW = timedelta(seconds=5)
+
+_COMPANY_COLUMNS = (Company.id, Company.country, Company.stage, Company.industry, Company.description,
+                    Company.status, Company.updated_at)
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+_STEM_LENGTH = 6
+_STOP_WORDS = {
+    'and', 'the', 'for', 'with', 'from', 'that', 'this', 'are', 'our',
+    'для', 'что', 'как', 'это', 'или', 'при', 'все', 'так', 'его', 'более', 'также', 'других', 'через',
+}
+
+def description_terms(text: Optional[str]) -> List[str]:
+    """Термины описания: нижний регистр, без коротких слов и чисел, усечение до основы"""
+    if not text:
+        return []
+    terms = []
+    for word in _TERM.findall(text.lower()):
+        if len(word) < 3 or word.isdigit() or word in _STOP_WORDS:
+            continue
+        terms.append(word[:_STEM_LENGTH])
+    return terms
+
+def term_bucket(term: str) -> int:
+    """Измерение термина; crc32 одинаков во всех процессах, в отличие от hash()"""
+    return zlib.crc32(term.encode('utf-8')) % TERM_DIMENSIONS
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def _vocabulary(values: Iterable[Optional[str]]) -> Dict[str, int]:
+    return {value: index for index, value in enumerate(sorted({value for value in values if value}))}
+
+def _industry_tags(row: tuple) -> List[str]:
+    return [slug for slug, _ in parse_tags(row[3])]
+
+def _term_counts(texts: List[Optional[str]]) -> np.ndarray:
+    """Хешированные термины описаний, логарифм частоты"""
+    block = np.zeros((len(texts), TERM_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for term in description_terms(text):
+            block[row, term_bucket(term)] += 1
+    return np.log1p(block, out=block)
+
+class FeatureEncoder:
+    """Словари стран, стадий и тегов и IDF терминов, зафиксированные по корпусу; кодирует любые строки в тех же столбцах"""
+
+    def __init__(self, countries: Dict[str, int], stages: Dict[str, int], tags: Dict[str, int], idf: np.ndarray):
+        self.countries = countries
+        self.stages = stages
+        self.tags = tags
+        self.idf = idf
+
+    @classmethod
+    def fit(cls, rows: List[tuple]) -> Tuple['FeatureEncoder', np.ndarray]:
+        """Словари и IDF по строкам (id, country, stage, industry, description) и матрица признаков этих строк"""
+        terms = _term_counts([row[4] for row in rows])
+        document_frequency = np.count_nonzero(terms, axis=0)
+        encoder = cls(
+            _vocabulary(row[1] for row in rows),
+            _vocabulary(row[2] for row in rows),
+            _vocabulary(tag for row in rows for tag in _industry_tags(row)),
+            np.log((1 + len(rows)) / (1 + document_frequency)).astype(np.float32) + 1,
+        )
+        return encoder, encoder.encode(rows, terms)
+
+    def covers(self, rows: List[tuple]) -> bool:
+        """Все страны, стадии и теги строк есть в словарях (иначе нужен полный пересчет)"""
+        return all(
+            (not row[1] or row[1] in self.countries) and (not row[2] or row[2] in self.stages)
+            and all(tag in self.tags for tag in _industry_tags(row))
+            for row in rows
+        )
+
+    def encode(self, rows: List[tuple], terms: Optional[np.ndarray] = None) -> np.ndarray:
+        """Матрица признаков строк; блоки нормированы, взвешены и склеены, строки нормированы"""
+        if terms is None:
+            terms = _term_counts([row[4] for row in rows])
+        country = np.zeros((len(rows), max(len(self.countries), 1)), dtype=np.float32)
+        stage = np.zeros((len(rows), max(len(self.stages), 1)), dtype=np.float32)
+        industry = np.zeros((len(rows), max(len(self.tags), 1)), dtype=np.float32)
+        for index, row in enumerate(rows):
+            if row[1]:
+                country[index, self.countries[row[1]]] = 1
+            if row[2]:
+                stage[index, self.stages[row[2]]] = 1
+            for tag in _industry_tags(row):
+                industry[index, self.tags[tag]] = 1
+        blocks = [
+            country * FEATURE_WEIGHTS['country'],
+            stage * FEATURE_WEIGHTS['stage'],
+            _normalize_rows(industry) * FEATURE_WEIGHTS['industry'],
+            _normalize_rows(terms * self.idf) * FEATURE_WEIGHTS['description'],
+        ]
+        return _normalize_rows(np.hstack(blocks))
+
+def encode_companies(rows: List[tuple]) -> np.ndarray:
+    """Матрица признаков по строкам (id, country, stage, industry, description); строки нормированы"""
+    return FeatureEncoder.fit(rows)[1]
+
+def top_k(features: np.ndarray, rows: np.ndarray, k: int = SIMILAR_TOP_K,
+          batch_size: int = 1024) -> Iterable[Tuple[int, np.ndarray, np.ndarray]]:
+    """Соседи строк rows: (строка, индексы соседей, близость) по убыванию близости, без самой строки"""
+    k = min(k, len(features) - 1)
+    if k <= 0:
+        return
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        scores = features[batch] @ features.T
+        scores[np.arange(len(batch)), batch] = -1
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        for offset, row in enumerate(batch):
+            positive = candidate_scores[offset] > 0
+            yield int(row), candidates[offset][positive], candidate_scores[offset][positive]
+
+class FeatureMatrix:
+    """Матрица признаков активных компаний в памяти воркера и k-я близость каждого сохраненного списка"""
+
+    def __init__(self, encoder: FeatureEncoder, rows: List[tuple], features: np.ndarray, loaded_at: datetime):
+        self.encoder = encoder
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.features = features
+        # Близость k-го соседа; -1 - список короче k, в него проходит любая положительная близость
+        self.thresholds = np.full(len(rows), -1.0, dtype=np.float32)
+        self.positions = {int(company_id): index for index, company_id in enumerate(self.ids)}
+        self.versions = {row[0]: row[6] for row in rows}
+        self.free: List[int] = []
+        self.loaded_at = self.synced_at = loaded_at
+
+    def put(self, rows: List[tuple]) -> None:
+        """Перекодирует строки компаний; новые занимают освободившиеся строки матрицы или дописываются в конец"""
+        for row, vector in zip(rows, self.encoder.encode(rows)):
+            position = self.positions.get(row[0])
+            if position is None:
+                if not self.free:
+                    self._grow()
+                position = self.free.pop()
+                self.ids[position] = row[0]
+                self.thresholds[position] = -1
+                self.positions[row[0]] = position
+            self.features[position] = vector
+            self.versions[row[0]] = row[6]
+
+    def remove(self, company_id: int) -> None:
+        """Обнуляет строку удаленной или скрытой компании (нулевая близость не попадает в списки)"""
+        position = self.positions.pop(company_id, None)
+        self.versions.pop(company_id, None)
+        if position is not None:
+            self.ids[position] = -1
+            self.features[position] = 0
+            self.thresholds[position] = -1
+            self.free.append(position)
+
+    def _grow(self) -> None:
+        size = len(self.ids)
+        extra = max(size // 4, 64)
+        self.ids = np.concatenate([self.ids, np.full(extra, -1, dtype=np.int64)])
+        self.features = np.vstack([self.features, np.zeros((extra, self.features.shape[1]), dtype=np.float32)])
+        self.thresholds = np.concatenate([self.thresholds, np.full(extra, -1.0, dtype=np.float32)])
+        self.free.extend(range(size + extra - 1, size - 1, -1))
+
+class SimilarityEngine:
+    """Расчет и хранение списков похожих компаний"""
+
+    def __init__(self, bind=engine, k: int = SIMILAR_TOP_K):
+        self.engine = bind
+        self.k = k
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: Set[int] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._matrix: Optional[FeatureMatrix] = None
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу соседей, если ее нет"""
+        CompanySimilar.__table__.create(self.engine, checkfirst=True)
+
+    def _load(self, connection) -> FeatureMatrix:
+        """Полностью перечитывает и кодирует активные компании (словари и IDF фиксируются заново)"""
+        now = datetime.utcnow()
+        rows = connection.execute(
+            select(*_COMPANY_COLUMNS).where(Company.status == 'active').order_by(Company.id)
+        ).all()
+        encoder, features = FeatureEncoder.fit(rows)
+        self._matrix = FeatureMatrix(encoder, rows, features, now)
+        self._load_thresholds(connection, self._matrix)
+        return self._matrix
+
+    def _load_thresholds(self, connection, matrix: FeatureMatrix) -> None:
+        matrix.thresholds[:] = -1
+        for company_id, score in connection.execute(
+            select(CompanySimilar.company_id, CompanySimilar.score).where(CompanySimilar.rank == self.k - 1)
+        ):
+            if company_id in matrix.positions:
+                matrix.thresholds[matrix.positions[company_id]] = score
+
+    def _sync(self, connection, changed: Set[int]) -> FeatureMatrix:
+        """Матрица с перекодированными измененными компаниями, в том числе измененными другими воркерами"""
+        matrix = self._matrix
+        now = datetime.utcnow()
+        if matrix is None or now - matrix.loaded_at > timedelta(seconds=FEATURE_CACHE_TTL):
+            return self._load(connection)
+        rows = connection.execute(
+            select(*_COMPANY_COLUMNS).where(or_(
+                Company.id.in_(list(changed)), Company.updated_at >= matrix.synced_at - _SYNC_SKEW
+            ))
+        ).all()
+        active, foreign = [], False
+        for row in rows:
+            if row[0] not in changed:
+                if row[5] == 'active' and matrix.versions.get(row[0]) == row[6]:
+                    continue
+                if row[5] != 'active' and row[0] not in matrix.positions:
+                    continue
+                foreign = True
+            if row[5] == 'active':
+                active.append(row)
+            else:
+                matrix.remove(row[0])
+        for company_id in changed - {row[0] for row in rows}:
+            matrix.remove(company_id)
+        if not matrix.encoder.covers(active):
+            return self._load(connection)
+        matrix.put(active)
+        matrix.synced_at = now
+
+        # Удаления в других воркерах не видны по updated_at - сверяем число активных компаний
+        total = connection.execute(select(func.count()).select_from(Company).where(Company.status == 'active')).scalar()
+        if total != len(matrix.positions):
+            return self._load(connection)
+        if foreign:
+            self._load_thresholds(connection, matrix)
+        return matrix
+
+    def _threshold(self, scores) -> float:
+        return float(scores[self.k - 1]) if len(scores) >= self.k else -1.0
+
+    def _insert(self, connection, values: List[dict]) -> None:
+        for start in range(0, len(values), 5000):
+            connection.execute(CompanySimilar.__table__.insert(), values[start:start + 5000])
+
+    def _delete(self, connection, company_ids: List[int]) -> None:
+        for start in range(0, len(company_ids), 500):
+            connection.execute(CompanySimilar.__table__.delete().where(
+                CompanySimilar.company_id.in_(company_ids[start:start + 500])
+            ))
+
+    def _store(self, connection, matrix: FeatureMatrix, rows: np.ndarray) -> None:
+        """Пересчитывает и записывает списки для строк матрицы rows"""
+        ids = matrix.ids
+        self._delete(connection, [int(ids[row]) for row in rows])
+        values = []
+        for row, neighbours, scores in top_k(matrix.features, rows, self.k):
+            values.extend(
+                {"company_id": int(ids[row]), "rank": rank, "similar_id": int(ids[neighbour]), "score": float(score)}
+                for rank, (neighbour, score) in enumerate(zip(neighbours, scores))
+            )
+            matrix.thresholds[row] = self._threshold(scores)
+            if len(values) >= 5000:
+                self._insert(connection, values)
+                values = []
+        self._insert(connection, values)
+
+    def _merge(self, connection, matrix: FeatureMatrix, rows: np.ndarray, present: np.ndarray, scores: np.ndarray) -> None:
+        """Вставляет измененные компании в списки, куда они прошли по порогу; остальные соседи берутся из таблицы"""
+        company_ids = [int(matrix.ids[row]) for row in rows]
+        lists: Dict[int, List[Tuple[int, float]]] = {company_id: [] for company_id in company_ids}
+        for start in range(0, len(company_ids), 500):
+            for company_id, similar_id, score in connection.execute(
+                select(CompanySimilar.company_id, CompanySimilar.similar_id, CompanySimilar.score)
+                .where(CompanySimilar.company_id.in_(company_ids[start:start + 500]))
+                .order_by(CompanySimilar.company_id, CompanySimilar.rank)
+            ):
+                lists[company_id].append((similar_id, score))
+        self._delete(connection, company_ids)
+        candidates = [int(company_id) for company_id in matrix.ids[present]]
+        values = []
+        for row, company_id, row_scores in zip(rows, company_ids, scores):
+            merged = lists[company_id] + [
+                (candidate, float(score)) for candidate, score in zip(candidates, row_scores) if score > 0
+            ]
+            merged.sort(key=lambda item: -item[1])
+            merged = merged[:self.k]
+            values.extend(
+                {"company_id": company_id, "rank": rank, "similar_id": similar_id, "score": score}
+                for rank, (similar_id, score) in enumerate(merged)
+            )
+            matrix.thresholds[row] = self._threshold([score for _, score in merged])
+        self._insert(connection, values)
+
+    def rebuild(self) -> Dict[str, int]:
+        """Полностью пересчитывает списки похожих компаний"""
+        with self._lock, self.engine.begin() as connection:
+            matrix = self._load(connection)
+            connection.execute(CompanySimilar.__table__.delete())
+            self._store(connection, matrix, np.array(sorted(matrix.positions.values()), dtype=np.int64))
+            stored = connection.execute(select(func.count()).select_from(CompanySimilar)).scalar()
+        return {'companies': len(matrix.positions), 'neighbours': stored}
+
+    def rebuild_if_empty(self) -> None:
+        """Заполняет списки при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'company_similar',
+            lambda connection: connection.execute(select(CompanySimilar.company_id).limit(1)).first() is None,
+            self.rebuild
+        )
+        if counts and counts['neighbours']:
+            print(f"Похожие компании рассчитаны: {counts}")
+
+    def refresh(self, company_ids: Iterable[int]) -> int:
+        """Инкрементальный пересчет после изменения компаний; возвращает число обновленных списков"""
+        changed = set(company_ids)
+        if not changed:
+            return 0
+        with self._lock:
+            try:
+                with self.engine.begin() as connection:
+                    return self._refresh(connection, changed)
+            except Exception:
+                # Кеш мог разойтись с откаченной транзакцией - следующий пересчет перечитает матрицу
+                self._matrix = None
+                raise
+
+    def _refresh(self, connection, changed: Set[int]) -> int:
+        matrix = self._sync(connection, changed)
+        positions = matrix.positions
+
+        # Списки, где измененные компании уже есть (в том числе удаленные или скрытые), пересчитываются целиком
+        affected = set(connection.execute(
+            select(CompanySimilar.company_id).where(CompanySimilar.similar_id.in_(list(changed)))
+        ).scalars())
+        gone = [company_id for company_id in changed if company_id not in positions]
+        if gone:
+            self._delete(connection, gone)
+        rows = np.array(sorted({positions[company_id] for company_id in affected | changed if company_id in positions}),
+                        dtype=np.int64)
+
+        # Списки, в которые измененная компания теперь проходит по порогу k-го соседа, дополняются без пересчета
+        present = np.array([positions[company_id] for company_id in changed if company_id in positions], dtype=np.int64)
+        entering = np.zeros(0, dtype=np.int64)
+        if len(present):
+            scores = matrix.features @ matrix.features[present].T
+            scores[present, np.arange(len(present))] = -1
+            passing = (scores > matrix.thresholds[:, None]) & (scores > 0)
+            passing[rows] = False
+            entering = np.nonzero(passing.any(axis=1))[0]
+
+        self._store(connection, matrix, rows)
+        if len(entering):
+            self._merge(connection, matrix, entering, present, scores[entering])
+        return len(rows) + len(entering)
+
+    def refresh_async(self, company_ids: Iterable[int]) -> None:
+        """Ставит пересчет в фоновый поток; изменения, пришедшие во время пересчета, объединяются"""
+        with self._pending_lock:
+            self._pending.update(company_ids)
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    def _drain(self) -> None:
+        while True:
+            with self._pending_lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                batch, self._pending = self._pending, set()
+            try:
+                self.refresh(batch)
+            except Exception as e:
+                print(f"Ошибка пересчета похожих компаний: {e}")
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """Ждет окончания фонового пересчета"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def similar(self, db, company_id: int, limit: int = 6) -> List[Company]:
+        """Похожие компании из сохраненного списка"""
+        return (
+            db.query(Company)
+            .join(CompanySimilar, CompanySimilar.similar_id == Company.id)
+            .filter(CompanySimilar.company_id == company_id, Company.status == 'active')
+            .order_by(CompanySimilar.rank)
+            .limit(limit)
+            .all()
+        )
+
+    def install_hooks(self, session_factory=SessionLocal) -> None:
+        """Подписывает пересчет на коммиты изменений компаний"""
+        if event.contains(session_factory, 'after_commit', _after_commit):
+            return
+        event.listen(Company, 'after_insert', _company_changed)
+        event.listen(Company, 'after_update', _company_updated)
+        event.listen(Company, 'after_delete', _company_changed)
+        event.listen(session_factory, 'after_commit', _after_commit)
+        event.listen(session_factory, 'after_rollback', _after_rollback)
+
+def _company_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('similar_dirty', set()).add(target.id)
+
+def _company_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in SIMILARITY_FIELDS):
+        _company_changed(mapper, connection, target)
+
+def _after_commit(session):
+    changed = session.info.pop('similar_dirty', None)
+    if changed:
+        similarity_engine.refresh_async(changed)
+
+def _after_rollback(session):
+    session.info.pop('similar_dirty', None)
+
+# Глобальный экземпляр движка похожих компаний
+similarity_engine = SimilarityEngine()
@@ -0,0 +1,305 @@
+"""
+Sitemap из предрассчитанных файлов.
+
+URL каждого типа сущностей делятся на файлы по диапазонам id (id // SITEMAP_CHUNK_SIZE), поэтому
+в файле не больше 50 000 URL, а запись в сущность затрагивает ровно один файл. После коммита записи
+в компанию, инвестора, новость, вакансию или мероприятие у ее файла в sitemap_chunk увеличивается
+version - отдельной короткой транзакцией, чтобы строка части не блокировалась до конца чужих транзакций
+записи (все компании части делят одну строку); при обращении к sitemap_index.xml перегенерируются только файлы, где version больше
+generated_version. Строки читаются потоково (stream_results + yield_per) и пишутся в файл по одной,
+содержимое хешируется по ходу записи - это ETag. Файлы отдаются с диска с ETag и 304 на If-None-Match.
+"""
+
+import hashlib
+import os
+import threading
+from datetime import datetime
+from typing import Optional, Set, Tuple
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+from sqlalchemy import event, select, text
+
+from db import engine, SessionLocal
+from models import Company, Event, Investor, Job, News, SitemapChunk
+from .backfill import run_backfill
+
+SITE_URL = os.getenv("SITE_URL", "https://stanbase.tech").rstrip('/')
+
+SITEMAP_DIR = os.getenv("SITEMAP_DIR", os.path.join("cache", "sitemaps"))
+
+# Лимит протокола sitemap - 50 000 URL в файле
+SITEMAP_CHUNK_SIZE = 50000
+
+SITEMAP_STREAM_BATCH = 1000
+
+_XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+_URLSET_OPEN = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+
+class SitemapType:
+    """Тип сущностей в sitemap: модель, путь страницы, частота и приоритет"""
+
+    def __init__(self, model, path: str, changefreq: str, priority: str, key: str = 'id'):
+        self.model = model
+        self.path = path
+        self.changefreq = changefreq
+        self.priority = priority
+        self.key = key
+
+    def columns(self) -> list:
+        """id, ключ URL и updated_at (у инвесторов и вакансий его нет - URL без lastmod)"""
+        columns = [self.model.id, getattr(self.model, self.key)]
+        if hasattr(self.model, 'updated_at'):
+            columns.append(self.model.updated_at)
+        return columns
+
+SITEMAP_TYPES = {
+    'company': SitemapType(Company, '/company/{}', 'weekly', '0.8'),
+    'investor': SitemapType(Investor, '/investor/{}', 'weekly', '0.8'),
+    'news': SitemapType(News, '/news/{}', 'monthly', '0.6', key='slug'),
+    'job': SitemapType(Job, '/job/{}', 'weekly', '0.5'),
+    'event': SitemapType(Event, '/event/{}', 'monthly', '0.5'),
+}
+
+_MODEL_TYPES = {spec.model: name for name, spec in SITEMAP_TYPES.items()}
+
+# Разделы сайта - отдельный статический файл
+SITEMAP_PAGES = [
+    ('/', 'daily', '1.0'),
+    ('/companies', 'daily', '0.9'),
+    ('/investors', 'daily', '0.9'),
+    ('/news', 'daily', '0.8'),
+    ('/jobs', 'daily', '0.7'),
+    ('/events', 'daily', '0.7'),
+    ('/analytics', 'weekly', '0.6'),
+]
+
+def _w3c(value: Optional[datetime]) -> str:
+    return value.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+def chunk_filename(entity_type: str, chunk: int) -> str:
+    """Имя файла части sitemap"""
+    return f"sitemap-{entity_type}-{chunk}.xml"
+
+class _HashingWriter:
+    """Запись во временный файл с подсчетом md5 - ETag без повторного чтения"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+        self.digest = hashlib.md5()
+
+    def write(self, chunk: str) -> None:
+        self.file.write(chunk)
+        self.digest.update(chunk.encode('utf-8'))
+
+    def commit(self) -> str:
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        return self.digest.hexdigest()
+
+    def abort(self) -> None:
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class SitemapService:
+    """Генерация и выдача файлов sitemap"""
+
+    def __init__(self, bind=engine, directory: str = SITEMAP_DIR, site_url: str = SITE_URL):
+        self.engine = bind
+        self.directory = directory
+        self.site_url = site_url
+        self._lock = threading.Lock()
+
+    def ensure_schema(self) -> None:
+        """Создает таблицу частей и каталог файлов"""
+        SitemapChunk.__table__.create(self.engine, checkfirst=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    # --- Отметка измененных частей ---
+
+    def mark(self, connection, keys: Set[Tuple[str, int]]) -> None:
+        """Увеличивает version частей"""
+        if not keys:
+            return
+        connection.execute(
+            text("INSERT INTO sitemap_chunk (entity_type, chunk, version, generated_version, url_count) "
+                 "VALUES (:entity_type, :chunk, 1, 0, 0) "
+                 "ON CONFLICT (entity_type, chunk) DO UPDATE SET version = sitemap_chunk.version + 1"),
+            [{"entity_type": entity_type, "chunk": chunk} for entity_type, chunk in sorted(keys)]
+        )
+
+    def mark_all(self) -> int:
+        """Отмечает все части всех типов (первый запуск, полная перегенерация)"""
+        keys = set()
+        with self.engine.begin() as connection:
+            for entity_type, spec in SITEMAP_TYPES.items():
+                chunks = connection.execute(
+                    select((spec.model.id // SITEMAP_CHUNK_SIZE).label('chunk')).distinct()
+                ).scalars()
+                keys.update((entity_type, int(chunk)) for chunk in chunks)
+            # Части, где сущностей больше нет, перегенерируются в пустые и удаляются
+            keys.update(connection.execute(select(SitemapChunk.entity_type, SitemapChunk.chunk)).all())
+            self.mark(connection, keys)
+        return len(keys)
+
+    def mark_all_if_empty(self) -> None:
+        """Отмечает все части при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        run_backfill(
+            self.engine, 'sitemap_chunk',
+            lambda connection: connection.execute(select(SitemapChunk.chunk).limit(1)).first() is None,
+            self.mark_all
+        )
+
+    # --- Генерация ---
+
+    def _write_chunk(self, entity_type: str, chunk: int) -> Tuple[int, Optional[str], Optional[datetime]]:
+        spec = SITEMAP_TYPES[entity_type]
+        model = spec.model
+        start, end = chunk * SITEMAP_CHUNK_SIZE, (chunk + 1) * SITEMAP_CHUNK_SIZE
+        path = self.path(chunk_filename(entity_type, chunk))
+        writer = _HashingWriter(path)
+        count, lastmod = 0, None
+        db = SessionLocal()
+        try:
+            writer.write(_XML_HEADER + _URLSET_OPEN)
+            rows = (
+                db.query(*spec.columns())
+                .filter(model.id >= start, model.id < end, model.status == 'active')
+                .order_by(model.id)
+                .execution_options(stream_results=True)
+                .yield_per(SITEMAP_STREAM_BATCH)
+            )
+            for row in rows:
+                key = row[1]
+                if not key:
+                    continue
+                updated_at = row[2] if len(row) > 2 else None
+                entry = f'  <url>\n    <loc>{escape(self.site_url + spec.path.format(quote(str(key))))}</loc>\n'
+                if updated_at:
+                    entry += f'    <lastmod>{_w3c(updated_at)}</lastmod>\n'
+                    lastmod = updated_at if lastmod is None else max(lastmod, updated_at)
+                entry += f'    <changefreq>{spec.changefreq}</changefreq>\n    <priority>{spec.priority}</priority>\n  </url>\n'
+                writer.write(entry)
+                count += 1
+            writer.write('</urlset>\n')
+        except Exception:
+            writer.abort()
+            raise
+        finally:
+            db.close()
+        if not count:
+            writer.abort()
+            if os.path.exists(path):
+                os.remove(path)
+            return 0, None, None
+        return count, writer.commit(), lastmod or datetime.utcnow()
+
+    def _write_pages(self) -> None:
+        writer = _HashingWriter(self.path('sitemap-pages.xml'))
+        writer.write(_XML_HEADER + _URLSET_OPEN)
+        for path, changefreq, priority in SITEMAP_PAGES:
+            writer.write(f'  <url>\n    <loc>{escape(self.site_url + path)}</loc>\n'
+                         f'    <changefreq>{changefreq}</changefreq>\n    <priority>{priority}</priority>\n  </url>\n')
+        writer.write('</urlset>\n')
+        writer.commit()
+
+    def _write_index(self) -> None:
+        with self.engine.connect() as connection:
+            chunks = connection.execute(
+                select(SitemapChunk.entity_type, SitemapChunk.chunk, SitemapChunk.lastmod)
+                .where(SitemapChunk.url_count > 0)
+                .order_by(SitemapChunk.entity_type, SitemapChunk.chunk)
+            ).all()
+        writer = _HashingWriter(self.path('sitemap_index.xml'))
+        writer.write(_XML_HEADER + '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        writer.write(f'  <sitemap>\n    <loc>{escape(self.site_url)}/sitemaps/sitemap-pages.xml</loc>\n  </sitemap>\n')
+        for entity_type, chunk, lastmod in chunks:
+            writer.write(f'  <sitemap>\n    <loc>{escape(self.site_url)}/sitemaps/{chunk_filename(entity_type, chunk)}</loc>\n')
+            if lastmod:
+                writer.write(f'    <lastmod>{_w3c(lastmod)}</lastmod>\n')
+            writer.write('  </sitemap>\n')
+        writer.write('</sitemapindex>\n')
+        writer.commit()
+
+    def refresh(self) -> int:
+        """Перегенерирует измененные части и индекс; возвращает число перегенерированных частей"""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with self.engine.connect() as connection:
+                stale = connection.execute(
+                    select(SitemapChunk.entity_type, SitemapChunk.chunk, SitemapChunk.version)
+                    .where(SitemapChunk.version > SitemapChunk.generated_version)
+                ).all()
+            for entity_type, chunk, version in stale:
+                if entity_type not in SITEMAP_TYPES:
+                    continue
+                count, etag, lastmod = self._write_chunk(entity_type, chunk)
+                with self.engine.begin() as connection:
+                    # Запись во время генерации увеличит version - часть останется устаревшей до следующего обращения
+                    connection.execute(
+                        SitemapChunk.__table__.update()
+                        .where(SitemapChunk.entity_type == entity_type, SitemapChunk.chunk == chunk)
+                        .values(generated_version=version, url_count=count, etag=etag, lastmod=lastmod)
+                    )
+            index_missing = not os.path.exists(self.path('sitemap_index.xml'))
+            if stale or index_missing:
+                self._write_pages()
+                self._write_index()
+            return len(stale)
+
+    def file(self, filename: str) -> Optional[Tuple[str, str]]:
+        """Путь и ETag готового файла (после refresh); None - файла нет"""
+        if os.path.basename(filename) != filename or not filename.endswith('.xml'):
+            return None
+        path = self.path(filename)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        # ETag части - md5 содержимого из sitemap_chunk; для индекса и разделов - размер и время записи
+        etag = None
+        if filename.startswith('sitemap-') and filename != 'sitemap-pages.xml':
+            entity_type, _, chunk = filename[len('sitemap-'):-len('.xml')].rpartition('-')
+            if chunk.isdigit():
+                with self.engine.connect() as connection:
+                    etag = connection.execute(
+                        select(SitemapChunk.etag).where(SitemapChunk.entity_type == entity_type, SitemapChunk.chunk == int(chunk))
+                    ).scalar()
+        return path, etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def install_hooks(self, session_factory=SessionLocal) -> None:
+        """Отмечает части sitemap при записи в сущности"""
+        if event.contains(session_factory, 'after_flush', _after_flush):
+            return
+        event.listen(session_factory, 'after_flush', _after_flush)
+        event.listen(session_factory, 'after_commit', _after_commit)
+        event.listen(session_factory, 'after_rollback', _discard_chunks)
+
+def _after_flush(session, flush_context):
+    keys = session.info.setdefault('sitemap_chunks', set())
+    changed = list(session.new) + list(session.deleted) + [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in changed:
+        entity_type = _MODEL_TYPES.get(type(obj))
+        if entity_type and obj.id is not None:
+            keys.add((entity_type, obj.id // SITEMAP_CHUNK_SIZE))
+
+def _after_commit(session):
+    keys = session.info.pop('sitemap_chunks', None)
+    if not keys:
+        return
+    try:
+        with sitemap_service.engine.begin() as connection:
+            sitemap_service.mark(connection, keys)
+    except Exception as e:
+        print(f"Ошибка отметки частей sitemap: {e}")
+
+def _discard_chunks(session):
+    session.info.pop('sitemap_chunks', None)
+
+# Глобальный экземпляр sitemap
+sitemap_service = SitemapService()
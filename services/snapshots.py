@@ -0,0 +1,135 @@
+"""
+Снимки строк ORM для кеша запросов.
+
+Вместо pickle отсоединенных объектов SQLAlchemy в кеш кладутся компактные namedtuple
+с явно загруженными связями (company.team, news.author). Такие снимки безопасно
+рендерить в шаблонах без сессии. Кодируются они через marshal - быстрый бинарный
+формат стандартной библиотеки.
+"""
+
+import marshal
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+PersonRow = namedtuple('PersonRow', [
+    'id', 'name', 'role', 'country', 'linkedin', 'telegram', 'website', 'instagram'
+])
+
+AuthorRow = namedtuple('AuthorRow', ['id', 'name', 'website'])
+
+CompanyRow = namedtuple('CompanyRow', [
+    'id', 'name', 'description', 'country', 'city', 'stage', 'industry',
+    'founded_date', 'website', 'logo', 'status', 'created_at', 'updated_at', 'team'
+])
+
+InvestorRow = namedtuple('InvestorRow', [
+    'id', 'name', 'description', 'country', 'focus', 'stages', 'website', 'status', 'type', 'logo'
+])
+
+NewsRow = namedtuple('NewsRow', [
+    'id', 'title', 'slug', 'summary', 'date', 'image', 'views', 'status',
+    'created_at', 'updated_at', 'author'
+])
+
+# Компания без связей - для выпадающих списков и ссылок
+CompanyRefRow = namedtuple('CompanyRefRow', ['id', 'name', 'logo'])
+
+JobRow = namedtuple('JobRow', [
+    'id', 'title', 'description', 'company_id', 'city', 'job_type', 'contact', 'status', 'company'
+])
+
+EventRow = namedtuple('EventRow', [
+    'id', 'title', 'description', 'date', 'format', 'location', 'country',
+    'registration_url', 'cover_image', 'status'
+])
+
+PodcastRow = namedtuple('PodcastRow', ['id', 'title', 'description', 'youtube_url', 'date', 'status'])
+
+# Связи, которые снимаются вместе со строкой: поле -> тип снимка
+ROW_RELATIONS: Dict[type, Dict[str, type]] = {
+    CompanyRow: {'team': PersonRow},
+    NewsRow: {'author': AuthorRow},
+    JobRow: {'company': CompanyRefRow},
+}
+
+# Порядок типов фиксирован: индекс типа хранится в закодированных данных, новые типы - только в конец
+ROW_TYPES: List[type] = [
+    PersonRow, AuthorRow, CompanyRow, InvestorRow, NewsRow,
+    CompanyRefRow, JobRow, EventRow, PodcastRow
+]
+_ROW_TYPE_INDEX = {row_type: index for index, row_type in enumerate(ROW_TYPES)}
+
+# Метки в закодированных данных (marshal не умеет даты и namedtuple)
+_ROW_MARK = '\x00r'
+_DATE_MARK = '\x00d'
+_DATETIME_MARK = '\x00t'
+_EPOCH = datetime(1970, 1, 1)
+
+def snapshot(obj: Any, row_type: type) -> Optional[tuple]:
+    """Снимает строку ORM в namedtuple указанного типа"""
+    if obj is None:
+        return None
+    relations = ROW_RELATIONS.get(row_type, {})
+    values = []
+    for field in row_type._fields:
+        value = getattr(obj, field, None)
+        related_type = relations.get(field)
+        if related_type is not None:
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(snapshot(item, related_type) for item in value)
+            else:
+                value = snapshot(value, related_type)
+        values.append(value)
+    return row_type._make(values)
+
+def snapshot_all(objects: Iterable[Any], row_type: type) -> List[tuple]:
+    """Снимает список строк ORM"""
+    return [snapshot(obj, row_type) for obj in objects]
+
+def _encode(value: Any) -> Any:
+    value_type = type(value)
+    if value_type in _ROW_TYPE_INDEX:
+        return (_ROW_MARK, _ROW_TYPE_INDEX[value_type], tuple(_encode(v) for v in value))
+    if value_type is datetime:
+        return (_DATETIME_MARK, (value - _EPOCH).total_seconds())
+    if value_type is date:
+        return (_DATE_MARK, value.toordinal())
+    if value_type is list:
+        return [_encode(v) for v in value]
+    if value_type is tuple:
+        return tuple(_encode(v) for v in value)
+    if value_type is dict:
+        return {k: _encode(v) for k, v in value.items()}
+    return value
+
+def _decode(value: Any) -> Any:
+    value_type = type(value)
+    if value_type is tuple:
+        if value:
+            mark = value[0]
+            if mark == _ROW_MARK:
+                return ROW_TYPES[value[1]]._make([_decode(v) for v in value[2]])
+            if mark == _DATE_MARK:
+                return date.fromordinal(value[1])
+            if mark == _DATETIME_MARK:
+                return _EPOCH + timedelta(seconds=value[1])
+        return tuple(_decode(v) for v in value)
+    if value_type is list:
+        return [_decode(v) for v in value]
+    if value_type is dict:
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+class SnapshotCodec:
+    """Кодек кеша для снимков строк: marshal + метки для дат и namedtuple"""
+
+    code = b's'
+
+    @staticmethod
+    def dumps(data: Any) -> bytes:
+        return marshal.dumps(_encode(data))
+
+    @staticmethod
+    def loads(payload: bytes) -> Any:
+        return _decode(marshal.loads(payload))
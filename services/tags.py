@@ -0,0 +1,173 @@
+"""
+Теги: нормализованные значения списков через запятую (Investor.focus, Investor.stages, Company.industry).
+
+Строковые поля остаются источником правды для форм и шаблонов, а таблицы tag, investor_tag
+и company_tag синхронизируются с ними в транзакции записи (события after_insert/after_update).
+Фильтры списков работают через индексированные связи вместо ilike('%x%'), который находил
+и подстроки ("AI" в "Retail").
+"""
+
+import re
+from typing import Dict, Iterable, List, Tuple, Union
+
+from sqlalchemy import event, func, inspect, select, text
+
+from db import engine, SessionLocal
+from models import Company, Investor, Tag, investor_tag, company_tag
+from .backfill import run_backfill
+
+# Поля-списки: тип сущности -> {поле: вид тега}
+TAG_FIELDS = {
+    'investor': {'focus': 'focus', 'stages': 'stage'},
+    'company': {'industry': 'industry'},
+}
+
+TAG_MODELS = {
+    'investor': Investor,
+    'company': Company,
+}
+
+# Таблица связей и ее колонка сущности
+TAG_LINKS = {
+    'investor': (investor_tag, investor_tag.c.investor_id),
+    'company': (company_tag, company_tag.c.company_id),
+}
+
+_TAG_MAX_LENGTH = 64
+_SPACES = re.compile(r'\s+')
+
+def tag_slug(name: str) -> str:
+    """Ключ тега: нижний регистр, одиночные пробелы"""
+    return _SPACES.sub(' ', name.strip().lower())[:_TAG_MAX_LENGTH]
+
+def parse_tags(value: Union[str, Iterable[str], None]) -> List[Tuple[str, str]]:
+    """Теги из строки через запятую или списка: [(slug, name)] без повторов, в исходном порядке"""
+    if not value:
+        return []
+    parts = value.split(',') if isinstance(value, str) else [part for item in value for part in str(item).split(',')]
+    tags = {}
+    for part in parts:
+        name = _SPACES.sub(' ', part.strip())[:_TAG_MAX_LENGTH]
+        if name:
+            tags.setdefault(tag_slug(name), name)
+    return list(tags.items())
+
+class TagService:
+    """Синхронизация тегов и фильтрация по ним"""
+
+    def __init__(self, bind=engine):
+        self.engine = bind
+
+    def ensure_schema(self) -> None:
+        """Создает таблицы тегов, если их нет"""
+        with self.engine.begin() as connection:
+            for table in (Tag.__table__, investor_tag, company_tag):
+                table.create(connection, checkfirst=True)
+
+    def resolve(self, connection, kind: str, tags: List[Tuple[str, str]]) -> List[int]:
+        """id тегов по (slug, name); недостающие теги создаются"""
+        if not tags:
+            return []
+        slugs = [slug for slug, _ in tags]
+        found = dict(connection.execute(
+            select(Tag.slug, Tag.id).where(Tag.kind == kind, Tag.slug.in_(slugs))
+        ).all())
+        missing = [{"kind": kind, "slug": slug, "name": name} for slug, name in tags if slug not in found]
+        if missing:
+            # ON CONFLICT DO NOTHING есть и в SQLite, и в PostgreSQL: тег мог создать параллельный запрос
+            connection.execute(text(
+                "INSERT INTO tag (kind, slug, name) VALUES (:kind, :slug, :name) "
+                "ON CONFLICT (kind, slug) DO NOTHING"
+            ), missing)
+            found.update(connection.execute(
+                select(Tag.slug, Tag.id).where(Tag.kind == kind, Tag.slug.in_([tag["slug"] for tag in missing]))
+            ).all())
+        return [found[slug] for slug in slugs]
+
+    def sync(self, connection, entity_type: str, entity_id: int, field: str, value: str) -> None:
+        """Приводит связи сущности с тегами одного вида к значению поля"""
+        kind = TAG_FIELDS[entity_type][field]
+        link, entity_column = TAG_LINKS[entity_type]
+        connection.execute(link.delete().where(
+            entity_column == entity_id,
+            link.c.tag_id.in_(select(Tag.id).where(Tag.kind == kind))
+        ))
+        tag_ids = self.resolve(connection, kind, parse_tags(value))
+        if tag_ids:
+            connection.execute(link.insert(), [
+                {entity_column.key: entity_id, "tag_id": tag_id} for tag_id in tag_ids
+            ])
+
+    def filter_query(self, query, entity_type: str, field: str, values, match_all: bool = False):
+        """Ограничивает запрос сущностями с тегами: любой из values (OR) или все (AND)"""
+        slugs = [slug for slug, _ in parse_tags(values)]
+        if not slugs:
+            return query
+        model = TAG_MODELS[entity_type]
+        link, entity_column = TAG_LINKS[entity_type]
+        matched = (
+            select(entity_column)
+            .join(Tag, Tag.id == link.c.tag_id)
+            .where(Tag.kind == TAG_FIELDS[entity_type][field], Tag.slug.in_(slugs))
+        )
+        if match_all and len(slugs) > 1:
+            matched = matched.group_by(entity_column).having(func.count(link.c.tag_id) == len(slugs))
+        return query.filter(model.id.in_(matched))
+
+    def backfill(self, batch_size: int = 500) -> Dict[str, int]:
+        """Разбирает существующие значения полей в теги (миграция данных)"""
+        counts = {}
+        db = SessionLocal()
+        try:
+            with self.engine.begin() as connection:
+                for entity_type, model in TAG_MODELS.items():
+                    fields = list(TAG_FIELDS[entity_type])
+                    counts[entity_type] = 0
+                    for row in db.query(model.id, *[getattr(model, field) for field in fields]).yield_per(batch_size):
+                        for field, value in zip(fields, row[1:]):
+                            self.sync(connection, entity_type, row[0], field, value)
+                        counts[entity_type] += 1
+        finally:
+            db.close()
+        return counts
+
+    def backfill_if_empty(self) -> None:
+        """Заполняет теги при первом запуске на существующей базе (один воркер, под блокировкой)"""
+        counts = run_backfill(
+            self.engine, 'tag',
+            lambda connection: connection.execute(select(Tag.id).limit(1)).first() is None,
+            self.backfill
+        )
+        if counts and any(counts.values()):
+            print(f"Теги заполнены из полей focus/stages/industry: {counts}")
+
+    def install_hooks(self) -> None:
+        """Подписывает теги на изменения моделей"""
+        for entity_type, model in TAG_MODELS.items():
+            if event.contains(model, 'after_insert', _after_insert):
+                continue
+            event.listen(model, 'after_insert', _after_insert)
+            event.listen(model, 'after_update', _after_update)
+            event.listen(model, 'after_delete', _after_delete)
+
+_ENTITY_TYPES_BY_TABLE = {model.__tablename__: entity_type for entity_type, model in TAG_MODELS.items()}
+
+def _after_insert(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    for field in TAG_FIELDS[entity_type]:
+        tag_service.sync(connection, entity_type, target.id, field, getattr(target, field))
+
+def _after_update(mapper, connection, target):
+    entity_type = _ENTITY_TYPES_BY_TABLE[target.__tablename__]
+    state = inspect(target)
+    for field in TAG_FIELDS[entity_type]:
+        if state.attrs[field].history.has_changes():
+            tag_service.sync(connection, entity_type, target.id, field, getattr(target, field))
+
+def _after_delete(mapper, connection, target):
+    # Связи удаляем явно: каскад внешних ключей в SQLite по умолчанию выключен
+    link, entity_column = TAG_LINKS[_ENTITY_TYPES_BY_TABLE[target.__tablename__]]
+    connection.execute(link.delete().where(entity_column == target.id))
+
+# Глобальный экземпляр сервиса тегов
+tag_service = TagService()
@@ -0,0 +1,225 @@
+"""
+Трендовые рейтинги новостей, компаний и инвесторов.
+
+Оценка сущности - сумма весов событий (просмотр, комментарий) с экспоненциальным затуханием:
+score(t) = sum(w * exp(-λ (t - t_i))). Хранится не сама оценка, а sum(w * exp(λ (t_i - t0))) от общей
+точки отсчета t0: затухание одинаково для всех сущностей типа и не меняет их порядок, поэтому
+событие - одно сложение, а текущая оценка получается умножением на exp(-λ (t - t0)). Когда показатель
+экспоненты становится большим, точка отсчета переносится (все оценки умножаются на один множитель).
+
+Хранимые оценки только растут, поэтому лучшие TRENDING_CAPACITY сущностей держатся в min-куче:
+событие - O(log k), выдача топа - из памяти. Рейтинги живут в памяти воркера: каждый воркер видит
+свою долю просмотров (при равномерной балансировке - тот же порядок), комментарии за последние
+дни подгружаются при первом обращении.
+"""
+
+import heapq
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import object_session
+
+from db import SessionLocal
+from models import Comment
+
+# Период полураспада оценки, секунды
+TRENDING_HALF_LIFE = {
+    'news': 24 * 3600,
+    'company': 3 * 24 * 3600,
+    'investor': 3 * 24 * 3600,
+}
+
+# Вес события
+TRENDING_WEIGHTS = {
+    'view': 1.0,
+    'comment': 3.0,
+}
+
+# Сколько лучших сущностей держать в куче (с запасом на неактивные)
+TRENDING_CAPACITY = 200
+
+# Перенос точки отсчета, когда exp(λ (t - t0)) превышает e^50
+_REBASE_EXPONENT = 50.0
+
+class TopK:
+    """Лучшие k ключей по неубывающим оценкам: min-куча с ленивым удалением устаревших записей"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.members: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []
+
+    def _drop_stale(self) -> None:
+        heap = self._heap
+        while heap and self.members.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def offer(self, key: int, score: float) -> None:
+        """Учитывает новую оценку ключа"""
+        if key in self.members or len(self.members) < self.capacity:
+            self.members[key] = score
+            heapq.heappush(self._heap, (score, key))
+            # Устаревшие записи копятся от повторных событий - сжимаем кучу
+            if len(self._heap) > 4 * self.capacity:
+                self.rescale(1.0)
+            return
+        self._drop_stale()
+        if score > self._heap[0][0]:
+            _, evicted = heapq.heappop(self._heap)
+            del self.members[evicted]
+            self.members[key] = score
+            heapq.heappush(self._heap, (score, key))
+
+    def rescale(self, factor: float) -> None:
+        """Умножает оценки на общий множитель и пересобирает кучу без устаревших записей"""
+        self.members = {key: score * factor for key, score in self.members.items()}
+        self._heap = [(score, key) for key, score in self.members.items()]
+        heapq.heapify(self._heap)
+
+    def items(self) -> List[Tuple[int, float]]:
+        """Ключи по убыванию оценки"""
+        return sorted(self.members.items(), key=lambda item: (-item[1], item[0]))
+
+class TrendingBoard:
+    """Затухающие оценки сущностей одного типа"""
+
+    def __init__(self, half_life: float, capacity: int = TRENDING_CAPACITY, now: Optional[float] = None):
+        self.rate = math.log(2) / half_life
+        self.origin = time.time() if now is None else now
+        self.scores: Dict[int, float] = {}
+        self.top = TopK(capacity)
+
+    def add(self, key: int, weight: float, at: Optional[float] = None) -> None:
+        """Событие с весом weight в момент at (по умолчанию - сейчас); O(log k)"""
+        at = time.time() if at is None else at
+        exponent = self.rate * (at - self.origin)
+        if exponent > _REBASE_EXPONENT:
+            self._rebase(at)
+            exponent = 0.0
+        score = self.scores.get(key, 0.0) + weight * math.exp(exponent)
+        self.scores[key] = score
+        self.top.offer(key, score)
+
+    def _rebase(self, at: float) -> None:
+        factor = math.exp(-self.rate * (at - self.origin))
+        self.scores = {key: score * factor for key, score in self.scores.items()}
+        self.top.rescale(factor)
+        self.origin = at
+
+    def score(self, key: int, now: Optional[float] = None) -> float:
+        """Текущая оценка сущности"""
+        now = time.time() if now is None else now
+        return self.scores.get(key, 0.0) * math.exp(-self.rate * (now - self.origin))
+
+    def ranked(self, limit: int, now: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Лучшие сущности с текущими оценками"""
+        now = time.time() if now is None else now
+        decay = math.exp(-self.rate * (now - self.origin))
+        return [(key, score * decay) for key, score in self.top.items()[:limit]]
+
+class TrendingEngine:
+    """Трендовые рейтинги по типам сущностей в памяти воркера"""
+
+    def __init__(self, half_lives: Dict[str, float] = TRENDING_HALF_LIFE):
+        self.half_lives = dict(half_lives)
+        self._boards: Dict[str, TrendingBoard] = {}
+        self._lock = threading.Lock()
+
+    def _board(self, entity_type: str) -> TrendingBoard:
+        board = self._boards.get(entity_type)
+        if board is None:
+            board = self._boards[entity_type] = TrendingBoard(self.half_lives[entity_type])
+            self._warm(entity_type, board)
+        return board
+
+    def _warm(self, entity_type: str, board: TrendingBoard) -> None:
+        """Подгружает комментарии за время, после которого их вклад меньше 1/32"""
+        since = datetime.utcnow() - timedelta(seconds=5 * self.half_lives[entity_type])
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(Comment.entity_id, Comment.created_at)
+                .where(Comment.entity_type == entity_type, Comment.status == 'active', Comment.created_at >= since)
+            ).all()
+        except Exception as e:
+            print(f"Ошибка загрузки комментариев для трендов: {e}")
+            rows = []
+        finally:
+            db.close()
+        offset = time.time() - datetime.utcnow().timestamp()
+        for entity_id, created_at in rows:
+            board.add(entity_id, TRENDING_WEIGHTS['comment'], created_at.timestamp() + offset)
+
+    def record(self, entity_type: str, entity_id: int, kind: str = 'view', at: Optional[float] = None) -> None:
+        """Учитывает событие; типы без рейтинга пропускаются"""
+        if entity_type not in self.half_lives:
+            return
+        with self._lock:
+            self._board(entity_type).add(entity_id, TRENDING_WEIGHTS[kind], at)
+
+    def top(self, entity_type: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """Лучшие сущности типа: [(id, оценка)] по убыванию"""
+        with self._lock:
+            return self._board(entity_type).ranked(limit)
+
+    def ranked_ids(self, entity_type: str, limit: int = TRENDING_CAPACITY) -> List[int]:
+        """id лучших сущностей по убыванию оценки"""
+        return [entity_id for entity_id, _ in self.top(entity_type, limit)]
+
+    def scores(self, entity_type: str, ids: Iterable[int]) -> Dict[int, float]:
+        """Текущие оценки сущностей (0 - без событий)"""
+        with self._lock:
+            board = self._board(entity_type)
+            now = time.time()
+            return {entity_id: board.score(entity_id, now) for entity_id in ids}
+
+    def order(self, entity_type: str, items: list, key=lambda item: item.id) -> list:
+        """Сортирует объекты по текущей оценке; стабильно - при равных оценках исходный порядок сохраняется"""
+        scores = self.scores(entity_type, [key(item) for item in items])
+        return sorted(items, key=lambda item: -scores[key(item)])
+
+    def install_hooks(self, view_counter=None, session_factory=SessionLocal) -> None:
+        """Подписывает рейтинги на просмотры и закоммиченные комментарии"""
+        if event.contains(session_factory, 'after_commit', _after_commit):
+            return
+        if view_counter is not None:
+            view_counter.subscribe(lambda entity_type, entity_id: self.record(entity_type, entity_id, 'view'))
+        event.listen(Comment, 'after_insert', _comment_inserted)
+        event.listen(session_factory, 'after_commit', _after_commit)
+        event.listen(session_factory, 'after_rollback', _discard_events)
+
+def trending_page(query, model, entity_type: str, limit: int, offset: int, order_by, options=()) -> list:
+    """Страница запроса по трендовой оценке: сначала сущности из топа (по оценке), затем остальные по order_by"""
+    ranked = trending_engine.ranked_ids(entity_type)
+    if ranked:
+        allowed = {row[0] for row in query.filter(model.id.in_(ranked)).with_entities(model.id)}
+        ranked = [entity_id for entity_id in ranked if entity_id in allowed]
+    page_ids = ranked[offset:offset + limit]
+    loaded = {item.id: item for item in query.options(*options).filter(model.id.in_(page_ids))} if page_ids else {}
+    items = [loaded[entity_id] for entity_id in page_ids if entity_id in loaded]
+    rest = limit - len(items)
+    if rest > 0:
+        rest_query = query.options(*options)
+        if ranked:
+            rest_query = rest_query.filter(~model.id.in_(ranked))
+        items += rest_query.order_by(order_by, model.id).offset(max(0, offset - len(ranked))).limit(rest).all()
+    return items
+
+def _comment_inserted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and (target.status or 'active') == 'active':
+        session.info.setdefault('trending_events', []).append((target.entity_type, target.entity_id))
+
+def _after_commit(session):
+    for entity_type, entity_id in session.info.pop('trending_events', ()):
+        trending_engine.record(entity_type, entity_id, 'comment')
+
+def _discard_events(session):
+    session.info.pop('trending_events', None)
+
+# Глобальный экземпляр трендовых рейтингов
+trending_engine = TrendingEngine()
@@ -0,0 +1,191 @@
+"""
+Счетчики просмотров с отложенной записью.
+
+Страница не пишет в базу: просмотр увеличивает счетчик в памяти воркера, а фоновый поток раз в
+VIEW_FLUSH_INTERVAL секунд (или при накоплении VIEW_FLUSH_MAX_PENDING сущностей) сбрасывает
+суммарные приращения одной транзакцией пакетными UPDATE/upsert. Новости пишутся в колонку
+News.views, остальные сущности - в таблицу entity_view.
+
+У каждой пачки есть id, который записывается в view_flush_batch в той же транзакции. Если сброс
+упал, пачка остается в очереди с тем же id и повторяется; уже примененная пачка (например, ошибка
+пришла после коммита) пропускается, поэтому просмотры не считаются дважды. При остановке воркера
+очередь сбрасывается (atexit).
+"""
+
+import atexit
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import bindparam, func, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from db import engine
+from models import EntityView, News, ViewFlushBatch
+
+# Сущности со счетчиком просмотров
+VIEW_ENTITY_TYPES = ('news', 'company', 'investor', 'event', 'job')
+
+# Сущности с собственной колонкой просмотров; остальные - в entity_view
+VIEW_COLUMNS = {'news': News}
+
+VIEW_FLUSH_INTERVAL = 10
+VIEW_FLUSH_MAX_PENDING = 1000
+
+# Сколько хранить id примененных пачек
+VIEW_BATCH_RETENTION = timedelta(days=1)
+
+class _Batch:
+    __slots__ = ('batch_id', 'deltas')
+
+    def __init__(self, deltas: Dict[Tuple[str, int], int]):
+        self.batch_id = uuid.uuid4().hex
+        self.deltas = deltas
+
+class ViewCounter:
+    """Буфер просмотров воркера и его сброс в базу"""
+
+    def __init__(self, bind=engine, interval: float = VIEW_FLUSH_INTERVAL):
+        self.engine = bind
+        self.interval = interval
+        self._pending: Dict[Tuple[str, int], int] = defaultdict(int)
+        self._failed: List[_Batch] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    def ensure_schema(self) -> None:
+        """Создает таблицы счетчиков и пачек, если их нет"""
+        EntityView.__table__.create(self.engine, checkfirst=True)
+        ViewFlushBatch.__table__.create(self.engine, checkfirst=True)
+
+    def record(self, entity_type: str, entity_id: int) -> None:
+        """Засчитывает просмотр; в базу попадет со следующим сбросом"""
+        if entity_type not in VIEW_ENTITY_TYPES:
+            raise ValueError(f"Неизвестный тип сущности: {entity_type}")
+        with self._lock:
+            self._pending[(entity_type, entity_id)] += 1
+            size = len(self._pending)
+            if self._thread is None:
+                self._start()
+        if size >= VIEW_FLUSH_MAX_PENDING:
+            self._wakeup.set()
+        for listener in self._listeners:
+            listener(entity_type, entity_id)
+
+    def subscribe(self, listener) -> None:
+        """listener(entity_type, entity_id) вызывается на каждый просмотр (тренды)"""
+        self._listeners.append(listener)
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="view-counter-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self) -> None:
+        last_prune = datetime.utcnow()
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if datetime.utcnow() - last_prune > VIEW_BATCH_RETENTION / 24:
+                    self.prune()
+                    last_prune = datetime.utcnow()
+            except Exception as e:
+                print(f"Ошибка сброса счетчиков просмотров: {e}")
+
+    def pending(self, entity_type: str, entity_id: int) -> int:
+        """Просмотры воркера, еще не записанные в базу"""
+        key = (entity_type, entity_id)
+        with self._lock:
+            return self._pending.get(key, 0) + sum(batch.deltas.get(key, 0) for batch in self._failed)
+
+    def flush(self) -> int:
+        """Сбрасывает накопленные приращения; возвращает число просмотров, записанных в базу"""
+        with self._flush_lock:
+            with self._lock:
+                batches = self._failed
+                if self._pending:
+                    batches.append(_Batch(dict(self._pending)))
+                    self._pending.clear()
+                self._failed = []
+            written = 0
+            for index, batch in enumerate(batches):
+                try:
+                    written += self._apply(batch)
+                except Exception as e:
+                    print(f"Ошибка записи просмотров, пачка будет повторена: {e}")
+                    with self._lock:
+                        self._failed = batches[index:] + self._failed
+                    break
+            return written
+
+    def _apply(self, batch: _Batch) -> int:
+        grouped = defaultdict(list)
+        for (entity_type, entity_id), delta in batch.deltas.items():
+            grouped[entity_type].append({"entity_id": entity_id, "delta": delta})
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(ViewFlushBatch.__table__.insert(), {"batch_id": batch.batch_id, "created_at": datetime.utcnow()})
+                for entity_type, rows in grouped.items():
+                    model = VIEW_COLUMNS.get(entity_type)
+                    if model is not None:
+                        connection.execute(
+                            update(model.__table__)
+                            .where(model.__table__.c.id == bindparam('entity_id'))
+                            .values(views=func.coalesce(model.__table__.c.views, 0) + bindparam('delta')),
+                            rows
+                        )
+                    else:
+                        connection.execute(
+                            text("INSERT INTO entity_view (entity_type, entity_id, views) "
+                                 "VALUES (:entity_type, :entity_id, :delta) "
+                                 "ON CONFLICT (entity_type, entity_id) DO UPDATE SET views = entity_view.views + excluded.views"),
+                            [{"entity_type": entity_type, **row} for row in rows]
+                        )
+        except IntegrityError:
+            # id пачки уже записан - она применена раньше (ошибка после коммита)
+            with self.engine.connect() as connection:
+                applied = connection.execute(
+                    select(ViewFlushBatch.batch_id).where(ViewFlushBatch.batch_id == batch.batch_id)
+                ).first()
+            if applied:
+                return 0
+            raise
+        return sum(batch.deltas.values())
+
+    def prune(self) -> int:
+        """Удаляет старые id примененных пачек"""
+        with self.engine.begin() as connection:
+            return connection.execute(
+                ViewFlushBatch.__table__.delete().where(ViewFlushBatch.created_at < datetime.utcnow() - VIEW_BATCH_RETENTION)
+            ).rowcount
+
+    def counts(self, entity_type: str, ids: Iterable[int]) -> Dict[int, int]:
+        """Просмотры сущностей одним запросом (записанные в базу и ожидающие сброса в этом воркере)"""
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        model = VIEW_COLUMNS.get(entity_type)
+        with self.engine.connect() as connection:
+            if model is not None:
+                rows = connection.execute(select(model.id, model.views).where(model.id.in_(ids)))
+            else:
+                rows = connection.execute(
+                    select(EntityView.entity_id, EntityView.views)
+                    .where(EntityView.entity_type == entity_type, EntityView.entity_id.in_(ids))
+                )
+            stored = {entity_id: views or 0 for entity_id, views in rows}
+        return {entity_id: stored.get(entity_id, 0) + self.pending(entity_type, entity_id) for entity_id in ids}
+
+    def views(self, entity_type: str, entity_id: int) -> int:
+        """Просмотры одной сущности"""
+        return self.counts(entity_type, [entity_id])[entity_id]
+
+# Глобальный экземпляр счетчика просмотров
+view_counter = ViewCounter()
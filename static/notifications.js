@@ -0,0 +1,45 @@
+/**
+ * Уведомления в реальном времени
+ * Счетчик непрочитанных в меню и на странице уведомлений обновляется по Server-Sent Events
+ */
+
+class LiveNotifications {
+    constructor(url) {
+        this.url = url;
+        this.source = null;
+        if (window.EventSource) {
+            this.connect();
+        }
+    }
+
+    connect() {
+        // EventSource сам переподключается после обрыва (интервал задает сервер в retry)
+        this.source = new EventSource(this.url);
+        ['unread', 'notification', 'read', 'read_all', 'deleted'].forEach((name) => {
+            this.source.addEventListener(name, (event) => this.handle(name, JSON.parse(event.data)));
+        });
+    }
+
+    handle(name, message) {
+        if (message.unread !== null && message.unread !== undefined) {
+            this.setUnread(message.unread);
+        }
+        if (name === 'notification') {
+            document.dispatchEvent(new CustomEvent('stanbase:notification', { detail: message.data }));
+        }
+    }
+
+    setUnread(count) {
+        ['nav-notifications-count', 'unread-badge'].forEach((id) => {
+            const badge = document.getElementById(id);
+            if (badge) {
+                badge.textContent = count;
+                badge.style.display = count > 0 ? 'inline' : 'none';
+            }
+        });
+    }
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    window.liveNotifications = new LiveNotifications('/notifications/stream');
+});
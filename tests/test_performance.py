@@ -168,6 +168,1642 @@ def test_cache_stats():
     
     print("✅ Статистика кеша работает корректно")
 
+def test_cache_tiers():
+    """Тестируем двухуровневый кеш: память + общее хранилище"""
+    print("\n🚀 Тестируем уровни кеша...")
+
+    import tempfile
+    from services.cache import CacheManager
+
+    for backend in ("file", "sqlite"):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            manager = CacheManager(cache_dir=cache_dir, backend=backend, memory_max_entries=2)
+            manager.set("tier_a", {"value": 1}, ttl=60)
+
+            # Первый запрос обслуживает память
+            assert manager.get("tier_a") == {"value": 1}
+            assert manager.get_stats()['tiers']['memory']['hits'] == 1
+
+            # После вытеснения из памяти данные приходят из общего хранилища
+            manager.set("tier_b", 2, ttl=60)
+            manager.set("tier_c", 3, ttl=60)
+            assert manager.get("tier_a") == {"value": 1}
+            stats = manager.get_stats()
+            assert stats['backend'] == backend
+            assert stats['tiers']['backend']['hits'] == 1
+            assert stats['tiers']['memory']['evictions'] >= 1
+
+            # Истекший TTL не отдается ни одним уровнем
+            manager.set("tier_expired", "old", ttl=-1)
+            assert manager.get("tier_expired") is None
+
+            assert manager.clear("tier_") >= 3
+            assert manager.get("tier_b") is None
+
+    # Опечатка в имени хранилища - ошибка при создании, а не файловый кеш
+    try:
+        CacheManager(cache_dir=tempfile.gettempdir(), backend="sqlte")
+        assert False, "ожидалась ошибка"
+    except ValueError as e:
+        assert "sqlte" in str(e)
+
+    print("✅ Уровни кеша работают корректно")
+
+def test_cache_tag_invalidation():
+    """Тестируем инвалидацию по тегам через события сессии"""
+    print("\n🚀 Тестируем инвалидацию по тегам...")
+
+    from models import Job
+    from services.cache import install_invalidation_hooks
+    from services.search import search_service
+
+    install_invalidation_hooks(SessionLocal)
+    # Поиск по q идет через поисковый индекс, он тоже должен обновляться при коммите
+    search_service.ensure_schema()
+    search_service.install_hooks()
+
+    result1 = QueryCache.get_companies_with_filters(q="tag-invalidation-test")
+    companies_generation = cache_manager.get_tag_generation('companies')
+    news_generation = cache_manager.get_tag_generation('news')
+
+    db = SessionLocal()
+    try:
+        company = Company(name="tag-invalidation-test", status='active')
+        db.add(company)
+        db.commit()
+
+        # Коммит компании увеличивает поколение тега companies, но не news
+        assert cache_manager.get_tag_generation('companies') > companies_generation
+        assert cache_manager.get_tag_generation('news') == news_generation
+
+        result2 = QueryCache.get_companies_with_filters(q="tag-invalidation-test")
+        assert result2['total'] == result1['total'] + 1
+
+        # Список вакансий хранит название компании - переименование сбрасывает и его
+        job = Job(title="tag-invalidation-job", city="TagInvalidationCity", company_id=company.id, status='active')
+        db.add(job)
+        db.commit()
+        assert QueryCache.get_jobs_with_filters(city="TagInvalidationCity")[0].company.name == "tag-invalidation-test"
+        company.name = "tag-invalidation-renamed"
+        db.commit()
+        assert QueryCache.get_jobs_with_filters(city="TagInvalidationCity")[0].company.name == "tag-invalidation-renamed"
+
+        db.delete(job)
+        db.delete(company)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Инвалидация по тегам работает корректно")
+
+def test_snapshot_codec_benchmark():
+    """Сравниваем снимки строк (marshal) с pickle ORM объектов: размер и время декодирования"""
+    print("\n🚀 Бенчмарк формата снимков строк...")
+
+    import pickle
+    from datetime import date, datetime
+    from models import Person
+    from services.snapshots import SnapshotCodec, CompanyRow, snapshot_all
+
+    companies = []
+    for i in range(500):
+        company = Company(
+            id=i,
+            name=f"Company {i}",
+            description="Описание компании " * 10,
+            country="Казахстан",
+            city="Алматы",
+            stage="Seed",
+            industry="Fintech",
+            founded_date=date(2020, 1, 1),
+            website=f"https://company{i}.example.com",
+            status='active',
+            created_at=datetime(2024, 5, 1, 12, 30),
+            updated_at=datetime(2024, 5, 2, 12, 30)
+        )
+        company.team = [Person(id=i * 10 + j, name=f"Person {j}", role="CEO") for j in range(3)]
+        companies.append(company)
+
+    pickled = pickle.dumps(companies, protocol=pickle.HIGHEST_PROTOCOL)
+    rows = snapshot_all(companies, CompanyRow)
+    encoded = SnapshotCodec.dumps(rows)
+
+    rounds = 20
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        pickle.loads(pickled)
+    pickle_time = (time.perf_counter() - start_time) / rounds
+
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        decoded = SnapshotCodec.loads(encoded)
+    snapshot_time = (time.perf_counter() - start_time) / rounds
+
+    print(f"📦 pickle ORM: {len(pickled)} байт, декодирование {pickle_time * 1000:.2f} мс")
+    print(f"📦 снимки:     {len(encoded)} байт, декодирование {snapshot_time * 1000:.2f} мс")
+
+    # Снимки компактнее и восстанавливаются без потерь, включая связи и даты
+    assert len(encoded) < len(pickled)
+    assert decoded == rows
+    assert decoded[0].team[0].name == "Person 0"
+    assert decoded[0].founded_date == date(2020, 1, 1)
+    assert decoded[0].created_at == datetime(2024, 5, 1, 12, 30)
+
+    print("✅ Формат снимков работает корректно")
+
+def test_cache_single_flight():
+    """Тестируем объединение одновременных промахов и stale-while-revalidate"""
+    print("\n🚀 Тестируем single-flight и фоновое обновление...")
+
+    import tempfile
+    import threading
+    from services.cache import CacheManager
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        manager = CacheManager(cache_dir=cache_dir)
+        calls = []
+
+        def slow_query():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        # 10 одновременных промахов - один запрос к "БД"
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(manager.get_or_set("sf_key", slow_query, ttl=60)))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == [1] * 10
+
+        # Устаревшее значение отдается сразу, а обновляется в фоне
+        manager.get_or_set("swr_key", lambda: "old", ttl=-1, stale_ttl=60)
+        assert manager.get_or_set("swr_key", lambda: "new", ttl=60, stale_ttl=60) == "old"
+        for _ in range(50):
+            if manager.get("swr_key")['data'] == "new":
+                break
+            time.sleep(0.02)
+        assert manager.get_or_set("swr_key", lambda: "newer", ttl=60, stale_ttl=60) == "new"
+
+    print("✅ Single-flight и фоновое обновление работают корректно")
+
+def test_search_index():
+    """Тестируем полнотекстовый индекс: инкрементальное обновление, ранжирование и подсветку"""
+    print("\n🚀 Тестируем поисковый индекс...")
+
+    from services.search import search_service
+
+    search_service.ensure_schema()
+    search_service.install_hooks()
+
+    db = SessionLocal()
+    try:
+        exact = Company(name="Searchindex Robotics", description="Складские роботы", status='active')
+        mention = Company(name="Other Startup", description="Партнер searchindex robotics <b>", status='active')
+        db.add_all([exact, mention])
+        db.commit()
+
+        hits = search_service.search("searchindex robot", entity_types=['company'])['company']
+        ids = [hit.entity_id for hit in hits]
+        # Совпадение в названии весит больше, чем в описании
+        assert ids[:2] == [exact.id, mention.id]
+        snippet = hits[1].snippet
+        assert '<mark>searchindex</mark>' in snippet
+        assert '&lt;b&gt;' in snippet
+
+        # Изменение описания переиндексирует запись, скрытие убирает ее из поиска
+        mention.description = "Без упоминаний"
+        db.commit()
+        assert [hit.entity_id for hit in search_service.search("searchindex", entity_types=['company'])['company']] == [exact.id]
+
+        exact.status = 'inactive'
+        db.commit()
+        assert search_service.search("searchindex", entity_types=['company'])['company'] == []
+
+        db.delete(exact)
+        db.delete(mention)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Поисковый индекс работает корректно")
+
+def test_backfill_lock():
+    """Тестируем первичное заполнение при старте: параллельные воркеры заполняют таблицу один раз"""
+    print("\n🚀 Тестируем блокировку первичного заполнения...")
+
+    import threading
+    from db import engine
+    from services.backfill import run_backfill
+
+    filled = []
+
+    def fill():
+        # Долгое заполнение: остальные воркеры успевают увидеть пустую таблицу до его конца
+        time.sleep(0.3)
+        filled.append(threading.get_ident())
+        return {'rows': 1}
+
+    results = []
+    workers = [
+        threading.Thread(target=lambda: results.append(
+            run_backfill(engine, 'test-backfill', lambda connection: not filled, fill)
+        ))
+        for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(filled) == 1
+    assert sorted(results, key=lambda result: result is not None) == [None, None, None, {'rows': 1}]
+    # Блокировка снята - следующее заполнение не ждет
+    assert run_backfill(engine, 'test-backfill', lambda connection: True, lambda: 'again') == 'again'
+
+    print("✅ Первичное заполнение выполняется одним воркером")
+
+def test_search_transliteration():
+    """Тестируем нечеткий поиск по названиям: транслитерацию, опечатки и автокомплит"""
+    print("\n🚀 Тестируем транслитерацию и триграммный индекс...")
+
+    from services.search import search_service
+    from utils.transliteration import normalize_search_key
+
+    assert normalize_search_key("Узум") == normalize_search_key("UZUM") == "uzum"
+    assert normalize_search_key("O‘zbekiston Café") == "ozbekiston cafe"
+
+    search_service.ensure_schema()
+    search_service.install_hooks()
+
+    db = SessionLocal()
+    try:
+        latin = Company(name="Translitum Market", status='active')
+        cyrillic = Company(name="Транслитум", status='active')
+        hidden = Company(name="Translitum Archive", status='inactive')
+        db.add_all([latin, cyrillic, hidden])
+        db.commit()
+
+        # Кириллический запрос находит латинское название и наоборот, короткие названия выше
+        ids = [hit.entity_id for hit in search_service.fuzzy_search('company', "транслитум")]
+        assert ids[:2] == [cyrillic.id, latin.id]
+        assert hidden.id not in ids
+
+        # Опечатка
+        assert latin.id in [hit.entity_id for hit in search_service.fuzzy_search('company', "Translitom Market")]
+
+        # Автокомплит админки: префикс и неактивные компании
+        ids = [hit.entity_id for hit in search_service.fuzzy_search('company', "transl", active_only=False, prefix=True)]
+        assert set(ids[:3]) == {latin.id, cyrillic.id, hidden.id}
+
+        # /companies?q= использует тот же индекс
+        result = QueryCache.get_companies_with_filters(q="Translitum")
+        assert [c.id for c in result['companies']] == [latin.id, cyrillic.id]
+
+        latin.name = "Renamed Market"
+        db.commit()
+        assert latin.id not in [hit.entity_id for hit in search_service.fuzzy_search('company', "translitum")]
+
+        for company in (latin, cyrillic, hidden):
+            db.delete(company)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Транслитерация и нечеткий поиск работают корректно")
+
+def test_trigram_search_plan():
+    """Тестируем план и время нечеткого поиска на 100k названий без ANALYZE"""
+    print("\n🚀 Тестируем план триграммного поиска на 100k названий...")
+
+    import random
+    import string
+    from sqlalchemy import create_engine, text
+    from models import SearchName, SearchTrigram
+    from services.search import SearchService
+    from utils.transliteration import trigrams
+
+    memory = create_engine('sqlite://')
+    service = SearchService(bind=memory)
+    service.ensure_schema()
+
+    rng = random.Random(1)
+    names, rows = [], []
+    for entity_id in range(100_000):
+        key = ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(2))
+        key_trigrams = trigrams(key)
+        names.append({"entity_type": 'company', "entity_id": entity_id, "search_key": key,
+                      "trigram_count": len(key_trigrams), "is_active": True})
+        rows += [{"entity_type": 'company', "trigram": trigram, "entity_id": entity_id,
+                  "trigram_count": len(key_trigrams), "is_active": True} for trigram in key_trigrams]
+    with memory.begin() as connection:
+        connection.execute(SearchName.__table__.insert(), names)
+        connection.execute(SearchTrigram.__table__.insert(), rows)
+
+        plan = ' '.join(row[-1] for row in connection.execute(text(
+            "EXPLAIN QUERY PLAN SELECT entity_id, count(*) FROM search_trigram "
+            "WHERE entity_type = 'company' AND trigram IN ('  a', ' ab', 'abc') GROUP BY entity_id"
+        )))
+        assert 'USING PRIMARY KEY (entity_type=? AND trigram=?)' in plan, plan
+
+    target = names[500]['search_key']
+    start = time.time()
+    for _ in range(10):
+        hits = service.fuzzy_search('company', target)
+    elapsed = (time.time() - start) / 10
+    print(f"⏱️ Запрос по 100k названиям: {elapsed * 1000:.1f}ms")
+    assert hits[0].entity_id == 500
+    assert elapsed < 0.05
+
+    # Удаление по первичному ключу убирает все триграммы названия
+    with memory.begin() as connection:
+        service.names.delete(connection, 'company', 500)
+        left = connection.execute(text("SELECT count(*) FROM search_trigram WHERE entity_id = 500")).scalar()
+    assert left == 0
+    assert 500 not in [hit.entity_id for hit in service.fuzzy_search('company', target)]
+    memory.dispose()
+
+    print("✅ Триграммный поиск использует первичный ключ")
+
+def test_cursor_pagination():
+    """Тестируем keyset пагинацию: полный обход без пропусков и дублей, подпись курсора"""
+    print("\n🚀 Тестируем пагинацию по курсору...")
+
+    from services.pagination import InvalidCursor, encode_cursor, decode_cursor
+
+    db = SessionLocal()
+    try:
+        # Одинаковые названия: порядок между ними определяет id
+        created = [Company(name=f"cursor-test-{i % 3}", status='active') for i in range(7)]
+        db.add_all(created)
+        db.commit()
+        created_ids = {c.id for c in created}
+
+        query = db.query(Company).filter(Company.name.like("cursor-test-%"))
+        seen = []
+        after = None
+        while True:
+            items, after = DatabasePagination.paginate_after(query, 'companies', Company.name, Company.id, after=after, per_page=3)
+            seen.extend(c.id for c in items)
+            if after is None:
+                break
+        expected = [c.id for c in query.order_by(Company.name, Company.id)]
+        assert seen == expected
+        assert set(seen) == created_ids
+
+        # Курсор нельзя подделать или использовать для другого списка
+        token = encode_cursor('companies', ("cursor-test-1", 5))
+        assert decode_cursor('companies', token) == ("cursor-test-1", 5)
+        for bad_key, bad_token in [('companies', token[:-2] + 'AA'), ('investors', token), ('companies', 'garbage')]:
+            try:
+                decode_cursor(bad_key, bad_token)
+                assert False, "Курсор должен быть отклонен"
+            except InvalidCursor:
+                pass
+
+        for company in created:
+            db.delete(company)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Пагинация по курсору работает корректно")
+
+def test_count_service():
+    """Тестируем кеш количеств по фильтрам, инвалидацию при записи и приблизительный режим"""
+    print("\n🚀 Тестируем сервис количеств...")
+
+    from services.cache import install_invalidation_hooks
+    from services.counts import count_service, normalize_filters
+    from services.pagination import Pagination
+
+    install_invalidation_hooks(SessionLocal)
+    count_service.install_hooks()
+
+    assert normalize_filters({'q': ' x ', 'status': '', 'country': None}) == (('q', 'x'),)
+
+    db = SessionLocal()
+    try:
+        query = db.query(Company).filter(Company.name.ilike('%count-test%'))
+        before = count_service.count(query, Company, filters={'q': 'count-test'})
+        assert before == query.count() and not before.estimated
+
+        estimated_before = count_service.estimate(Company)
+
+        company = Company(name="count-test", status='active')
+        db.add(company)
+        db.commit()
+
+        # Коммит инвалидирует тег таблицы - количество пересчитывается
+        assert count_service.count(query, Company, filters={'q': 'count-test'}) == before + 1
+        # Счетчик строк обновился в транзакции вставки
+        assert count_service.estimate(Company) == estimated_before + 1
+        assert count_service.count(db.query(Company), Company, filters={}, estimate_unfiltered=True) == db.query(Company).count()
+
+        # Pagination знает, точное ли количество
+        estimate = count_service.estimate(Company)
+        assert Pagination(items=[], total=estimate).get_pagination_info()['total_estimated'] == estimate.estimated
+        assert Pagination(items=[], total=5).total_estimated is False
+
+        db.delete(company)
+        db.commit()
+        assert count_service.estimate(Company) == estimated_before
+
+        # Запись мимо ORM сдвигает счетчик; сверка с COUNT(*) его исправляет
+        db.add(Company(name="count-test-bulk", status='active'))
+        db.commit()
+        db.query(Company).filter(Company.name == "count-test-bulk").delete(synchronize_session=False)
+        db.commit()
+        assert count_service.estimate(Company) == estimated_before + 1
+        assert count_service.reconcile() >= 1
+        assert count_service.estimate(Company) == estimated_before == db.query(Company).count()
+        assert count_service.reconcile() == 0
+
+        # Без явной сверки счетчик исправляется при первом обращении после ROW_COUNT_RECONCILE_TTL
+        db.add(Company(name="count-test-bulk", status='active'))
+        db.commit()
+        db.query(Company).filter(Company.name == "count-test-bulk").delete(synchronize_session=False)
+        db.commit()
+        count_service._reconciled['company'] = 0
+        assert count_service.estimate(Company) == estimated_before
+    finally:
+        db.close()
+
+    print("✅ Сервис количеств работает корректно")
+
+def test_facet_index():
+    """Тестируем фасеты фильтров: инкрементальные количества при вставке, изменении и скрытии"""
+    print("\n🚀 Тестируем фасеты фильтров...")
+
+    from models import Job
+    from services.facets import facet_index
+
+    facet_index.ensure_schema()
+    facet_index.install_hooks()
+
+    db = SessionLocal()
+    try:
+        before = facet_index.get('investor')
+        focus_before = before['focus'].get('FacetTestAI', 0)
+
+        investor = Investor(name="facet-test", focus="FacetTestAI, FacetTestBio", stages="Seed", country="FacetLand", status='active')
+        db.add(investor)
+        db.commit()
+
+        facets = facet_index.get('investor')
+        assert facets['focus']['FacetTestAI'] == focus_before + 1
+        assert facets['country']['FacetLand'] == before['country'].get('FacetLand', 0) + 1
+
+        # Изменение после коммита (атрибуты истекли) - старое значение все равно учитывается
+        db.expire_all()
+        investor.focus = "FacetTestAI"
+        db.commit()
+        facets = facet_index.get('investor')
+        assert facets['focus']['FacetTestAI'] == focus_before + 1
+        assert 'FacetTestBio' not in facets['focus']
+
+        # Неактивные записи в фасеты не попадают; значения фильтров берутся из индекса
+        investor.status = 'inactive'
+        db.commit()
+        assert 'FacetLand' not in facet_index.get('investor')['country']
+        assert 'FacetLand' not in QueryCache.get_investor_filters()['countries']
+
+        db.delete(investor)
+        db.commit()
+        assert facet_index.get('investor')['focus'].get('FacetTestAI', 0) == focus_before
+
+        # Список вакансий показывает тот же набор, по которому считаются фасеты
+        active = Job(title="facet-job", city="FacetCity", job_type="remote", status='active')
+        closed = Job(title="facet-job", city="FacetCity", job_type="remote", status='closed')
+        db.add_all([active, closed])
+        db.commit()
+        jobs = QueryCache.get_jobs_with_filters(city="FacetCity")
+        assert [job.id for job in jobs] == [active.id]
+        assert QueryCache.get_job_filters()['counts']['city']['FacetCity'] == len(jobs)
+        db.delete(active)
+        db.delete(closed)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Фасеты фильтров работают корректно")
+
+def test_tag_filters():
+    """Тестируем фильтры по тегам: OR/AND, без ложных совпадений подстрок, пересинхронизация при изменении"""
+    print("\n🚀 Тестируем фильтры по тегам...")
+
+    from services.tags import tag_service, parse_tags
+
+    tag_service.ensure_schema()
+    tag_service.install_hooks()
+
+    assert parse_tags(" AI,  ai , Deep  Tech,") == [("ai", "AI"), ("deep tech", "Deep Tech")]
+
+    db = SessionLocal()
+    try:
+        both = Investor(name="tag-test-both", focus="TagAI, TagFintech", stages="Seed", status='active')
+        ai_only = Investor(name="tag-test-ai", focus="TagAI", stages="Series A", status='active')
+        retail = Investor(name="tag-test-retail", focus="TagAIRetail", stages="Seed", status='active')
+        db.add_all([both, ai_only, retail])
+        db.commit()
+
+        def names(values, match_all=False, field='focus'):
+            query = tag_service.filter_query(db.query(Investor), 'investor', field, values, match_all=match_all)
+            return {investor.name for investor in query.filter(Investor.name.like('tag-test-%'))}
+
+        # Регистр не важен, подстрока "TagAI" в "TagAIRetail" не совпадает
+        assert names("tagai") == {"tag-test-both", "tag-test-ai"}
+        assert names("TagAI, TagFintech") == {"tag-test-both", "tag-test-ai"}
+        assert names("TagAI, TagFintech", match_all=True) == {"tag-test-both"}
+        assert names("Seed", field='stages') >= {"tag-test-both", "tag-test-retail"}
+
+        # Изменение поля пересинхронизирует связи
+        ai_only.focus = "TagFintech"
+        db.commit()
+        assert names("TagAI") == {"tag-test-both"}
+        assert names("TagFintech", match_all=True) == {"tag-test-both", "tag-test-ai"}
+
+        result = QueryCache.get_investors_with_filters(focus="TagAI, TagFintech", match='all', limit=None)
+        assert [investor.name for investor in result['investors']] == ["tag-test-both"]
+
+        for investor in (both, ai_only, retail):
+            db.delete(investor)
+        db.commit()
+        assert names("TagFintech") == set()
+    finally:
+        db.close()
+
+    print("✅ Фильтры по тегам работают корректно")
+
+def test_deal_investor_links():
+    """Тестируем связи сделок с инвесторами: точные имена, редактирование сделки, инвестор заведен позже"""
+    print("\n🚀 Тестируем связи сделок с инвесторами...")
+
+    from models import Deal
+    from services.deals import deal_investor_index
+
+    deal_investor_index.ensure_schema()
+    deal_investor_index.install_hooks()
+
+    db = SessionLocal()
+    try:
+        alpha = Investor(name="DealTest Alpha", status='active')
+        alpha_two = Investor(name="DealTest Alpha Ventures II", status='active')
+        db.add_all([alpha, alpha_two])
+        db.commit()
+
+        both = Deal(type="Seed", amount=100, investors="DealTest Alpha Ventures II, dealtest alpha")
+        second_only = Deal(type="Series A", amount=200, investors="DealTest Alpha Ventures II, DealTest Later Fund")
+        db.add_all([both, second_only])
+        db.commit()
+
+        def deal_ids(investor):
+            return {deal.id for deal in deal_investor_index.deals_query(db, investor.id)}
+
+        # "Alpha" не совпадает с подстрокой в "Alpha Ventures II"; регистр имени не важен
+        assert deal_ids(alpha) == {both.id}
+        assert deal_ids(alpha_two) == {both.id, second_only.id}
+
+        # Редактирование сделки пересобирает связи
+        both.investors = "DealTest Alpha"
+        db.commit()
+        assert deal_ids(alpha_two) == {second_only.id}
+
+        # Инвестор, заведенный после сделки, подхватывает ее
+        later = Investor(name="DealTest Later Fund", status='active')
+        db.add(later)
+        db.commit()
+        assert deal_ids(later) == {second_only.id}
+
+        for obj in (both, second_only, alpha, alpha_two, later):
+            db.delete(obj)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Связи сделок с инвесторами работают корректно")
+
+def test_coinvest_graph():
+    """Тестируем граф соинвестиций: инкрементальные ребра совпадают с полным пересчетом"""
+    print("\n🚀 Тестируем граф соинвестиций...")
+
+    from datetime import date
+    from models import Deal, PortfolioEntry, CoinvestEdge
+    from services.deals import deal_investor_index
+    from services.coinvest import coinvest_graph
+
+    deal_investor_index.ensure_schema()
+    deal_investor_index.install_hooks()
+    coinvest_graph.ensure_schema()
+    coinvest_graph.install_hooks()
+
+    db = SessionLocal()
+    try:
+        company = Company(name="coinvest-test", country="GraphLand", stage="Seed", status='active')
+        first = Investor(name="Graph Fund A", status='active')
+        second = Investor(name="Graph Fund B", status='active')
+        third = Investor(name="Graph Fund C", status='active')
+        db.add_all([company, first, second, third])
+        db.commit()
+
+        deal = Deal(type="Seed", amount=100.0, date=date(2024, 1, 10), company_id=company.id,
+                    investors="Graph Fund A, Graph Fund B")
+        other = Deal(type="Series A", amount=500.0, date=date(2024, 6, 1), company_id=company.id,
+                     investors="Graph Fund A, Graph Fund B")
+        db.add_all([deal, other])
+        db.commit()
+
+        snapshot = coinvest_graph.snapshot()
+        assert snapshot.neighbours(first.id) == [(second.id, 2, 600.0)]
+        assert snapshot.active_investors("GraphLand", "Seed", limit=2) == [(first.id, 2), (second.id, 2)]
+
+        # Запись портфеля на ту же дату - участник того же раунда, объем раунда остается объемом сделки
+        db.add(PortfolioEntry(investor_id=third.id, company_id=company.id, amount=30.0, date=date(2024, 1, 10)))
+        other.investors = "Graph Fund B"
+        db.commit()
+
+        snapshot = coinvest_graph.snapshot()
+        assert snapshot.neighbours(first.id) == [(second.id, 1, 100.0), (third.id, 1, 100.0)]
+        assert snapshot.neighbours(second.id, limit=1) == [(first.id, 1, 100.0)]
+
+        ids = [first.id, second.id, third.id]
+
+        def edges():
+            return sorted(db.query(CoinvestEdge.investor_id, CoinvestEdge.peer_id, CoinvestEdge.rounds, CoinvestEdge.amount)
+                          .filter(CoinvestEdge.investor_id.in_(ids)).all())
+
+        incremental = edges()
+        coinvest_graph.rebuild()
+        assert edges() == incremental
+
+        # Удаление сделки убирает ребра ее раунда
+        db.delete(deal)
+        db.commit()
+        assert coinvest_graph.snapshot().neighbours(first.id) == []
+
+        for obj in db.query(PortfolioEntry).filter(PortfolioEntry.company_id == company.id).all() + [other, company, first, second, third]:
+            db.delete(obj)
+        db.commit()
+        assert edges() == []
+    finally:
+        db.close()
+
+    print("✅ Граф соинвестиций работает корректно")
+
+def test_similar_companies():
+    """Тестируем похожие компании: ранжирование, фоновый пересчет, совпадение с полным пересчетом"""
+    print("\n🚀 Тестируем похожие компании...")
+
+    import numpy as np
+    from models import CompanySimilar
+    from services.similarity import similarity_engine, encode_companies, top_k
+
+    similarity_engine.ensure_schema()
+    similarity_engine.install_hooks()
+
+    db = SessionLocal()
+    try:
+        payments = Company(name="similar-test-pay", country="SimLand", stage="Seed", industry="SimFintech, SimPayments",
+                           description="Онлайн платежи и переводы для малого бизнеса", status='active')
+        wallet = Company(name="similar-test-wallet", country="SimLand", stage="Seed", industry="SimFintech",
+                         description="Мобильный кошелек: платежи, переводы и кешбэк", status='active')
+        farm = Company(name="similar-test-farm", country="OtherLand", stage="Growth", industry="SimAgro",
+                       description="Датчики влажности почвы для фермеров", status='active')
+        db.add_all([payments, wallet, farm])
+        db.commit()
+        similarity_engine.wait()
+
+        similar = similarity_engine.similar(db, payments.id)
+        assert similar and similar[0].id == wallet.id
+        assert farm.id not in [company.id for company in similar]
+
+        # Изменение индустрии пересчитывает списки в фоне без перечитывания всех компаний
+        loads = []
+        load = similarity_engine._load
+        similarity_engine._load = lambda connection: loads.append(1) or load(connection)
+        try:
+            farm.industry = "SimFintech, SimPayments"
+            farm.description = "Платежи и переводы для фермеров"
+            db.commit()
+            similarity_engine.wait()
+        finally:
+            similarity_engine._load = load
+        assert loads == []
+        assert farm.id in [company.id for company in similarity_engine.similar(db, payments.id)]
+
+        def stored(company_id):
+            return [(row.similar_id, round(row.score, 5)) for row in db.query(CompanySimilar)
+                    .filter(CompanySimilar.company_id == company_id).order_by(CompanySimilar.rank)]
+
+        # Инкрементальные списки совпадают с полным top-k по той же матрице
+        matrix = similarity_engine._matrix
+        for company in (payments, wallet, farm):
+            row = matrix.positions[company.id]
+            _, neighbours, scores = next(iter(top_k(matrix.features, np.array([row]), similarity_engine.k)))
+            assert stored(company.id) == [(int(matrix.ids[n]), round(float(s), 5)) for n, s in zip(neighbours, scores)]
+
+        similarity_engine.rebuild()
+        assert similarity_engine.similar(db, payments.id)[0].id in (wallet.id, farm.id)
+
+        # Скрытая компания пропадает из чужих списков
+        wallet.status = 'inactive'
+        db.commit()
+        similarity_engine.wait()
+        assert wallet.id not in [company.id for company in similarity_engine.similar(db, payments.id)]
+        assert stored(wallet.id) == []
+
+        for company in (payments, wallet, farm):
+            db.delete(company)
+        db.commit()
+        similarity_engine.wait()
+    finally:
+        db.close()
+
+    # Пакетный top-k на синтетических данных
+    rows = [(i, f"C{i % 7}", f"S{i % 5}", f"T{i % 11}, T{i % 13}", f"term{i % 17} word{i % 19}") for i in range(2000)]
+    start = time.time()
+    features = encode_companies(rows)
+    neighbours = list(top_k(features, np.arange(len(rows))))
+    elapsed = time.time() - start
+    print(f"⏱️ 2000 компаний: {elapsed:.2f}s")
+    assert len(neighbours) == len(rows)
+    assert all(row not in ids for row, ids, _ in neighbours)
+
+    print("✅ Похожие компании работают корректно")
+
+def test_investor_matching():
+    """Тестируем подбор инвесторов: ранжирование, объяснения, исключение портфеля, пакетная оценка"""
+    print("\n🚀 Тестируем подбор инвесторов...")
+
+    import random
+    from datetime import date
+    from models import PortfolioEntry
+    from services.matching import matching_engine, MatchingModel
+
+    db = SessionLocal()
+    try:
+        company = Company(name="match-test-startup", country="MatchLand", stage="MatchSeed",
+                          industry="MatchFintech, MatchAI", status='active')
+        peer = Company(name="match-test-peer", country="MatchLand", stage="MatchSeed",
+                       industry="MatchFintech", status='active')
+        best = Investor(name="match-test-best", country="MatchLand", focus="MatchFintech, MatchAI",
+                        stages="MatchSeed", status='active')
+        partial = Investor(name="match-test-partial", country="Elsewhere", focus="MatchAI",
+                           stages="MatchGrowth", status='active')
+        holder = Investor(name="match-test-holder", country="MatchLand", focus="MatchFintech, MatchAI",
+                          stages="MatchSeed", status='active')
+        db.add_all([company, peer, best, partial, holder])
+        db.commit()
+        db.add(PortfolioEntry(investor_id=holder.id, company_id=company.id, amount=10.0, date=date(2024, 1, 1)))
+        db.add(PortfolioEntry(investor_id=best.id, company_id=peer.id, amount=10.0, date=date(2024, 1, 1)))
+        db.commit()
+
+        matches = matching_engine.investors_for_company(company.id, limit=5)
+        ids = [match['investor_id'] for match in matches]
+        assert ids[:2] == [best.id, partial.id]
+        # Инвестор, уже вложившийся в компанию, не предлагается
+        assert holder.id not in ids
+        assert matches[0]['score'] > matches[1]['score']
+        assert "Стадия: MatchSeed" in matches[0]['reasons']
+        assert any(reason.startswith("В портфеле: MatchFintech") for reason in matches[0]['reasons'])
+
+        companies = matching_engine.companies_for_investor(best.id, limit=5)
+        assert companies[0]['company_id'] == company.id
+        assert peer.id not in [match['company_id'] for match in companies]
+
+        db.query(PortfolioEntry).filter(PortfolioEntry.company_id.in_([company.id, peer.id])).delete(synchronize_session=False)
+        for obj in (company, peer, best, partial, holder):
+            db.delete(obj)
+        db.commit()
+    finally:
+        db.close()
+
+    # Пакетная оценка всех пар на синтетических данных
+    random.seed(7)
+    tags = [f"T{i}" for i in range(12)]
+    companies = [(i, f"c{i}", f"C{i % 5}", f"S{i % 4}", ", ".join(random.sample(tags, 2))) for i in range(2000)]
+    investors = [(i, f"i{i}", f"C{i % 5}", ", ".join(random.sample(tags, 3)), f"S{i % 4}, S{(i + 1) % 4}") for i in range(2000)]
+    start = time.time()
+    model = MatchingModel(companies, investors, [])
+    results = list(model.score_all(limit=10))
+    print(f"⏱️ 2000×2000 пар: {time.time() - start:.2f}s")
+    assert len(results) == len(companies)
+    assert all(len(ids) == 10 for _, ids, _ in results)
+
+    print("✅ Подбор инвесторов работает корректно")
+
+def test_analytics_rollups():
+    """Тестируем агрегаты аналитики: инкрементальные ячейки совпадают с полным пересчетом"""
+    print("\n🚀 Тестируем агрегаты аналитики...")
+
+    from datetime import date
+    from models import Deal, DealRollup
+    from services.analytics import analytics_service
+
+    analytics_service.ensure_schema()
+    analytics_service.install_hooks()
+
+    def rollups():
+        return sorted(tuple(row) for row in db.query(
+            DealRollup.year, DealRollup.month, DealRollup.country, DealRollup.stage, DealRollup.industry,
+            DealRollup.deal_type, DealRollup.deal_count, DealRollup.amount_sum, DealRollup.amount_min, DealRollup.amount_max
+        ))
+
+    db = SessionLocal()
+    company = Company(name="rollup-test", country="RollupLand", stage="Seed",
+                      industry="RollupTech, AI", status='active')
+    db.add(company)
+    db.commit()
+    try:
+        deals = [
+            Deal(type="Seed", amount=100.0, valuation=1000.0, date=date(2031, 3, 5), company_id=company.id),
+            Deal(type="Seed", amount=300.0, date=date(2031, 3, 20), company_id=company.id),
+            Deal(type="Series A", amount=50.0, date=date(2031, 7, 1), company_id=company.id),
+        ]
+        db.add_all(deals)
+        db.commit()
+
+        totals = analytics_service.summary(filters={'year': 2031}, db=db)[0]
+        assert (totals['count'], totals['sum'], totals['min'], totals['max']) == (3, 450.0, 50.0, 300.0)
+        assert totals['valuation_avg'] == 1000.0
+        by_industry = analytics_service.summary('industry', {'year': 2031}, db)
+        assert [row['key'] for row in by_industry] == ['RollupTech']
+        months = analytics_service.summary('month', {'year': 2031, 'country': 'RollupLand'}, db)
+        assert [(row['key'], row['count']) for row in months] == [(3, 2), (7, 1)]
+
+        # Удаление максимума и перенос сделки в другой месяц пересчитывают ячейки точно
+        db.delete(deals[1])
+        deals[2].date = date(2031, 3, 9)
+        db.commit()
+        totals = analytics_service.summary(filters={'year': 2031}, db=db)[0]
+        assert (totals['count'], totals['sum'], totals['max']) == (2, 150.0, 100.0)
+
+        # Смена страны компании переносит ее сделки в новые ячейки
+        company.country = "OtherLand"
+        db.commit()
+        countries = analytics_service.summary('country', {'year': 2031}, db)
+        assert [(row['key'], row['count']) for row in countries] == [("OtherLand", 2)]
+
+        incremental = rollups()
+        analytics_service.rebuild()
+        assert rollups() == incremental
+    finally:
+        # Данные удаляются и после упавшей проверки, через ORM - агрегаты обновляются событиями flush
+        db.rollback()
+        for deal in db.query(Deal).filter(Deal.company_id == company.id):
+            db.delete(deal)
+        db.delete(company)
+        db.commit()
+        db.close()
+    assert analytics_service.summary(filters={'year': 2031}) == []
+
+    print("✅ Агрегаты аналитики работают корректно")
+
+def test_funding_columns():
+    """Тестируем колоночную аналитику: перцентили, рост оценки и концентрация совпадают с построчным расчетом"""
+    print("\n🚀 Тестируем колоночную аналитику раундов...")
+
+    import random
+    import numpy as np
+    from collections import defaultdict
+    from datetime import date
+    from models import Deal
+    from services.funding import FundingColumns, funding_analytics
+
+    random.seed(11)
+    rounds = [
+        (random.randint(1, 300), date(random.randint(2019, 2024), random.randint(1, 12), random.randint(1, 28)),
+         random.choice([None, random.uniform(1e4, 1e7)]), random.choice([None, random.uniform(1e5, 1e8)]),
+         random.choice(["KZ", "UZ", "KG", ""]), random.choice(["Seed", "Series A"]), "AI", random.choice(["Seed", "A", "B"]))
+        for _ in range(20000)
+    ]
+    start = time.time()
+    columns = FundingColumns(rounds)
+    distribution = columns.distribution('amount', ('country', 'year'))
+    concentration = columns.concentration(('country', 'year'), top=10)
+    step_ups = columns.step_ups(('deal_type',))
+    print(f"⏱️ 20000 раундов: {time.time() - start:.3f}s")
+
+    # Построчный расчет для сравнения
+    amounts = defaultdict(list)
+    totals = defaultdict(lambda: defaultdict(float))
+    for company_id, day, amount, valuation, country, stage, industry, deal_type in rounds:
+        if amount is not None:
+            amounts[(country, day.year)].append(amount)
+            totals[(country, day.year)][company_id] += amount
+    for row in distribution:
+        values = amounts[(row['country'], row['year'])]
+        assert row['count'] == len(values)
+        assert np.allclose([row['quantiles'][name] for name in ('p25', 'p50', 'p75')], np.quantile(values, [0.25, 0.5, 0.75]))
+    assert len(distribution) == len(amounts)
+    for row in concentration:
+        companies = sorted(totals[(row['country'], row['year'])].values(), reverse=True)
+        assert row['companies'] == len(companies)
+        assert np.isclose(row['top_share'], sum(companies[:10]) / sum(companies))
+
+    ratios = defaultdict(list)
+    previous = {}
+    for company_id, day, amount, valuation, country, stage, industry, deal_type in sorted(rounds, key=lambda item: (item[0], item[1])):
+        if valuation is None:
+            continue
+        if company_id in previous:
+            ratios[deal_type].append(valuation / previous[company_id])
+        previous[company_id] = valuation
+    for row in step_ups:
+        assert np.isclose(row['quantiles']['p50'], np.median(ratios[row['deal_type']]))
+
+    # Снимок перестраивается после записи сделки
+    db = SessionLocal()
+    try:
+        company = Company(name="funding-test", country="FundLand", stage="Seed", status='active')
+        db.add(company)
+        db.commit()
+        db.add_all([
+            Deal(type="Seed", amount=100.0, valuation=1000.0, date=date(2032, 1, 1), company_id=company.id),
+            Deal(type="Series A", amount=300.0, valuation=4000.0, date=date(2032, 6, 1), company_id=company.id),
+        ])
+        db.commit()
+        rows = funding_analytics.distribution('amount', ('country',), {'year': 2032})
+        assert rows == [{'country': 'FundLand', 'count': 2, 'quantiles': {'p25': 150.0, 'p50': 200.0, 'p75': 250.0}}]
+        assert [item['step_up'] for item in funding_analytics.company_step_ups(company.id)] == [None, 4.0]
+
+        # Через ORM, а не Query.delete(): агрегаты deal_rollup обновляются событиями flush
+        for deal in db.query(Deal).filter(Deal.company_id == company.id):
+            db.delete(deal)
+        db.delete(company)
+        db.commit()
+        assert funding_analytics.distribution(filters={'year': 2032}) == []
+    finally:
+        db.close()
+
+    print("✅ Колоночная аналитика работает корректно")
+
+def test_admin_counters():
+    """Тестируем счетчики админки: статусы, приросты за неделю и обновление после записи"""
+    print("\n🚀 Тестируем счетчики админки...")
+
+    from datetime import datetime, timedelta
+    from models import Feedback
+    from services.admin_stats import admin_counters
+
+    db = SessionLocal()
+    try:
+        before = admin_counters.entity('feedback')
+        badges_before = admin_counters.badges().get('feedback', 0)
+        now = datetime.utcnow()
+        items = [
+            Feedback(type='bug', description='admin-counter-test', status='new', created_at=now),
+            Feedback(type='bug', description='admin-counter-test', status='new', created_at=now - timedelta(days=10)),
+            Feedback(type='bug', description='admin-counter-test', status='resolved', created_at=now - timedelta(days=30)),
+        ]
+        db.add_all(items)
+        db.commit()
+
+        # Запись в таблицу меняет поколение тега - кеш сразу отдает новые числа
+        after = admin_counters.entity('feedback')
+        assert after['total'] == before['total'] + 3
+        assert after['by_status'].get('new', 0) == before['by_status'].get('new', 0) + 2
+        assert after['by_status'].get('resolved', 0) == before['by_status'].get('resolved', 0) + 1
+        assert after['new_week'] == before['new_week'] + 1
+        assert after['new_prev_week'] == before['new_prev_week'] + 1
+        assert admin_counters.badges()['feedback'] == badges_before + 2
+
+        # Модели без created_at - только итоги и статусы
+        assert admin_counters.entity('deals')['new_week'] is None
+        assert set(admin_counters.all()) >= {'users', 'companies', 'investors', 'deals', 'jobs', 'news', 'events'}
+
+        for item in items:
+            db.delete(item)
+        db.commit()
+        assert admin_counters.entity('feedback')['total'] == before['total']
+    finally:
+        db.close()
+
+    print("✅ Счетчики админки работают корректно")
+
+def test_view_counter():
+    """Тестируем отложенные счетчики просмотров: пакетный сброс, повтор без двойного счета"""
+    print("\n🚀 Тестируем счетчики просмотров...")
+
+    from datetime import date
+    from models import EntityView
+    from services.views import ViewCounter, _Batch
+
+    counter = ViewCounter(interval=3600)
+    counter.ensure_schema()
+    db = SessionLocal()
+    news = News(title="views-test", slug="views-test", summary="s", content="c", date=date(2024, 1, 1), views=None)
+    company = Company(name="views-test", status='active')
+    db.add_all([news, company])
+    db.commit()
+    try:
+
+        for _ in range(5):
+            counter.record('news', news.id)
+        for _ in range(3):
+            counter.record('company', company.id)
+        # До сброса просмотры видны только в памяти воркера
+        assert counter.counts('company', [company.id]) == {company.id: 3}
+        assert counter.flush() == 8
+        assert counter.flush() == 0
+        db.refresh(news)
+        assert news.views == 5
+        assert counter.views('company', company.id) == 3
+
+        # Повтор уже примененной пачки (ошибка после коммита) не считается дважды
+        batch = _Batch({('company', company.id): 4})
+        assert counter._apply(batch) == 4
+        assert counter._apply(batch) == 0
+        assert counter.views('company', company.id) == 7
+
+        # Упавший сброс остается в очереди и применяется позже
+        engine = counter.engine
+        counter.record('company', company.id)
+        counter.engine = None
+        assert counter.flush() == 0
+        assert counter.pending('company', company.id) == 1
+        counter.engine = engine
+        assert counter.flush() == 1
+        assert counter.views('company', company.id) == 8
+
+        try:
+            counter.record('unknown', 1)
+            assert False, "ожидалась ошибка типа сущности"
+        except ValueError:
+            pass
+    finally:
+        # SQLite может выдать id удаленной компании новой записи - счетчик уходит вместе с ней
+        db.rollback()
+        db.query(EntityView).filter(EntityView.entity_type == 'company', EntityView.entity_id == company.id).delete()
+        db.delete(news)
+        db.delete(company)
+        db.commit()
+        db.close()
+
+    print("✅ Счетчики просмотров работают корректно")
+
+def test_trending_engine():
+    """Тестируем тренды: затухание, топ из кучи совпадает с полным перебором, комментарии после коммита"""
+    print("\n🚀 Тестируем трендовые рейтинги...")
+
+    import math
+    import random
+    from models import Comment, User
+    from services.trending import TrendingBoard, trending_engine
+
+    # Затухание: событие половину периода назад весит вдвое меньше свежего
+    board = TrendingBoard(half_life=3600, capacity=5, now=0.0)
+    board.add(1, 1.0, at=0.0)
+    board.add(2, 1.0, at=3600.0)
+    assert math.isclose(board.score(1, now=3600.0), 0.5)
+    assert [key for key, _ in board.ranked(2, now=3600.0)] == [2, 1]
+
+    # Топ-k из кучи совпадает с полным перебором, в том числе после переноса точки отсчета
+    random.seed(5)
+    board = TrendingBoard(half_life=60, capacity=10, now=0.0)
+    start = time.time()
+    at = 0.0
+    for _ in range(50000):
+        at += random.random() * 0.2
+        board.add(random.randint(1, 500), random.choice([1.0, 3.0]), at=at)
+    print(f"⏱️ 50000 событий: {time.time() - start:.3f}s")
+    expected = sorted(board.scores, key=lambda key: -board.scores[key])[:10]
+    assert [key for key, _ in board.ranked(10, now=at)] == expected
+
+    trending_engine.install_hooks()
+    db = SessionLocal()
+    try:
+        company = Company(name="trending-test", status='active')
+        user = db.query(User).first()
+        db.add(company)
+        db.commit()
+        before = trending_engine.scores('company', [company.id])[company.id]
+        trending_engine.record('company', company.id)
+        assert trending_engine.scores('company', [company.id])[company.id] > before
+        if user:
+            comment = Comment(content="trend", user_id=user.id, entity_type='company', entity_id=company.id)
+            db.add(comment)
+            db.flush()
+            # До коммита комментарий не учитывается
+            middle = trending_engine.scores('company', [company.id])[company.id]
+            db.commit()
+            assert trending_engine.scores('company', [company.id])[company.id] > middle + 2
+            db.delete(comment)
+        assert company.id in trending_engine.ranked_ids('company')
+        db.delete(company)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Трендовые рейтинги работают корректно")
+
+def test_sitemap_chunks():
+    """Тестируем sitemap: перегенерация только измененных частей, lastmod, стабильный ETag, удаление URL"""
+    print("\n🚀 Тестируем части sitemap...")
+
+    import shutil
+    import tempfile
+    from sqlalchemy import event
+    from db import engine
+    from services.sitemap import SitemapService, chunk_filename, SITEMAP_CHUNK_SIZE
+
+    directory = tempfile.mkdtemp()
+    service = SitemapService(directory=directory, site_url="https://example.test")
+    service.ensure_schema()
+    service.install_hooks()
+    db = SessionLocal()
+    try:
+        service.mark_all()
+        start = time.time()
+        service.refresh()
+        print(f"⏱️ Полная генерация: {time.time() - start:.3f}s")
+        assert service.refresh() == 0
+        index_path, index_etag = service.file('sitemap_index.xml')
+
+        company = Company(name="sitemap-test", status='active')
+        db.add(company)
+        db.commit()
+        filename = chunk_filename('company', company.id // SITEMAP_CHUNK_SIZE)
+        # Перегенерируется только часть новой компании
+        assert service.refresh() == 1
+        path, etag = service.file(filename)
+        content = open(path, encoding='utf-8').read()
+        entry = content.split(f"https://example.test/company/{company.id}</loc>")[1].split("</url>")[0]
+        assert "<lastmod>" in entry
+        assert filename in open(service.path('sitemap_index.xml'), encoding='utf-8').read()
+        # Без изменений файл и ETag те же
+        assert service.refresh() == 0
+        assert service.file(filename) == (path, etag)
+
+        db.delete(company)
+        db.commit()
+        assert service.refresh() == 1
+        found = service.file(filename)
+        if found:
+            assert f"/company/{company.id}</loc>" not in open(found[0], encoding='utf-8').read()
+            assert found[1] != etag
+        assert service.file('../models.py') is None
+
+        # Отметка - после коммита отдельной транзакцией: запись не трогает sitemap_chunk, откат ничего не отмечает
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            db.add(Company(name="sitemap-rollback", status='active'))
+            db.flush()
+            assert not any('sitemap_chunk' in statement for statement in statements)
+            db.rollback()
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        assert service.refresh() == 0
+    finally:
+        db.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print("✅ Части sitemap работают корректно")
+
+def test_comment_threads():
+    """Тестируем загрузку дерева комментариев: постоянное число запросов, вложенность, курсор по корням"""
+    print("\n🚀 Тестируем дерево комментариев...")
+
+    from sqlalchemy import event
+    from db import engine
+    from models import Comment, User
+    from services.comments import CommentService
+
+    db = SessionLocal()
+    try:
+        user = User(email="thread-test@example.com", password="-", role="startuper", first_name="Thread",
+                    last_name="Test", country_id=0, city="-", phone="-")
+        company = Company(name="thread-test", status='active')
+        db.add(user)
+        db.add(company)
+        db.commit()
+        roots = []
+        for index in range(6):
+            root = Comment(content=f"root {index}", user_id=user.id, entity_type='company', entity_id=company.id)
+            db.add(root)
+            db.flush()
+            roots.append(root)
+            parent = root
+            # Цепочка ответов глубиной 3 под каждым корнем
+            for depth in range(3):
+                parent = Comment(content=f"reply {index}.{depth}", user_id=user.id, entity_type='company',
+                                 entity_id=company.id, parent_id=parent.id)
+                db.add(parent)
+                db.flush()
+        hidden = Comment(content="deleted", user_id=user.id, entity_type='company', entity_id=company.id,
+                         parent_id=roots[0].id, status='deleted')
+        db.add(hidden)
+        db.commit()
+
+        company_id = company.id
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            first, cursor = CommentService.get_threads('company', company_id, limit=4)
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        # Корни с авторами и все ответы с авторами - два запроса
+        assert len(statements) == 2, statements
+        assert len(first) == 4 and cursor
+        node = first[0]
+        for depth in range(1, 4):
+            assert len(node.replies) == 1 and node.replies[0].depth == depth
+            node = node.replies[0]
+            assert node.comment.user.id == user.id
+        assert all(reply.comment.status == 'active' for reply in first[-1].replies)
+
+        second, cursor = CommentService.get_threads('company', company.id, limit=4, after=cursor)
+        assert len(second) == 2 and cursor is None
+        ids = [node.comment.id for node in first + second]
+        assert ids == [root.id for root in reversed(roots)]
+
+        shallow, _ = CommentService.get_threads('company', company.id, limit=1, max_depth=1)
+        assert shallow[0].replies and not shallow[0].replies[0].replies
+
+        for comment in db.query(Comment).filter(Comment.entity_type == 'company', Comment.entity_id == company.id).order_by(Comment.id.desc()):
+            db.delete(comment)
+        db.delete(company)
+        db.delete(user)
+        db.commit()
+    finally:
+        db.close()
+
+    print("✅ Дерево комментариев загружается корректно")
+
+def test_comment_counts():
+    """Тестируем счетчики комментариев: создание, повторное удаление, пачка сущностей, сверка"""
+    print("\n🚀 Тестируем счетчики комментариев...")
+
+    from models import Comment, CommentCount, User
+    from services.comments import CommentService, comment_counter
+
+    comment_counter.ensure_schema()
+    db = SessionLocal()
+    try:
+        user = User(email="counter-test@example.com", password="-", role="startuper", first_name="Counter",
+                    last_name="Test", country_id=0, city="-", phone="-")
+        companies = [Company(name=f"counter-test-{index}", status='active') for index in range(3)]
+        db.add(user)
+        db.add_all(companies)
+        db.commit()
+        ids = [company.id for company in companies]
+        user_id = user.id
+    finally:
+        db.close()
+
+    first = CommentService.create_comment(user_id, "first", 'company', ids[0])
+    CommentService.create_comment(user_id, "second", 'company', ids[0])
+    CommentService.create_comment(user_id, "reply", 'company', ids[0], parent_id=first.id)
+    CommentService.create_comment(user_id, "other", 'company', ids[1])
+    assert comment_counter.counts('company', ids) == {ids[0]: 3, ids[1]: 1, ids[2]: 0}
+
+    # Повторное удаление не уменьшает счетчик второй раз
+    assert CommentService.delete_comment(first.id, user_id)
+    assert CommentService.delete_comment(first.id, user_id)
+    assert CommentService.get_comment_count('company', ids[0]) == 2
+
+    # Запись в обход сервиса расходится со счетчиком до сверки
+    db = SessionLocal()
+    try:
+        db.add(Comment(content="direct", user_id=user_id, entity_type='company', entity_id=ids[2]))
+        db.query(CommentCount).filter(CommentCount.entity_type == 'company', CommentCount.entity_id == ids[1]).update({'count': 7})
+        db.commit()
+        assert comment_counter.reconcile() >= 2
+        assert comment_counter.counts('company', ids) == {ids[0]: 2, ids[1]: 1, ids[2]: 1}
+        assert comment_counter.reconcile() == 0
+
+        db.query(Comment).filter(Comment.entity_type == 'company', Comment.entity_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Company).filter(Company.id.in_(ids)).delete(synchronize_session=False)
+        db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        db.commit()
+        comment_counter.reconcile()
+        assert comment_counter.counts('company', ids) == {ids[0]: 0, ids[1]: 0, ids[2]: 0}
+    finally:
+        db.close()
+
+    print("✅ Счетчики комментариев работают корректно")
+
+def test_realtime_notifications():
+    """Тестируем уведомления в реальном времени: SSE-очередь, кеш непрочитанных без COUNT, брокер между воркерами"""
+    print("\n🚀 Тестируем уведомления в реальном времени...")
+
+    import asyncio
+    from sqlalchemy import event
+    from db import engine
+    from models import Notification, User
+    from services.notifications import NotificationService
+    from services.realtime import realtime_notifications, DatabaseBroker
+
+    realtime_notifications.ensure_schema()
+    realtime_notifications.install_hooks()
+    db = SessionLocal()
+    try:
+        user = User(email="live-test@example.com", password="-", role="startuper", first_name="Live",
+                    last_name="Test", country_id=0, city="-", phone="-")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+    finally:
+        db.close()
+    assert NotificationService.get_unread_count(user_id) == 0
+
+    async def receive_created():
+        queue = realtime_notifications.hub.subscribe(user_id)
+        try:
+            loop = asyncio.get_running_loop()
+            created = await loop.run_in_executor(
+                None, lambda: NotificationService.create_notification(user_id, "Новый раунд", "Компания привлекла инвестиции")
+            )
+            return created, await asyncio.wait_for(queue.get(), 2)
+        finally:
+            realtime_notifications.hub.unsubscribe(user_id, queue)
+
+    created, message = asyncio.run(receive_created())
+    assert message['event'] == 'notification' and message['data']['id'] == created.id
+    assert message['unread'] == 1
+
+    # Счетчик меняется событиями, без COUNT(*)
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        assert NotificationService.get_unread_count(user_id) == 1
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    assert not statements
+    assert NotificationService.mark_as_read(created.id, user_id)
+    assert NotificationService.mark_as_read(created.id, user_id)
+    assert NotificationService.get_unread_count(user_id) == 0
+    NotificationService.create_notification(user_id, "Вакансия", "Новая вакансия")
+    NotificationService.create_notification(user_id, "Вакансия", "Еще одна вакансия")
+    assert NotificationService.get_unread_count(user_id) == 2
+    NotificationService.mark_all_as_read(user_id)
+    assert NotificationService.get_unread_count(user_id) == 0
+
+    # Другой воркер: видит наши события через notification_event, его события доходят до нашего счетчика
+    other = DatabaseBroker(origin="other-worker")
+    other.poll()
+    received = []
+    latest = NotificationService.create_notification(user_id, "Мероприятие", "Новое мероприятие")
+    other.poll(received.append)
+    assert [item['data']['id'] for item in received if item['user_id'] == user_id] == [latest.id]
+    db = SessionLocal()
+    try:
+        other.publish(db, [{"user_id": user_id, "event": "read", "data": {"id": latest.id},
+                            "unread_delta": -1, "unread_reset": False}])
+        db.commit()
+    finally:
+        db.close()
+    realtime_notifications.broker.poll()
+    assert NotificationService.get_unread_count(user_id) == 0
+
+    db = SessionLocal()
+    try:
+        db.query(Notification).filter(Notification.user_id == user_id).delete(synchronize_session=False)
+        db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    realtime_notifications.counter.invalidate(user_id)
+
+    print("✅ Уведомления в реальном времени работают корректно")
+
+def test_notification_broker_gaps():
+    """Тестируем брокер: событие с меньшим id, закоммиченное позже, не теряется"""
+    print("\n🚀 Тестируем пропуски id в брокере уведомлений...")
+
+    import json
+    from datetime import datetime
+    from db import engine
+    from models import NotificationEvent
+    from services import realtime
+    from services.realtime import DatabaseBroker, realtime_notifications
+
+    realtime_notifications.ensure_schema()
+    reader = DatabaseBroker(origin="reader")
+    reader.poll()
+    base = reader._last_id
+
+    def commit_event(event_id):
+        with engine.begin() as connection:
+            connection.execute(NotificationEvent.__table__.insert(), {
+                "id": event_id, "user_id": None, "origin": "writer",
+                "payload": json.dumps({"user_id": 0, "event": "read", "data": {"id": event_id}, "unread_delta": 0}),
+                "created_at": datetime.utcnow(),
+            })
+
+    # Два воркера получили id base+1 и base+2, второй закоммитил раньше
+    received = []
+    commit_event(base + 2)
+    assert reader.poll(received.append) == 1
+    commit_event(base + 1)
+    commit_event(base + 3)
+    assert reader.poll(received.append) == 2
+    assert [item['id'] for item in received] == [base + 2, base + 1, base + 3]
+    assert reader.poll(received.append) == 0 and not reader._gaps
+
+    # Откаченная транзакция оставляет пропуск, который забывается по таймауту
+    commit_event(base + 5)
+    assert reader.poll(received.append) == 1 and list(reader._gaps) == [base + 4]
+    timeout = realtime.BROKER_GAP_TIMEOUT
+    realtime.BROKER_GAP_TIMEOUT = -1
+    try:
+        assert reader.poll(received.append) == 0
+    finally:
+        realtime.BROKER_GAP_TIMEOUT = timeout
+    assert not reader._gaps and reader._last_id == base + 5
+
+    with engine.begin() as connection:
+        connection.execute(NotificationEvent.__table__.delete().where(NotificationEvent.id > base))
+
+    print("✅ Брокер уведомлений не теряет события с пропусками id")
+
+def test_notification_fan_out():
+    """Тестируем рассылку: аудитории, пачки INSERT в одной транзакции, одно событие на пачку"""
+    print("\n🚀 Тестируем массовую рассылку уведомлений...")
+
+    import asyncio
+    from sqlalchemy import func, insert, select
+    from models import Notification, NotificationEvent, User
+    from services.notifications import NotificationService
+    from services.realtime import realtime_notifications
+
+    realtime_notifications.ensure_schema()
+    realtime_notifications.install_hooks()
+    db = SessionLocal()
+    try:
+        users = [
+            User(email=f"fanout-{index}@example.com", password="-", role="fanout-test", first_name="Fan",
+                 last_name="Out", country_id=0, city="-", phone="-")
+            for index in range(3)
+        ]
+        db.add_all(users)
+        db.commit()
+        user_ids = [user.id for user in users]
+        last_event = db.query(func.max(NotificationEvent.id)).scalar() or 0
+    finally:
+        db.close()
+    assert NotificationService.get_unread_count(user_ids[0]) == 0
+
+    async def receive_round():
+        queue = realtime_notifications.hub.subscribe(user_ids[0])
+        try:
+            loop = asyncio.get_running_loop()
+            count = await loop.run_in_executor(None, lambda: NotificationService.fan_out(
+                "Новый раунд", "Компания X привлекла инвестиции", 'success', 'company', 1,
+                role="fanout-test", batch_size=2
+            ))
+            return count, await asyncio.wait_for(queue.get(), 2)
+        finally:
+            realtime_notifications.hub.unsubscribe(user_ids[0], queue)
+
+    count, message = asyncio.run(receive_round())
+    assert count == 3
+    assert message['unread'] == 1 and message['data']['title'] == "Новый раунд" and message['data']['id']
+    db = SessionLocal()
+    try:
+        # Три получателя пачками по два - два события брокера
+        assert db.query(NotificationEvent).filter(NotificationEvent.id > last_event).count() == 2
+        assert db.query(Notification).filter(Notification.user_id.in_(user_ids)).count() == 3
+    finally:
+        db.close()
+
+    count = NotificationService.fan_out("Новости", "Дайджест", query=select(User.id).where(User.email.like("fanout-%")))
+    assert count == 3
+    assert NotificationService.get_unread_count(user_ids[0]) == 2
+
+    # Несуществующие id пропускаются: без сирот и без отката всей рассылки
+    count = NotificationService.fan_out("Проверка", "Только существующие", user_ids=[user_ids[0], 999_999_999])
+    assert count == 1
+    assert NotificationService.get_unread_count(user_ids[0]) == 3
+
+    # Большая аудитория списком id (с повторами)
+    synthetic = list(range(10_000_000, 10_020_000))
+    db = SessionLocal()
+    try:
+        db.execute(insert(User), [
+            {"id": user_id, "email": f"fanout-bulk-{user_id}@example.com", "password": "-", "role": "fanout-bulk",
+             "first_name": "Fan", "last_name": "Out", "country_id": 0, "city": "-", "phone": "-"}
+            for user_id in synthetic
+        ])
+        db.commit()
+    finally:
+        db.close()
+    start = time.time()
+    count = NotificationService.fan_out("Рассылка", "Всем", user_ids=synthetic + synthetic[:100])
+    print(f"⏱️ 20000 уведомлений: {time.time() - start:.3f}s")
+    assert count == 20000
+
+    db = SessionLocal()
+    try:
+        assert db.query(Notification).filter(Notification.user_id >= 10_000_000).count() == 20000
+        assert db.query(Notification).filter(Notification.user_id == 999_999_999).count() == 0
+        db.query(Notification).filter(
+            (Notification.user_id >= 10_000_000) | Notification.user_id.in_(user_ids)
+        ).delete(synchronize_session=False)
+        db.query(User).filter(User.id.in_(user_ids) | (User.id >= 10_000_000)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    for user_id in user_ids:
+        realtime_notifications.counter.invalidate(user_id)
+
+    print("✅ Массовая рассылка уведомлений работает корректно")
+
+def test_notification_digest_retention():
+    """Тестируем дайджест похожих уведомлений и архивацию старых прочитанных"""
+    print("\n🚀 Тестируем дайджест и архивацию уведомлений...")
+
+    from datetime import datetime, timedelta
+    from models import Notification, NotificationArchive, User
+    from services.notification_archive import notification_archiver
+    from services.notifications import NotificationService
+    from services.realtime import realtime_notifications
+
+    realtime_notifications.ensure_schema()
+    notification_archiver.ensure_schema()
+    db = SessionLocal()
+    try:
+        user = User(email="digest@example.com", password="-", role="digest-test", first_name="Digest",
+                    last_name="Test", country_id=0, city="-", phone="-")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+    finally:
+        db.close()
+
+    # Три комментария к одной компании - одно уведомление с group_count 3
+    for index in range(3):
+        NotificationService.create_notification(user_id, "Новый комментарий", f"Комментарий {index}", 'info', 'company', 7)
+    NotificationService.fan_out("Новый комментарий", "Комментарий 3", 'info', 'company', 7, user_ids=[user_id])
+    NotificationService.create_notification(user_id, "Вакансия", "Другая сущность", 'info', 'job', 7)
+    notifications = NotificationService.get_user_notifications(user_id)
+    assert len(notifications) == 2
+    grouped = next(n for n in notifications if n.entity_type == 'company')
+    assert grouped.group_count == 4 and grouped.message == "Комментарий 3"
+    assert NotificationService.get_unread_count(user_id) == 2
+
+    # Прочитанное уведомление не сворачивает новое
+    NotificationService.mark_as_read(grouped.id, user_id)
+    NotificationService.create_notification(user_id, "Новый комментарий", "Комментарий 4", 'info', 'company', 7)
+    assert len(NotificationService.get_user_notifications(user_id)) == 3
+
+    # Архивация: переносятся только прочитанные старше срока хранения
+    db = SessionLocal()
+    try:
+        old = datetime.utcnow() - timedelta(days=100)
+        db.query(Notification).filter(Notification.user_id == user_id).update({Notification.created_at: old})
+        extra = [Notification(user_id=user_id, title=f"Старое {index}", message="-", type="info", is_read=True, created_at=old)
+                 for index in range(4)]
+        db.add_all(extra)
+        db.commit()
+    finally:
+        db.close()
+    assert notification_archiver.archive(older_than_days=90, batch_size=2) == 5
+    assert notification_archiver.archive(older_than_days=90, batch_size=2) == 0
+
+    db = SessionLocal()
+    try:
+        remaining = db.query(Notification).filter(Notification.user_id == user_id).all()
+        assert len(remaining) == 2 and not any(n.is_read for n in remaining)
+        archived = db.query(NotificationArchive).filter(NotificationArchive.user_id == user_id).all()
+        assert len(archived) == 5
+        assert {a.group_count for a in archived if a.entity_type == 'company'} == {4}
+        db.query(Notification).filter(Notification.user_id == user_id).delete(synchronize_session=False)
+        db.query(NotificationArchive).filter(NotificationArchive.user_id == user_id).delete(synchronize_session=False)
+        db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    realtime_notifications.counter.invalidate(user_id)
+
+    # База до дайджеста: колонка group_count добавляется при старте, повторный старт ничего не меняет
+    from sqlalchemy import create_engine, inspect, text
+    from services.notification_archive import NotificationArchiver
+
+    legacy = create_engine('sqlite://')
+    with legacy.begin() as connection:
+        connection.execute(text("CREATE TABLE notification (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                                "title VARCHAR(256) NOT NULL, message TEXT NOT NULL, type VARCHAR(32) NOT NULL, "
+                                "entity_type VARCHAR(32), entity_id INTEGER, is_read BOOLEAN, created_at DATETIME)"))
+        connection.execute(text("INSERT INTO notification (user_id, title, message, type) VALUES (1, 'old', '-', 'info')"))
+    archiver = NotificationArchiver(bind=legacy)
+    archiver.ensure_schema()
+    archiver.ensure_schema()
+    assert 'group_count' in {column['name'] for column in inspect(legacy).get_columns('notification')}
+    with legacy.connect() as connection:
+        assert connection.execute(text("SELECT group_count FROM notification")).scalar() == 1
+    legacy.dispose()
+
+    print("✅ Дайджест и архивация уведомлений работают корректно")
+
 def test_api_endpoints():
     """Тестируем API эндпоинты (если сервер запущен)"""
     print("\n🚀 Тестируем API эндпоинты...")
@@ -238,7 +1874,35 @@ if __name__ == "__main__":
         test_pagination_performance()
         test_cache_invalidation()
         test_pagination_helper()
+        test_cursor_pagination()
+        test_count_service()
+        test_facet_index()
+        test_tag_filters()
+        test_deal_investor_links()
+        test_coinvest_graph()
+        test_similar_companies()
+        test_investor_matching()
+        test_analytics_rollups()
+        test_funding_columns()
+        test_admin_counters()
+        test_view_counter()
+        test_trending_engine()
+        test_sitemap_chunks()
+        test_comment_threads()
+        test_comment_counts()
+        test_realtime_notifications()
+        test_notification_broker_gaps()
+        test_notification_fan_out()
+        test_notification_digest_retention()
         test_cache_stats()
+        test_cache_tiers()
+        test_cache_tag_invalidation()
+        test_snapshot_codec_benchmark()
+        test_cache_single_flight()
+        test_search_index()
+        test_backfill_lock()
+        test_search_transliteration()
+        test_trigram_search_plan()
         test_api_endpoints()
         performance_benchmark()
         
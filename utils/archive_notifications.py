@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Скрипт для переноса старых прочитанных уведомлений в архив.
+"""
+
+from services.notification_archive import notification_archiver, NOTIFICATION_RETENTION_DAYS
+
+def archive_notifications():
+    """Переносит прочитанные уведомления старше NOTIFICATION_RETENTION_DAYS в notification_archive"""
+    notification_archiver.ensure_schema()
+    archived = notification_archiver.archive()
+    print(f"Перенесено уведомлений старше {NOTIFICATION_RETENTION_DAYS} дней: {archived}")
+    print("✅ Архивация уведомлений завершена")
+
+if __name__ == "__main__":
+    print("🗄️ Архивация уведомлений...")
+    archive_notifications()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Миграция поля Deal.investors в таблицу связей сделок с инвесторами (deal_investor).
+"""
+
+from services.deals import deal_investor_index
+
+def migrate_deal_investors():
+    """Создает таблицу связей и сопоставляет имена инвесторов сделок с Investor.id"""
+    deal_investor_index.ensure_schema()
+    counts = deal_investor_index.backfill()
+    print(f"Сделок: {counts['deals']}, связей с инвесторами: {counts['links']}")
+    print("✅ Связи сделок с инвесторами заполнены")
+
+if __name__ == "__main__":
+    print("🤝 Миграция участия инвесторов в сделках...")
+    migrate_deal_investors()
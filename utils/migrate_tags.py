@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""
+Миграция строковых полей Investor.focus, Investor.stages и Company.industry в таблицы тегов.
+"""
+
+from services.tags import tag_service
+
+def migrate_tags():
+    """Создает таблицы тегов и разбирает в них текущие значения полей"""
+    tag_service.ensure_schema()
+    counts = tag_service.backfill()
+    for entity_type, count in counts.items():
+        print(f"{entity_type}: {count} записей")
+    print("✅ Теги заполнены")
+
+if __name__ == "__main__":
+    print("🏷️ Миграция тегов...")
+    migrate_tags()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Скрипт для полного пересчета агрегатов аналитики сделок.
+"""
+
+from services.analytics import analytics_service
+
+def rebuild_analytics():
+    """Создает таблицу deal_rollup и пересчитывает все ячейки по сделкам"""
+    analytics_service.ensure_schema()
+    counts = analytics_service.rebuild()
+    print(f"Сделок: {counts['deals']}, ячеек: {counts['cells']}")
+    print("✅ Агрегаты аналитики пересчитаны")
+
+if __name__ == "__main__":
+    print("📊 Пересчет агрегатов аналитики...")
+    rebuild_analytics()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Скрипт для полного пересчета графа соинвестиций (раунды и ребра между инвесторами).
+"""
+
+from services.coinvest import coinvest_graph
+
+def rebuild_coinvest_graph():
+    """Создает таблицы графа и пересчитывает их по сделкам и записям портфеля"""
+    coinvest_graph.ensure_schema()
+    counts = coinvest_graph.rebuild()
+    print(f"Раундов: {counts['rounds']}, ребер: {counts['edges']}")
+    print("✅ Граф соинвестиций пересчитан")
+
+if __name__ == "__main__":
+    print("🕸️ Пересчет графа соинвестиций...")
+    rebuild_coinvest_graph()
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""
+Скрипт для пересчета фасетов фильтров (значения фильтров списков с количествами).
+"""
+
+from services.facets import facet_index
+
+def rebuild_facets():
+    """Создает таблицу фасетов и пересчитывает ее по активным записям"""
+    facet_index.ensure_schema()
+    counts = facet_index.rebuild()
+    for entity_type, count in counts.items():
+        print(f"{entity_type}: {count} значений")
+    print("✅ Фасеты пересчитаны")
+
+if __name__ == "__main__":
+    print("📊 Пересчет фасетов фильтров...")
+    rebuild_facets()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Скрипт для перестройки поискового индекса.
+Заново индексирует активные компании, инвесторов, новости и вакансии.
+"""
+
+from services.search import search_service
+
+def rebuild_search_index():
+    """Создает таблицу индекса и полностью перестраивает его"""
+    search_service.ensure_schema()
+    counts = search_service.rebuild()
+    for entity_type, count in counts.items():
+        print(f"{entity_type}: {count}")
+    print(f"✅ Проиндексировано записей: {sum(counts.values())}")
+
+if __name__ == "__main__":
+    print("🔍 Перестройка поискового индекса...")
+    rebuild_search_index()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Скрипт для полного пересчета списков похожих компаний.
+"""
+
+from services.similarity import similarity_engine
+
+def rebuild_similar_companies():
+    """Создает таблицу соседей и пересчитывает top-k для всех активных компаний"""
+    similarity_engine.ensure_schema()
+    counts = similarity_engine.rebuild()
+    print(f"Компаний: {counts['companies']}, соседей: {counts['neighbours']}")
+    print("✅ Похожие компании пересчитаны")
+
+if __name__ == "__main__":
+    print("🧭 Пересчет похожих компаний...")
+    rebuild_similar_companies()
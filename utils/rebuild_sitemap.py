@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""
+Скрипт для полной перегенерации файлов sitemap.
+"""
+
+from services.sitemap import sitemap_service
+
+def rebuild_sitemap():
+    """Отмечает все части sitemap устаревшими и перегенерирует их вместе с индексом"""
+    sitemap_service.ensure_schema()
+    marked = sitemap_service.mark_all()
+    generated = sitemap_service.refresh()
+    print(f"Частей отмечено: {marked}, перегенерировано: {generated}")
+    print("✅ Sitemap перегенерирован")
+
+if __name__ == "__main__":
+    print("🗺️ Перегенерация sitemap...")
+    rebuild_sitemap()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Скрипт для сверки счетчиков комментариев с таблицей comment.
+"""
+
+from services.comments import comment_counter
+
+def reconcile_comment_counts():
+    """Создает таблицу comment_count и исправляет разошедшиеся счетчики"""
+    comment_counter.ensure_schema()
+    fixed = comment_counter.reconcile()
+    print(f"Исправлено счетчиков: {fixed}")
+    print("✅ Счетчики комментариев сверены")
+
+if __name__ == "__main__":
+    print("💬 Сверка счетчиков комментариев...")
+    reconcile_comment_counts()
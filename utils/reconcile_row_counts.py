@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+Скрипт для сверки счетчиков строк SQLite (приблизительные количества админки) с COUNT(*).
+"""
+
+from services.counts import count_service
+
+def reconcile_row_counts():
+    """Исправляет счетчики строк, сдвинутые записями мимо ORM (массовые delete, скрипты, ручной SQL)"""
+    fixed = count_service.reconcile()
+    print(f"Исправлено счетчиков: {fixed}")
+    print("✅ Счетчики строк сверены")
+
+if __name__ == "__main__":
+    print("🔢 Сверка счетчиков строк...")
+    reconcile_row_counts()
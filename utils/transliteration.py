@@ -0,0 +1,58 @@
+"""
+Транслитерация кириллицы в латиницу и нормализация текста для поиска.
+"""
+
+import re
+import unicodedata
+from typing import Set
+
+# Таблица транслитерации кириллицы (используется и для slug новостей)
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'E',
+    'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й': 'Y', 'К': 'K', 'Л': 'L', 'М': 'M',
+    'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R', 'С': 'S', 'Т': 'T', 'У': 'U',
+    'Ф': 'F', 'Х': 'H', 'Ц': 'Ts', 'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch',
+    'Ъ': '', 'Ы': 'Y', 'Ь': '', 'Э': 'E', 'Ю': 'Yu', 'Я': 'Ya'
+}
+
+# Буквы казахского, узбекского, кыргызского и таджикского алфавитов (строчные)
+CENTRAL_ASIAN_TO_LATIN = {
+    'ә': 'a', 'ғ': 'g', 'қ': 'k', 'ң': 'ng', 'ө': 'o', 'ұ': 'u', 'ү': 'u',
+    'һ': 'h', 'і': 'i', 'ў': 'o', 'ҳ': 'h', 'ҷ': 'j', 'ӣ': 'i', 'ӯ': 'u'
+}
+
+_SEARCH_TRANSLITERATION = {
+    cyr: lat.lower() for cyr, lat in {**CYRILLIC_TO_LATIN, **CENTRAL_ASIAN_TO_LATIN}.items() if cyr.islower()
+}
+
+# Апострофы узбекской латиницы (o‘zbek, g‘isht) выкидываются, а не разделяют слово
+_APOSTROPHES = re.compile(r"['‘’ʻʼ`]")
+_NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+def normalize_search_key(text: str) -> str:
+    """Ключ поиска: нижний регистр, латиница без диакритики, слова через пробел"""
+    if not text:
+        return ''
+    text = text.lower()
+    text = ''.join(_SEARCH_TRANSLITERATION.get(char, char) for char in text)
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = _APOSTROPHES.sub('', text)
+    return _NON_ALPHANUMERIC.sub(' ', text).strip()
+
+def trigrams(key: str, prefix: bool = False) -> Set[str]:
+    """Триграммы ключа поиска; prefix=True - последнее слово может быть недописанным"""
+    result = set()
+    words = key.split()
+    for index, word in enumerate(words):
+        padded = f'  {word} '
+        if prefix and index == len(words) - 1:
+            padded = padded[:-1]
+        for start in range(len(padded) - 2):
+            result.add(padded[start:start + 3])
+    return result